@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Measure cold-start time: a fresh interpreter importing ptrial.observer.kernel, and bin/observe
+starting up (--help parses arguments after every module-level import).
+
+Each case runs in a new process, so nothing is cached in the interpreter.  The time of an
+interpreter that does nothing is measured too and subtracted.  Run from the top of the tree:
+
+  python bench/startup.py [--runs N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = (
+    ('python', [sys.executable, '-c', 'pass']),
+    ('import ptrial.observer.kernel', [sys.executable, '-c', 'import ptrial.observer.kernel']),
+    ('bin/observe --help', [sys.executable, os.path.join(ROOT, 'bin', 'observe'), '--help']),
+)
+
+
+def run(argv, runs):
+    """
+    Wall-clock seconds for each of runs executions of argv.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='')
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call(argv, env=env, stdout=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure ptrial cold-start time')
+    parser.add_argument('--runs', type=int, default=20, help='runs of each case')
+    args = parser.parse_args()
+    results = [(name, run(argv, args.runs)) for name, argv in CASES]
+    base = results[0][1][0]
+    print '{:<32} {:>9} {:>9} {:>9}'.format('case', 'min ms', 'median ms', 'over base')
+    for name, times in results:
+        best = times[0]
+        median = times[len(times) // 2]
+        print '{:<32} {:>9.1f} {:>9.1f} {:>9.1f}'.format(name, best * 1000, median * 1000,
+                                                         (best - base) * 1000)
+
+if __name__ == '__main__':
+    main()
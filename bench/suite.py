@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Measure the cost of collection: reading each kernel observer's source, encoding datapoints,
+moving them through the queues and delivery paths, and scheduling many observers.
+
+Observers read recorded /proc and /sys files (bench/fixtures and the fixtures in ptrial/test),
+so results from different hosts and kernels can be compared.  ProcessTableObserver is the
+exception; it scans this host's live /proc.
+
+Each case is timed several times and the best run is kept, as timeit does.  Results are printed
+as a table, and can be written as JSON and compared with an earlier run:
+
+  python bench/suite.py [--json results.json] [--compare baseline.json] [--filter queue]
+"""
+import argparse
+from collections import OrderedDict
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ptrial.observer.core import LoopObserver, CSV_DATA, JSON_DATA, PYTHON_DATA
+from ptrial.observer.encoders import CsvEncoder, NdjsonEncoder
+from ptrial.observer.kernel import (DiskStatsObserver, MemoryObserver, ProcessObserver,
+                                    ProcessTableObserver, ProcReader, StorageObserver)
+from ptrial.observer.queues import BoundedQueue, Channel, DROP_OLDEST
+from ptrial.observer.scheduler import Scheduler
+from ptrial.observer.workers import Ring, _RingQueue, _unpack
+from Queue import Queue
+from threading import Thread
+
+FIXTURES = os.path.join(ROOT, 'bench', 'fixtures')
+TEST_FIXTURES = os.path.join(ROOT, 'ptrial', 'test')
+RESULT_VERSION = 1
+MIN_TIME = 0.2  # seconds that one timed run of a case should take at least
+BATCH = 1000  # datapoints per queue and encoder batch
+SCHEDULER_SIZES = (10, 100, 1000)
+SAMPLES_PER_OBSERVER = 20
+
+
+class _NullObserver(LoopObserver):
+    """
+    An observer whose source costs next to nothing, so that timing it shows the loop overhead.
+    """
+    def __init__(self, name, queue, count):
+        super(_NullObserver, self).__init__(name, queue, interval=1e-9, count=count)
+        self._field_names = ('a', 'b', 'c')
+        self._values = OrderedDict([('a', 1), ('b', 2), ('c', 3)])
+
+    def _read_source(self):
+        return self._values
+
+def fixture(name):
+    return os.path.join(FIXTURES, name)
+
+def test_fixture(name):
+    return os.path.join(TEST_FIXTURES, name)
+
+def datapoints(n):
+    """
+    n MemoryObserver datapoints read from the meminfo fixture.
+    """
+    obs = MemoryObserver('mem', source=test_fixture('meminfo'))
+    return [obs.get_datapoint(1426168800 + i) for i in range(n)]
+
+# Cases.  Each returns a function that does some number of operations and returns that number.
+
+def read_source(make):
+    def case():
+        obs = make()
+        read = obs._read_source
+        def run(n):
+            for _ in xrange(n):
+                read()
+            return n
+        return run
+    return case
+
+def _storage():
+    obs = StorageObserver('storage', None, '/')
+    obs._reader = ProcReader(fixture('block-stat'))
+    return obs
+
+def _process():
+    obs = ProcessObserver('process', None, pid=os.getpid())
+    obs._reader = ProcReader(fixture('pid-stat'))
+    return obs
+
+def encode(data_format):
+    def case():
+        obs = MemoryObserver('mem', source=test_fixture('meminfo'), data_format=data_format)
+        encoder = obs._encode
+        point = datapoints(1)[0]
+        def run(n):
+            for _ in xrange(n):
+                encoder(point)
+            return n
+        return run
+    return case
+
+def encode_batch(make):
+    def case():
+        points = datapoints(BATCH)
+        obs = MemoryObserver('mem', source=test_fixture('meminfo'))
+        def run(n):
+            for _ in xrange(n):
+                make(obs).encode(points)
+            return n * BATCH
+        return run
+    return case
+
+def queue_roundtrip(make, batched=False):
+    """
+    Publish a batch of datapoints and take them all out again.
+    """
+    def case():
+        points = datapoints(BATCH)
+        def run(n):
+            for _ in xrange(n):
+                q = make()
+                if batched:
+                    q.put_many(points)
+                    q.drain()
+                    continue
+                put = q.put
+                for point in points:
+                    put(point)
+                get = q.get_nowait
+                for _ in points:
+                    get()
+            return n * BATCH
+        return run
+    return case
+
+def ring_roundtrip():
+    """
+    Send datapoints to a worker pool's parent: pack, marshal, ring write, read and unpack.
+    """
+    def case():
+        import marshal
+        points = datapoints(BATCH)
+        ring = Ring(BATCH * 4096)  # room for the whole batch, so nothing is dropped
+        def run(n):
+            for _ in xrange(n):
+                queue = _RingQueue(ring, 0)
+                for point in points:
+                    queue.put(point)
+                for record in ring.read():
+                    _unpack(marshal.loads(record)[2])
+            return n * BATCH
+        return run
+    return case
+
+def scheduler(nobservers):
+    """
+    Samples per second through a Scheduler, for observers that cost next to nothing.
+    """
+    def case():
+        def run(n):
+            total = 0
+            for _ in xrange(n):
+                sched = Scheduler()
+                for i in range(nobservers):
+                    sched.add(_NullObserver('obs{}'.format(i), Channel(), SAMPLES_PER_OBSERVER))
+                thread = Thread(target=sched.run)
+                thread.start()
+                while len(sched):
+                    time.sleep(0.001)
+                sched.stop()
+                thread.join()
+                total += nobservers * SAMPLES_PER_OBSERVER
+            return total
+        return run
+    return case
+
+def direct_samples(nobservers):
+    """
+    The same samples taken by calling sample() in a loop, as a baseline for the scheduler.
+    """
+    def case():
+        def run(n):
+            total = 0
+            for _ in xrange(n):
+                observers = [_NullObserver('obs{}'.format(i), Channel(), SAMPLES_PER_OBSERVER)
+                             for i in range(nobservers)]
+                for _ in range(SAMPLES_PER_OBSERVER):
+                    for obs in observers:
+                        obs.sample()
+                total += nobservers * SAMPLES_PER_OBSERVER
+            return total
+        return run
+    return case
+
+CASES = [
+    ('read_source.StorageObserver', read_source(_storage)),
+    ('read_source.DiskStatsObserver', read_source(
+        lambda: DiskStatsObserver('disks', None, source=test_fixture('diskstats')))),
+    ('read_source.MemoryObserver', read_source(
+        lambda: MemoryObserver('mem', source=test_fixture('meminfo')))),
+    ('read_source.ProcessObserver', read_source(_process)),
+    ('read_source.ProcessTableObserver (live /proc)', read_source(
+        lambda: ProcessTableObserver('ptable', None))),
+    ('encode.python', encode(PYTHON_DATA)),
+    ('encode.csv', encode(CSV_DATA)),
+    ('encode.json', encode(JSON_DATA)),
+    ('encode_batch.CsvEncoder', encode_batch(lambda obs: CsvEncoder(obs.name, obs.field_names))),
+    ('encode_batch.NdjsonEncoder', encode_batch(lambda obs: NdjsonEncoder(obs.name))),
+    ('queue.Queue', queue_roundtrip(Queue)),
+    ('queue.BoundedQueue', queue_roundtrip(lambda: BoundedQueue(BATCH, DROP_OLDEST))),
+    ('queue.Channel', queue_roundtrip(Channel)),
+    ('queue.Channel.put_many+drain', queue_roundtrip(Channel, batched=True)),
+    ('delivery.Ring', ring_roundtrip()),
+]
+for _n in SCHEDULER_SIZES:
+    CASES.append(('scheduler.{}'.format(_n), scheduler(_n)))
+    CASES.append(('sample_loop.{}'.format(_n), direct_samples(_n)))
+
+
+def measure(case, repeat):
+    """
+    Time a case.
+
+    Returns:
+      Seconds per operation of the best run, and the operations in a run.
+    """
+    run = case()
+    n = 1
+    while True:
+        start = time.time()
+        ops = run(n)
+        elapsed = time.time() - start
+        if elapsed >= MIN_TIME or n >= 2 ** 20:
+            break
+        n *= 2 if elapsed * 10 > MIN_TIME else 10
+    best = elapsed / ops
+    for _ in range(repeat - 1):
+        start = time.time()
+        ops = run(n)
+        best = min(best, (time.time() - start) / ops)
+    return best, ops
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of ptrial collection')
+    parser.add_argument('--json', metavar='FILE', help='write results as JSON ("-" for stdout)')
+    parser.add_argument('--compare', metavar='FILE', help='JSON results of an earlier run')
+    parser.add_argument('--filter', default='', help='run only cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each case')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((r['name'], r) for r in json.load(f)['results'])
+
+    results = []
+    out = sys.stderr if args.json == '-' else sys.stdout
+    print >>out, '{:<46} {:>12} {:>14} {:>9}'.format('case', 'us/op', 'ops/s', 'vs base')
+    for name, case in CASES:
+        if args.filter not in name:
+            continue
+        seconds, ops = measure(case, args.repeat)
+        result = {'name': name, 'us_per_op': seconds * 1e6, 'ops_per_sec': 1 / seconds,
+                  'ops_per_run': ops, 'repeat': args.repeat}
+        results.append(result)
+        ratio = ''
+        if name in baseline:
+            ratio = '{:.2f}x'.format(seconds * 1e6 / baseline[name]['us_per_op'])
+        print >>out, '{:<46} {:>12.3f} {:>14.0f} {:>9}'.format(name, seconds * 1e6, 1 / seconds,
+                                                                ratio)
+    for n in SCHEDULER_SIZES:
+        sched = [r for r in results if r['name'] == 'scheduler.{}'.format(n)]
+        loop = [r for r in results if r['name'] == 'sample_loop.{}'.format(n)]
+        if sched and loop:
+            print >>out, 'scheduler overhead at {} observers: {:.3f} us/sample'.format(
+                n, sched[0]['us_per_op'] - loop[0]['us_per_op'])
+
+    if args.json:
+        report = {
+            'version': RESULT_VERSION,
+            'time': int(time.time()),
+            'host': platform.node(),
+            'machine': platform.machine(),
+            'kernel': platform.release(),
+            'python': platform.python_version(),
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
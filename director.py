@@ -1,15 +1,21 @@
 """
 Top-level classes for running a trial.
 """
-import context
+from ptrial.context import core as context
+from ptrial.observer.pull import Collector, DEFAULT_IN_FLIGHT, DEFAULT_TIMEOUT
 import collections
 import datetime
+import socket
 import time
-import util
 
 # The version shall increment whenever the stored representation of a Director changes.
 DIRECTOR_VERSION = 1
 
+DEFAULT_AGENT_PORT = 8080
+
+# Private constants
+_INVALID_ADDRESS = 'Not an IPv4 address: "{}"'
+
 class Director(object):
     """
     The director is responsible for initiating a trial.
@@ -17,11 +23,19 @@ class Director(object):
     The director holds context and control parameters for gathering data across all nodes in
     a test.  It is responsible for creating and controlling Node Managers and receiving summary
     information at the end of the test.
+
+    Observer data is pulled from every node's agent (a BatchHandler, see ptrial.observer.fetch)
+    concurrently by collect(); see ptrial.observer.pull.
     
     Args:
-      name: a name for the 
+      name: a name for the trial
+      descr: what the trial is for
+      email: who to contact about the trial
+      max_in_flight: most node requests outstanding at once
+      timeout: seconds to wait for a node to answer
     """
-    def __init__(self, name, descr, email):
+    def __init__(self, name, descr, email, max_in_flight=DEFAULT_IN_FLIGHT,
+                 timeout=DEFAULT_TIMEOUT):
         """
         Create the trial context.
         """
@@ -38,19 +52,50 @@ class Director(object):
         self._summary = { 'run_duration': None, }
         self._nodes = []
         self._node_context = {}
+        self._collector = Collector(max_in_flight, timeout)
 
     def set_duration(self, duration):
         self._context['duration'] = datetime.timedelta(hours=duration)
         
-    def add_node(self, address):
+    def add_node(self, address, port=DEFAULT_AGENT_PORT):
         """
         Add a compute node to the trial.
         
         Args:
           address: primary IP address of node.
+          port: port of the node's agent
         """
-        self._nodes.append(util.IPv4Address(address))
-        
+        try:
+            socket.inet_aton(address)
+        except (socket.error, TypeError):
+            raise ValueError(_INVALID_ADDRESS.format(address))
+        if address.count('.') != 3:
+            raise ValueError(_INVALID_ADDRESS.format(address))  # inet_aton allows short forms
+        self._collector.add(address, port)
+        self._nodes.append(address)
+
+    def collect(self):
+        """
+        Pull what is new from every node at once.
+
+        Returns:
+          A dict of node (address:port) and either a dict of stream name and result or the
+          PullError that stopped the node being polled (see Collector.collect()).
+        """
+        return self._collector.collect()
+
+    def collect_status(self):
+        """
+        Report on the last collection round and each node.
+        """
+        return self._collector.status()
+
+    def close(self):
+        """
+        Close the connections to the nodes.
+        """
+        self._collector.close()
+
 # TODO: not sure this one is needed...
 class DirectorContext(context.ContextBase):
     def __init__(self, name, descr, email, nodes, duration):
@@ -16,21 +16,66 @@ consists of the following:
 # first crack: hardcode the parameters, write the streams to named files
 # the manager creates the main queue and the observers
 
-import context
-import em7_config
+from ptrial.context import core as context
+from ptrial.observer.core import split_datapoint, INTEGER_TIME, PYTHON_DATA
+from ptrial.observer.queues import Gap, drain
+from ptrial.store.query import Catalog
+from ptrial.store.rollup import RollupSet, rollup_dir, DEFAULT_RESOLUTIONS
+from ptrial.store.segment import SegmentWriter, SEGMENT_SUFFIX
+import os
+import threading
+import time
+
+# Archival strategies: when a data file is closed and a new one started
+HOURLY     = 'hourly'
+DAILY      = 'daily'
+SIZE_LIMIT = 'size'
+
+# fsync policies: when written data is forced to disk
+FSYNC_NONE   = 0  # leave it to the operating system
+FSYNC_FLUSH  = 1  # after every flush
+FSYNC_ROTATE = 2  # when a file is closed
+
+DEFAULT_SIZE_LIMIT = 64 * 2 ** 20
+DEFAULT_BUFFER_SIZE = 256 * 2 ** 10
+DEFAULT_WRITE_INTERVAL = 5
+
+# Private constants
+_INVALID_STRATEGY = 'Unknown archival strategy "{}"'
+_INVALID_TIME     = 'Observer {} datapoints need INTEGER_TIME timestamps to be stored'
+_NESTED_OBSERVER  = 'Observer {} has a row of fields per key and cannot be stored as one stream'
+_INVALID_FORMAT   = 'Observer {} must use PYTHON_DATA and INTEGER_TIME to be stored'
+_PERIOD_FORMAT = {
+    HOURLY: '%Y%m%dT%H',
+    DAILY: '%Y%m%d',
+}
 
 class NodeManager(object):
     """
     Manages observation, transformation, and storage for a single node. 
     
+    Contexts load their values on first use and keep snapshots in snapshot_dir, so starting a
+    manager does not parse static host facts again.
+
     Args:
       context: the TrialContext object for this test
+      snapshot_dir: where context snapshots are kept [default context.SNAPSHOT_DIR]; None
+                    disables them
     """
-    def __init__(self, trial_ctxt):
+    def __init__(self, trial_ctxt, snapshot_dir=context.SNAPSHOT_DIR):
         self._trial_ctxt = trial_ctxt
-        self._hw_ctxt = context.HardwareContext()
+        self._snapshot_dir = snapshot_dir
+        self._hw_ctxt = context.HardwareContext(snapshot=self._snapshot_path('hardware'))
         self._os_ctxt = context.OperatingSystemContext()
         self._init_app_context()        
+
+    def _snapshot_path(self, name):
+        """
+        Snapshot file for a context, or None if snapshots are disabled.
+        """
+        if self._snapshot_dir is None:
+            return None
+        return context.snapshot_path(name, self._snapshot_dir)
         
     def _init_app_context(self):
         """
@@ -45,6 +90,194 @@ class StoreManager(object):
     """
     pass
 
+class RotatingSegmentWriter(object):
+    """
+    Write one observer's datapoints to a series of segment files.
+
+    Datapoints are buffered in memory and written with one large write per flush.  A flush
+    happens when the buffer reaches buffer_size bytes or when flush() is called.  A new file is
+    started when the datapoint timestamps cross into a new hour or day (HOURLY, DAILY) or when
+    the file would grow past size_limit (SIZE_LIMIT).
+
+    The directory's catalog (see ptrial.store.query) is updated as each file is closed.
+
+    Files are named after the observer and the period or first timestamp they hold:
+
+      HOURLY      <name>-20150312T14.seg
+      DAILY       <name>-20150312.seg
+      SIZE_LIMIT  <name>-1426168800.seg
+
+    Args:
+      directory: where the files are written; created if needed
+      name: observer name
+      field_names: ordered sequence of field names
+      field_types: the type of each field [default all numeric]
+      strategy: HOURLY, DAILY or SIZE_LIMIT [default HOURLY]
+      size_limit: maximum file size in bytes for SIZE_LIMIT
+      fsync: FSYNC_NONE, FSYNC_FLUSH or FSYNC_ROTATE [default FSYNC_NONE]
+      buffer_size: bytes of records to collect before writing
+      meta: optional dict of extra header items for each file
+    """
+    def __init__(self, directory, name, field_names, field_types=None, strategy=HOURLY,
+                 size_limit=DEFAULT_SIZE_LIMIT, fsync=FSYNC_NONE,
+                 buffer_size=DEFAULT_BUFFER_SIZE, meta=None):
+        if strategy not in (HOURLY, DAILY, SIZE_LIMIT):
+            raise ValueError(_INVALID_STRATEGY.format(strategy))
+        self._directory = directory
+        self._name = str(name)
+        self._field_names = tuple(field_names)
+        self._field_types = field_types
+        self._strategy = strategy
+        self._size_limit = size_limit
+        self._fsync = fsync
+        self._buffer_size = buffer_size
+        self._meta = meta
+        self._pending = []   # (timestamp, period, packed record)
+        self._pending_bytes = 0
+        self._segment = None
+        self._period = None
+        self._files = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def append(self, timestamp, data):
+        """
+        Add a datapoint to the buffer, writing the buffer out if it is full.
+        """
+        period = self._period_of(timestamp)
+        if self._segment is None:
+            self._open(period, timestamp)
+        record = self._segment.pack(timestamp, data)
+        self._pending.append((timestamp, period, record))
+        self._pending_bytes += len(record)
+        if self._pending_bytes >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered datapoints, starting new files as the archival strategy requires.
+        """
+        batch = []
+        for timestamp, period, record in self._pending:
+            if self._rotate_due(period, len(batch) * len(record), len(record)):
+                self._write(batch)
+                batch = []
+                self._rotate(period, timestamp)
+            batch.append(record)
+        self._write(batch)
+        self._pending = []
+        self._pending_bytes = 0
+        if self._segment is not None:
+            self._segment.flush(self._fsync == FSYNC_FLUSH)
+
+    def close(self):
+        """
+        Write buffered datapoints and close the current file.
+        """
+        self.flush()
+        self._close_segment()
+
+    @property
+    def files(self):
+        """
+        Paths of the files written so far, oldest first.
+        """
+        return list(self._files)
+
+    def _period_of(self, timestamp):
+        if self._strategy == SIZE_LIMIT:
+            return None
+        return time.strftime(_PERIOD_FORMAT[self._strategy], time.localtime(timestamp))
+
+    def _rotate_due(self, period, unwritten, record_size):
+        """
+        True if the next record belongs in a new file.
+        """
+        if self._strategy == SIZE_LIMIT:
+            if not len(self._segment) and not unwritten:
+                return False  # always put at least one record in a file
+            return self._segment.size + unwritten + record_size > self._size_limit
+        return period != self._period
+
+    def _rotate(self, period, timestamp):
+        self._close_segment()
+        self._open(period, timestamp)
+
+    def _write(self, records):
+        if records:
+            self._segment.write(''.join(records))
+
+    def _open(self, period, timestamp):
+        """
+        Start a file for the given period, or for SIZE_LIMIT, named by its first timestamp.
+        """
+        if self._strategy == SIZE_LIMIT:
+            suffix = str(int(timestamp))
+        else:
+            suffix = period
+        path = os.path.join(self._directory, '{}-{}{}'.format(self._name, suffix, SEGMENT_SUFFIX))
+        seq = 1
+        while self._strategy == SIZE_LIMIT and os.path.exists(path):
+            path = os.path.join(self._directory,
+                                '{}-{}.{}{}'.format(self._name, suffix, seq, SEGMENT_SUFFIX))
+            seq += 1
+        self._segment = SegmentWriter(path, self._name, self._field_names, self._field_types,
+                                      self._meta)
+        self._period = period
+        if path not in self._files:
+            self._files.append(path)
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        self._segment.flush(self._fsync in (FSYNC_FLUSH, FSYNC_ROTATE))
+        self._segment.close()
+        Catalog(self._directory).update(self._segment.path)
+        self._segment = None
+
+class _ObserverStream(object):
+    """
+    The writers for one observer's raw datapoints and its rollups.
+    """
+    def __init__(self, observer, directory, meta, writer_args, resolutions):
+        self.observer = observer
+        self.writer = RotatingSegmentWriter(directory, observer.name, observer.field_names,
+                                            observer.field_types, meta=meta, **writer_args)
+        self.rollups = None
+        self.rollup_writers = {}
+        if resolutions:
+            self.rollups = RollupSet(observer.field_names, observer.field_types, resolutions)
+            # rollups are small, so one file a day is plenty
+            rollup_args = dict(writer_args, strategy=DAILY)
+            for rollup in self.rollups.rollups:
+                self.rollup_writers[rollup.resolution] = RotatingSegmentWriter(
+                    os.path.join(directory, rollup_dir(rollup.resolution)), observer.name,
+                    rollup.field_names, rollup.field_types, meta=meta, **rollup_args)
+        self.open = True
+
+    def append(self, timestamp, data):
+        self.writer.append(timestamp, data)
+        if self.rollups is not None:
+            for resolution, bucket, summary in self.rollups.add(timestamp, data):
+                self.rollup_writers[resolution].append(bucket, summary)
+
+    def flush(self):
+        self.writer.flush()
+        for writer in self.rollup_writers.itervalues():
+            writer.flush()
+
+    def close(self):
+        """
+        Write the unfinished rollup buckets and close every file.
+        """
+        if self.rollups is not None:
+            for resolution, bucket, summary in self.rollups.flush():
+                self.rollup_writers[resolution].append(bucket, summary)
+        self.writer.close()
+        for writer in self.rollup_writers.itervalues():
+            writer.close()
+        self.open = False
+
 class FileManager(StoreManager):
     """
     Arranges data storage in files and directories.  Directory hierarchy is ordered by trial,
@@ -57,7 +290,146 @@ class FileManager(StoreManager):
     harvest, etc.  Those directories contain the actual data files: metrics, harvests, etc.
     
     Data files are named according to an archival strategy: hourly, daily, size limit, etc.
+    They are binary segment files (see ptrial.store.segment).
     
     trial/node/node-name/
+
+    Observer queues are drained by a single writer thread every write_interval seconds; each
+    observer's datapoints go to a RotatingSegmentWriter in its own directory.  Observers must
+    use PYTHON_DATA and INTEGER_TIME.  If an observer's datapoints cannot be stored, its files
+    are closed and the error is kept in errors; the other observers are stored as usual.
+
+    Rollups (see ptrial.store.rollup) are computed as datapoints are written and stored in
+    subdirectories of the observer directory, one per resolution.  The query module reads them
+    the same way as raw data.
+
+    Example:
+        fm = FileManager('/data/trials', 'trial-42', '10.0.12.8', app='em7-7.3.6')
+        fm.add_observer(MemoryObserver('mem', Channel()))
+        writer = Thread(target=fm.run)
+        writer.start()
+        ...
+        fm.stop()
+        writer.join()
+
+    Args:
+      root: top of the directory tree
+      trial: trial name
+      node: node name or address
+      app: application version or function [default none]
+      write_interval: seconds between queue drains
+      strategy, size_limit, fsync, buffer_size: as for RotatingSegmentWriter
+      rollups: rollup resolutions in seconds; empty for none [default 1m, 5m, 1h]
     """
-    pass
\ No newline at end of file
+    def __init__(self, root, trial, node, app=None, write_interval=DEFAULT_WRITE_INTERVAL,
+                 strategy=HOURLY, size_limit=DEFAULT_SIZE_LIMIT, fsync=FSYNC_NONE,
+                 buffer_size=DEFAULT_BUFFER_SIZE, rollups=DEFAULT_RESOLUTIONS):
+        self._path = os.path.join(*[str(p) for p in (root, trial, node, app) if p])
+        self._meta = {'trial': str(trial), 'node': str(node)}
+        self._write_interval = write_interval
+        self._writer_args = {'strategy': strategy, 'size_limit': size_limit, 'fsync': fsync,
+                             'buffer_size': buffer_size}
+        self._rollups = rollups
+        self._streams = []
+        self._errors = {}  # observer name -> the error that stopped it being stored
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def path(self):
+        """
+        The node/app directory that observer directories are created in.
+        """
+        return self._path
+
+    def observer_path(self, name):
+        """
+        The directory for an observer's data files.
+        """
+        return os.path.join(self._path, str(name))
+
+    def add_observer(self, observer):
+        """
+        Store the datapoints that an observer puts in its queue.
+
+        Observers that report a row of fields per device or process (e.g. DiskStatsObserver)
+        cannot be stored; run one observer per device or process instead.
+
+        Returns:
+          The RotatingSegmentWriter for the observer's raw datapoints.
+
+        Raises:
+          ValueError if the observer is nested or does not use PYTHON_DATA and INTEGER_TIME.
+        """
+        if observer.nested:
+            raise ValueError(_NESTED_OBSERVER.format(observer.name))
+        if observer.data_format != PYTHON_DATA or observer.time_format != INTEGER_TIME:
+            raise ValueError(_INVALID_FORMAT.format(observer.name))
+        stream = _ObserverStream(observer, self.observer_path(observer.name), self._meta,
+                                 self._writer_args, self._rollups)
+        with self._lock:
+            self._streams.append(stream)
+        return stream.writer
+
+    def run(self):
+        """
+        Drain the observer queues every write_interval seconds until stop() is called.
+
+        Use this method as a run target for a Thread object.
+        """
+        while not self._stopped.wait(self._write_interval):
+            self.drain()
+        self.drain()
+        self.close()
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def errors(self):
+        """
+        The error that stopped each failed observer being stored, by observer name.
+        """
+        return dict(self._errors)
+
+    def drain(self):
+        """
+        Move everything in the observer queues to the writers and flush them.
+        """
+        with self._lock:
+            streams = list(self._streams)
+        for stream in streams:
+            if not stream.open:
+                continue
+            try:
+                self._drain_stream(stream)
+            except Exception as e:
+                # one observer's bad data must not stop the others being stored
+                self._errors[stream.observer.name] = e
+                try:
+                    stream.close()
+                except Exception:
+                    stream.open = False
+
+    def _drain_stream(self, stream):
+        observer = stream.observer
+        for item in drain(observer.queue):
+            if item is observer.end_data:
+                stream.close()
+                return
+            if isinstance(item, Gap):
+                continue  # datapoints the queue dropped; their times are missing from the store
+            name, timestamp, data = split_datapoint(item)
+            if not isinstance(timestamp, (int, long, float)):
+                raise ValueError(_INVALID_TIME.format(name))
+            stream.append(timestamp, data)
+        stream.flush()
+
+    def close(self):
+        """
+        Flush and close every writer.
+        """
+        with self._lock:
+            for stream in self._streams:
+                if stream.open:
+                    stream.close()
\ No newline at end of file
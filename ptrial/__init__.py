@@ -5,7 +5,9 @@ observer: API for retrieving performance and event data
 
 context: API for retrieving environment and configuration information
 
+store: API for writing observations to disk and reading them back
+
 The reason for the additional layer of packaging is so that private or
 vendor-specific modules can be separated from generic/core functions.
 """
-__all__ = ['observer', 'context']
+__all__ = ['observer', 'context', 'store']
@@ -1,56 +1,194 @@
 """
 Read-only containers for static information about the system.
+
+Context values are loaded when they are first used, one group of related keys at a time.  A
+context can also keep a snapshot file of the values it has loaded.  A snapshot is used only
+while the files the values came from are unchanged (same inode, mtime and size), so tools that
+start often do not parse the same static host facts every time.  Files under /proc have no
+useful mtime; values read from them are kept until the next boot.
+
+Snapshots are readable only by their owner, and keys a context marks as secret (e.g. database
+passwords) are never written to them.
 """
 import collections
+import json
 import os
 import socket
 
 CPU_FILE = '/proc/cpuinfo'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+SNAPSHOT_DIR = '/var/tmp/ptrial-context'
 
 HOSTNAME = 'hostname'
 KERNEL = 'kernel'
 CPU_MODEL = 'cpu_model'
 CPU_NCORES = 'cpu_ncores'
 
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_DIR_MODE = 0700
+_SNAPSHOT_MODE = 0600
+
+
+def snapshot_path(name, directory=SNAPSHOT_DIR):
+    """
+    Path of the snapshot file for a context, e.g. snapshot_path('hardware').
+    """
+    return os.path.join(directory, name + '.json')
+
 class ContextBase(collections.Mapping):
     """
     A base class that implements an immutable mapping container.
-    
+
     The interface is the same as a dictionary with the addition of attribute-style (dot) access.
+
+    Subclasses map each key to the name of a method that loads it (and any other keys that come
+    from the same source) into self._items, and list the files the values come from.  A
+    subclass that has no loaders overrides _populate() to load everything on first use.  Keys
+    listed in _secrets are left out of snapshots and loaded from their source each time.
+
+    Args:
+      snapshot: path of a snapshot file to read and keep up to date [default no snapshot]
     """
-    def __init__(self):
+    _loaders = {}  # key -> name of the method that loads it
+    _secrets = ()  # keys never written to a snapshot
+
+    def __init__(self, snapshot=None):
         self._items = {}
-        self._populate()
-        
+        self._populated = False
+        self._snapshot = snapshot
+        if snapshot:
+            self._read_snapshot()
+
     def __getattr__(self, key):
         """
-        Add dot notation as an alternative to bracketed key names. 
+        Add dot notation as an alternative to bracketed key names.
         """
-        return self._items[key]
-    
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
     def __getitem__(self, key):
-        return self._items[key]
-    
+        items = self._items
+        if key not in items:
+            self._load(key)
+        return items[key]
+
+    def __contains__(self, key):
+        if self._loaders:
+            return key in self._loaders or key in self._items
+        return key in self._all_items()
+
     def __iter__(self):
-        return iter(self._items)
-    
+        if self._loaders:
+            return iter(self._loaders)
+        return iter(self._all_items())
+
     def __len__(self):
-        return len(self._items)
-    
+        if self._loaders:
+            return len(self._loaders)
+        return len(self._all_items())
+
+    def sources(self):
+        """
+        The files that the values come from.  A snapshot is valid while they are unchanged.
+        Contexts whose values do not come from files return None and are not cached.
+        """
+        return None
+
+    def _load(self, key):
+        loader = self._loaders.get(key)
+        if loader is None:
+            if self._loaders or self._populated:
+                raise KeyError(key)
+            self._populate()
+            self._populated = True
+        else:
+            getattr(self, loader)()
+        self._write_snapshot()
+
+    def _all_items(self):
+        if not self._populated:
+            self._populate()
+            self._populated = True
+            self._write_snapshot()
+        return self._items
+
     def _populate(self):
         """
-        Populate the collection.  Must be overridden in subclasses.
+        Populate the collection.  Must be overridden in subclasses that have no loaders.
+        """
+        raise NotImplementedError
+
+    def _stamps(self):
+        stamps = {}
+        for path in self.sources():
+            if path.startswith('/proc/'):
+                stamps[path] = ['boot', _boot_id()]
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamps[path] = None
+                continue
+            stamps[path] = [st.st_ino, st.st_mtime, st.st_size]
+        return stamps
+
+    def _read_snapshot(self):
+        if self.sources() is None:
+            return
+        try:
+            with open(self._snapshot) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            return
+        if snapshot.get('version') != _SNAPSHOT_VERSION or \
+           snapshot.get('context') != type(self).__name__ or \
+           snapshot.get('stamps') != self._stamps():
+            return
+        for key, value in snapshot['items'].iteritems():
+            self._items[str(key)] = value.encode('utf-8') if isinstance(value, unicode) else value
+        self._populated = snapshot.get('populated', False)
+
+    def _write_snapshot(self):
+        """
+        Save the values loaded so far.  The snapshot is only a cache, so failure is ignored.
         """
-        raise NotImplemented
-            
+        if not self._snapshot or self.sources() is None:
+            return
+        secrets = self._secrets
+        snapshot = {
+            'version': _SNAPSHOT_VERSION,
+            'context': type(self).__name__,
+            'stamps': self._stamps(),
+            'items': dict((k, v) for k, v in self._items.iteritems() if k not in secrets),
+            'populated': self._populated and not secrets,
+        }
+        tmp = '{}.tmp.{}'.format(self._snapshot, os.getpid())
+        try:
+            directory = os.path.dirname(self._snapshot)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, _SNAPSHOT_DIR_MODE)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, _SNAPSHOT_MODE)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(tmp, self._snapshot)
+        except (IOError, OSError):
+            pass
+
 class OperatingSystemContext(ContextBase):
     """
-    General OS attributes.  
+    General OS attributes.
     """
-    def _populate(self):
-        items = self._items
-        items[HOSTNAME] = socket.gethostname()
-        items[KERNEL] = os.uname()[2]
+    _loaders = {HOSTNAME: '_hostname', KERNEL: '_kernel'}
+
+    def _hostname(self):
+        self._items[HOSTNAME] = socket.gethostname()
+
+    def _kernel(self):
+        self._items[KERNEL] = os.uname()[2]
 
 class HardwareContextError(Exception):
     """
@@ -63,35 +201,52 @@ class HardwareContext(ContextBase):
     General hardware attributes.
     """
     # techniques here are crude.  see https://git.fedorahosted.org/cgit/python-dmidecode.git
-    
-    def __init__(self, cpufile=CPU_FILE):
+    _loaders = {CPU_MODEL: '_cpu_info', CPU_NCORES: '_cpu_info'}
+
+    def __init__(self, cpufile=CPU_FILE, snapshot=None):
         """
         Allow the caller to specify test files.
         """
         self._cpu_file = cpufile
-        super(HardwareContext, self).__init__()
+        super(HardwareContext, self).__init__(snapshot)
+
+    def sources(self):
+        return [self._cpu_file]
 
-    def _populate(self):
-        self._cpu_info()
-    
     def _cpu_info(self):
         """
         Parse CPU info from /proc/cpuinfo.
-        """
-        with open(self._cpu_file) as f:
-            lines = f.readlines()
 
+        The wanted attributes are the same for every processor, so only the first processor's
+        block is read.
+        """
         wanted_attrs = {'model name': None, 'cpu cores': None}
-        for line in lines:
-            l = line.split(':')
-            for k in wanted_attrs.keys():
-                if l[0].strip() == k:
-                    wanted_attrs[k] = l[1].strip()
+        missing = len(wanted_attrs)
+        with open(self._cpu_file) as f:
+            for line in f:
+                name, sep, value = line.partition(':')
+                if not sep:
+                    if not line.strip():
+                        break  # end of the first processor
+                    continue
+                name = name.strip()
+                if name in wanted_attrs and wanted_attrs[name] is None:
+                    wanted_attrs[name] = value.strip()
+                    missing -= 1
+                    if not missing:
+                        break
         for k, v in wanted_attrs.iteritems():
             if v is None:
-                raise HardwareConfigurationError(self._err_missing_value(k))
+                raise HardwareContextError(self._err_missing_value(k))
         self._items[CPU_MODEL] = wanted_attrs['model name']
         self._items[CPU_NCORES] = int(wanted_attrs['cpu cores'])
 
     def _err_missing_value(self, key):
-            return 'value for key "{}" not found'.format(key)
\ No newline at end of file
+            return 'value for key "{}" not found'.format(key)
+
+def _boot_id():
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except IOError:
+        return None
@@ -25,35 +25,46 @@ class EM7ContextError(Exception):
     """
     pass
 
+_LOCAL_ATTRS = (IPADDR, DBDIR, DBUSER, DBPASS, TYPE)
+
 class EM7Context(ContextBase):
     """
     A mapping of select "local only" EM7 configuration attributes.
+
+    silo.conf is parsed only when one of its attributes is used, and the release file only when
+    the base version is used.  The database password is never written to a snapshot.
     """
     
     CONFIG_NOT_FOUND =  'configuration file {} not found'
+    _loaders = dict([(attr, '_silo_conf') for attr in _LOCAL_ATTRS] +
+                    [(BASE_VERSION, '_release')])
+    _secrets = (DBPASS,)
     
-    def __init__(self, config_path=SILO_CONF, rel_path=SILO_REL):
+    def __init__(self, config_path=SILO_CONF, rel_path=SILO_REL, snapshot=None):
         """
         Allow the caller to specify pathnames that are not standard.  Helps with testing.
         """
         self._config_path = config_path
         self._rel_path = rel_path
-        super(EM7Context, self).__init__()
+        super(EM7Context, self).__init__(snapshot)
+
+    def sources(self):
+        return [self._config_path, self._rel_path]
         
-    def _populate(self):
+    def _silo_conf(self):
         items = self._items
         silo = ConfigParser()
         files_read = silo.read(self._config_path)
         if not files_read:
-            raise Em7ConfigurationError(self._err_config_not_found())
+            raise EM7ContextError(self._err_config_not_found())
 
-        local_attrs = [IPADDR, DBDIR, DBUSER, DBPASS, TYPE]        
-        for attr in local_attrs:
+        for attr in _LOCAL_ATTRS:
             items[attr] = silo.get(LOCAL, attr)
-            
+
+    def _release(self):
         with open(self._rel_path) as f:
             line = f.readline()
-            items[BASE_VERSION] = line.strip()
+            self._items[BASE_VERSION] = line.strip()
 
     def _err_config_not_found(self):
         return 'configuration file {} not found'.format(self._config_path)
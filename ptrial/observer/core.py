@@ -1,15 +1,10 @@
 """
 The core module provides the fundamental interfaces for getting time-series data from a source.
 """
+from bisect import bisect_left
 from collections import OrderedDict
 import datetime
-import json
-import os.path
-from Queue import Queue
-import random
-import re
-import string
-import subprocess
+import os
 import time
 
 # Public data format constants
@@ -22,15 +17,74 @@ TIME_STRING_FORMAT  = '%Y-%m-%d %H:%M:%S'
 INTEGER_TIME = 1
 ASCII_TIME   = 2
 
+# Public field type constants
+COUNTER = 'counter'  # monotonically increasing total; wraps or resets to zero
+GAUGE   = 'gauge'    # instantaneous level
+ENUM    = 'enum'     # one of a set of named states
+
+# Public derivation constants
+DERIVE_DELTA = 1  # counters become the change since the previous datapoint
+DERIVE_RATE  = 2  # counters become the change per second since the previous datapoint
+
 # Private constants
 _INVALID_ARG      = 'Argument {} is an _INVALID type'
 _INVALID_INTERVAL = 'Loop observer interval must be >= 1 second'
 _INVALID_NAME     = 'An observer must have a name'
+_NO_FIELD_TYPES   = 'Derivation needs a type for every field'
+_NO_TIMESTAMP     = 'Datapoint has no timestamp'
 _NO_QUEUE = 'No output queue set for observer' 
+_NESTED_HISTORY = 'Observer {} has a row of fields per key; a History holds one row per datapoint'
+
+# Upper bounds (seconds) of the latency histogram buckets: 10us to 10s in 1-2.5-5 steps.  One
+# more bucket holds everything slower.
+LATENCY_BOUNDS = tuple(m * 10.0 ** e for e in range(-5, 1) for m in (1, 2.5, 5)) + (10.0,)
+
+# A tick that starts more than this share of the interval after it was due is counted as late
+_LATE_FRACTION = 0.1
+
+# Counter widths used to tell a wrapped counter from one that was reset
+_COUNTER_WIDTHS = (2 ** 32, 2 ** 64)
 
 class ObserverError(Exception):
     pass
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the time module; ask the C library for CLOCK_MONOTONIC.
+    # ctypes is loaded on the first call so that importing this module stays cheap.
+    _CLOCK_MONOTONIC = 1
+    _clock = []  # (clock_gettime, timespec type, byref, get_errno) once loaded
+
+    def _load_clock():
+        import ctypes
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # clock_gettime is in librt on old glibc and in libc itself since glibc 2.17
+        for library in ('librt.so.1', None):
+            try:
+                clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+                break
+            except (OSError, AttributeError):
+                continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+        _clock[:] = [clock_gettime, Timespec, ctypes.byref, ctypes.get_errno]
+
+    def monotonic():
+        """
+        Seconds from an arbitrary starting point.  Unaffected by changes to the system clock.
+        """
+        if not _clock:
+            _load_clock()
+        clock_gettime, timespec, byref, get_errno = _clock
+        ts = timespec()
+        if clock_gettime(_CLOCK_MONOTONIC, byref(ts)) != 0:
+            errno = get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
 class ObserverBase(object):
     """
     ObserverBase provides the basic interaction for datapoint processing.  It is not intended to
@@ -56,9 +110,14 @@ class ObserverBase(object):
       name: name of the observer
       datapoint: the most recent datapoint
       field_names: ordered sequence of field (metric) names
+      field_types: the COUNTER, GAUGE or ENUM type of each field, if the observer declares them
+      nested: True if the data holds a row of fields per device, process, etc. rather than one
+              value per field
       
     """
     
+    nested = False
+
     def __init__(self, name, time_format=INTEGER_TIME, data_format=PYTHON_DATA, time_as_key=True):
         """
         Check the name and determine the time formatting function to use.
@@ -72,6 +131,7 @@ class ObserverBase(object):
         if time_format == ASCII_TIME:
             self._time = self._ascii_time
             self._time_as_key = False
+        self._time_format = time_format
         self._data_format = data_format
         encoder = {
             JSON_DATA: self._json_data,
@@ -81,19 +141,72 @@ class ObserverBase(object):
         self._encode = encoder[data_format]
 
         # Field (metric) names and their optional string indexes must be defined in subclasses.
+        # Field types are optional; they are needed for derivation.
         self._field_names = ()
         self._field_indexes = ()
+        self._field_types = ()
+        self._deriver = None
         self._datapoint = None
+        self._data = None  # data and Unix time of the most recent datapoint, before encoding
+        self._timestamp = None
             
-    def get_datapoint(self):
+    def get_datapoint(self, timestamp=None):
         """
         Retrieve a datapoint with the correct encoding applied.
+
+        Args:
+          timestamp: Unix time to stamp on the datapoint; the default is the current time
+        """
+        self._observe(timestamp)
+        return self._encode(self._datapoint)
+
+    def _observe(self, timestamp):
+        """
+        Read the source and build the datapoint, before encoding.
         """
+        data = self._read_source()
+        if self._deriver is not None:
+            data = self._derive(data)
+        self._data = data
+        self._timestamp = timestamp if timestamp is not None else time.time()
         if self._time_as_key:
-            self._datapoint = { 'name': self.name, self._time() : self._read_source() }
+            self._datapoint = { 'name': self.name, self._time(timestamp) : data }
         else:
-            self._datapoint = {'name': self.name, 'time': self._time(), 'data': self._read_source()}
-        return self._encode(self._datapoint)
+            self._datapoint = {'name': self.name, 'time': self._time(timestamp), 'data': data}
+
+    def set_derivation(self, mode):
+        """
+        Report counters as deltas (DERIVE_DELTA) or per-second rates (DERIVE_RATE) instead of
+        raw totals.  Gauge and enum fields are unchanged.  Use None to report raw totals.
+
+        The observer must declare its field types.
+        """
+        if mode is None:
+            self._deriver = None
+        else:
+            self._deriver = Deriver(self._field_names, self._field_types, mode)
+
+    @property
+    def field_types(self):
+        """
+        The COUNTER, GAUGE or ENUM type of each field, in field_names order.  Empty if the
+        observer does not declare types.
+        """
+        return self._field_types
+
+    @property
+    def time_format(self):
+        """
+        INTEGER_TIME or ASCII_TIME.
+        """
+        return self._time_format
+
+    @property
+    def data_format(self):
+        """
+        PYTHON_DATA, JSON_DATA or CSV_DATA.
+        """
+        return self._data_format
     
     @property
     def datapoint(self):
@@ -116,6 +229,15 @@ class ObserverBase(object):
         else:
             return self._field_names
     
+    def _derive(self, data):
+        """
+        Apply the derivation stage to the data from _read_source().
+
+        Subclasses whose data holds a row of fields per device, process, etc. override this to
+        derive each row (see Deriver.derive_rows).
+        """
+        return self._deriver.derive(monotonic(), data)
+
     def _read_source(self):
         """
         Read data from the observed source.
@@ -131,11 +253,15 @@ class ObserverBase(object):
         """
         raise NotImplementedError
 
-    def _ascii_time(self):
-        return time.strftime(TIME_STRING_FORMAT)
+    def _ascii_time(self, timestamp=None):
+        if timestamp is None:
+            return time.strftime(TIME_STRING_FORMAT)
+        return time.strftime(TIME_STRING_FORMAT, time.localtime(timestamp))
     
-    def _integer_time(self):
-        return int(time.time())    
+    def _integer_time(self, timestamp=None):
+        if timestamp is None:
+            return int(time.time())
+        return int(round(timestamp))
 
     def _csv_data(self, data):
         """
@@ -152,21 +278,9 @@ class ObserverBase(object):
           data: a Python dictionary containing data items only (i.e., not a complete datapoint)
         """
         # (Because timestamp is a key (and thus constantly changes) the writers in the Python csv
-        # module aren't of much use.  
-        ts = None
-        if not self._time_as_key:
-            ts = data['time']
-        else:                    
-            # find the integer timestamp, which is a key
-            for k in data.keys():
-                if type(k) is int:
-                    ts = k
-                
-        line = str(ts)
-        for k in self._field_names:
-            metric = str(data[ts][k]) if self._time_as_key else str(data['data'][k])
-            line = line + ',' + metric
-        return line
+        # module aren't of much use.  See the encoders module for encoding batches.)
+        _, ts, values = split_datapoint(data)
+        return ','.join([str(ts)] + [str(values[k]) for k in self._field_names])
     
     def _json_data(self, data):
         """
@@ -178,6 +292,7 @@ class ObserverBase(object):
         Args:
           data: a Python dictionary
         """
+        import json
         return json.dumps(data)
     
     def _python_data(self, data):
@@ -198,6 +313,7 @@ class TestObserver(ObserverBase):
         self._field_names = ('thing1', 'thing2')
 
     def _read_source(self):
+        import random
         data = OrderedDict()
         for thing in self._field_names:
             data[thing] =  random.randint(1,999999)
@@ -206,6 +322,18 @@ class TestObserver(ObserverBase):
 class LoopObserver(ObserverBase):
     """
     Make observations at regular intervals and place data into a queue.
+
+    By default the observer sleeps for the interval after each datapoint, so the time taken to
+    read and queue the data is added to every period.  In aligned mode the deadline for each
+    datapoint is planned on a monotonic clock and falls on a wall-clock multiple of the interval
+    (e.g. every whole second, or :00/:15/:30/:45 for a 15 second interval).  Datapoints from
+    different aligned observers and nodes share timestamps.  If the loop falls a whole interval
+    or more behind, the ticks it could not make are skipped and counted as missed ticks.
+
+    Give the observer a queues.BoundedQueue to keep memory bounded when the consumer is slow;
+    lost datapoints are then marked in the queue and counted in status().  With a plain Queue
+    that has a maxsize, a datapoint that cannot be queued within one interval is counted and
+    dropped.
     
     Objects of this type should run in a thread. The caller creates the queue passes it to the
     observer during init:
@@ -219,13 +347,25 @@ class LoopObserver(ObserverBase):
           outq: output queue for datapoints [default is None]
           interval: sleep interval in seconds between datapoints; default is 1 second
           count: number of datapoints to read, default 0 (no limit); used for unit testing
+          aligned: align datapoints with wall-clock interval boundaries [default False]
     """
     def __init__(self, name, queue=None, interval=1, count=0, time_format=INTEGER_TIME, 
-                 data_format=PYTHON_DATA, time_as_key=True):
+                 data_format=PYTHON_DATA, time_as_key=True, aligned=False):
         super(LoopObserver, self).__init__(name, time_format, data_format, time_as_key)
         self._queue = queue
         self._interval = interval
         self._count = count
+        self._counting = True if count > 0 else False
+        self._aligned = aligned
+        self._missed_ticks = 0
+        self._late_ticks = 0
+        self._samples = 0
+        self._gaps = 0
+        self._read_time = Histogram()
+        self._encode_time = Histogram()
+        self._enqueue_time = Histogram()
+        self._late = Histogram()
+        self._history = None
         self._run = True
         self._start_time = datetime.datetime.now()
         self.end_data = object()  # dummy object to put in the queue to indicate EOD
@@ -240,15 +380,168 @@ class LoopObserver(ObserverBase):
         if not self._queue:
             raise ObserverError(_NO_QUEUE)
         
-        counting = True if self._count > 0 else False
-
-        while self._run and (self._count > 0 or not counting):
-            if counting:
-                self._count -= 1
-            # FIXME: caller should  set maxsize, so set timeout and handle Queue.Full (data gap)
-            self._queue.put(self.get_datapoint())
-            time.sleep(self._interval)
-        self._queue.put(self.end_data)
+        if not self._aligned:
+            while self.running:
+                self.sample()
+                time.sleep(self._interval)
+        else:
+            deadline, tick = self.first_tick(monotonic())
+            while self.running:
+                delay = deadline - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.sample(tick, -delay)
+                deadline, tick = self.next_tick(deadline, tick, monotonic())
+        self.finish()
+
+    def sample(self, timestamp=None, lateness=None, block=True):
+        """
+        Read one datapoint and place it in the queue.
+        
+        This is the body of the run() loop.  It is public so that a scheduler can drive many
+        observers from a single thread instead of giving each observer a thread of its own.
+
+        The time taken to read, encode and queue the datapoint is added to the observer's
+        latency histograms (see status()).
+
+        Args:
+          timestamp: Unix time of the tick being sampled; the default is the current time
+          lateness: seconds after its deadline that the tick is sampled, if the caller knows
+          block: wait (for at most one interval) for room in a full queue; a scheduler passes
+            False so that one full queue cannot hold up its other observers
+        """
+        if self._counting:
+            self._count -= 1
+        if lateness is not None:
+            if lateness > 0:
+                self._late.add(lateness)
+                if lateness > self._interval * _LATE_FRACTION:
+                    self._late_ticks += 1
+            else:
+                self._late.add(0.0)
+        # time.time() rather than monotonic(): it is cheaper, and a clock step spoils only the
+        # one sample it falls in
+        start = time.time()
+        self._observe(timestamp)
+        read = time.time()
+        datapoint = self._encode(self._datapoint)
+        encoded = time.time()
+        if self._history is not None:
+            self._history.append(self._timestamp, self._data)
+        try:
+            # a bounded queue applies its own overflow policy and never raises Full; a plain
+            # Queue with a maxsize blocks for at most one interval
+            self._queue.put(datapoint, block, self._interval)
+        except _queue_full():
+            self._gaps += 1
+        queued = time.time()
+        self._samples += 1
+        self._read_time.add(read - start)
+        self._encode_time.add(encoded - read)
+        self._enqueue_time.add(queued - encoded)
+
+    def first_tick(self, now):
+        """
+        Plan the first datapoint.
+
+        Args:
+          now: the monotonic() time to start at, which may be later than the current time (e.g.
+            when a scheduler delays the first datapoint)
+
+        Returns:
+          A (deadline, timestamp) tuple.  The deadline is a monotonic() time.  The timestamp is
+          the Unix time of the tick in aligned mode and None otherwise.
+        """
+        if not self._aligned:
+            return now, None
+        wall = time.time() + (now - monotonic())  # the Unix time at now
+        tick = (int(wall // self._interval) + 1) * self._interval
+        return now + (tick - wall), tick
+
+    def next_tick(self, deadline, tick, now):
+        """
+        Plan the datapoint that follows the one due at deadline.
+
+        In aligned mode a tick that is already a whole interval overdue is skipped and counted as
+        missed, so the series keeps its spacing rather than bunching up after a stall.
+
+        Args:
+          deadline: monotonic() time that the previous datapoint was due
+          tick: timestamp of the previous datapoint, as returned by first_tick()
+          now: the current monotonic() time
+
+        Returns:
+          A (deadline, timestamp) tuple as for first_tick().
+        """
+        interval = self._interval
+        if not self._aligned:
+            return max(deadline + interval, now), None
+        deadline += interval
+        tick += interval
+        if now >= deadline + interval:
+            missed = int((now - deadline) // interval)
+            self._missed_ticks += missed
+            deadline += missed * interval
+            tick += missed * interval
+        return deadline, tick
+
+    def finish(self):
+        """
+        Place the end-of-data marker in the queue.  A bounded queue takes it even when full.
+        """
+        put = getattr(self._queue, 'put_marker', self._queue.put)
+        put(self.end_data)
+
+    @property
+    def running(self):
+        """
+        True until stop() is called or the datapoint count is used up.
+        """
+        return self._run and (self._count > 0 or not self._counting)
+
+    @property
+    def interval(self):
+        """
+        Sampling interval in seconds.
+        """
+        return self._interval
+
+    @property
+    def aligned(self):
+        """
+        True if datapoints are aligned with wall-clock interval boundaries.
+        """
+        return self._aligned
+
+    @property
+    def missed_ticks(self):
+        """
+        Number of aligned ticks skipped because the observer fell behind.
+        """
+        return self._missed_ticks
+
+    @property
+    def late_ticks(self):
+        """
+        Number of ticks sampled more than a tenth of an interval after they were due.  Only
+        aligned observers and observers run by a Scheduler know when a tick was due.
+        """
+        return self._late_ticks
+
+    @property
+    def samples(self):
+        """
+        Number of datapoints taken.
+        """
+        return self._samples
+
+    @property
+    def gaps(self):
+        """
+        Number of datapoints lost because the queue was full.  For a BoundedQueue this is the
+        queue's count, which includes losses from any other observers sharing the queue.
+        """
+        return self._gaps + getattr(self._queue, 'gaps', 0)
         
     @property
     def queue(self):
@@ -264,10 +557,44 @@ class LoopObserver(ObserverBase):
     @queue.deleter
     def queue(self):
         del self._queue
+
+    @property
+    def history(self):
+        """
+        The History that keeps recent datapoints in memory, or None.
+        """
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = history
+
+    def keep_history(self, capacity, typecode='d'):
+        """
+        Keep the most recent datapoints in a History, in addition to putting them in the queue.
+
+        Observers with nested data (a row per device or process) cannot keep a History.
+
+        Args:
+          capacity: number of datapoints to keep
+          typecode: array typecode for numeric fields (see History)
+
+        Returns:
+          The new History.
+        """
+        if self.nested:
+            raise ObserverError(_NESTED_HISTORY.format(self.name))
+        from ptrial.observer.history import History
+        self._history = History(capacity, self._field_names, self._field_types, typecode)
+        return self._history
         
     def status(self):
         """
-        Report on queue size and run time.
+        Report on queue size, run time and the cost of sampling.
+
+        latency holds a histogram (see Histogram.summary()) of the seconds taken to read the
+        source, to encode the datapoint and to put it in the queue, and of how late ticks were
+        sampled.
         """
         if not self._queue:
             raise ObserverError(_NO_QUEUE)
@@ -277,6 +604,16 @@ class LoopObserver(ObserverBase):
             'interval': self._interval,
             'qsize': self._queue.qsize(),
             'uptime': str(now - self._start_time),
+            'samples': self._samples,
+            'missed_ticks': self._missed_ticks,
+            'late_ticks': self._late_ticks,
+            'gaps': self.gaps,
+            'latency': {
+                'read': self._read_time.summary(),
+                'encode': self._encode_time.summary(),
+                'enqueue': self._enqueue_time.summary(),
+                'lateness': self._late.summary(),
+            },
         }
         return state
 
@@ -294,11 +631,170 @@ class TestLoopObserver(LoopObserver):
     A loop server that generates random data for testing.
     """
     def __init__(self, name, queue, interval=1, count=0, time_format=INTEGER_TIME, 
-                 data_format=PYTHON_DATA, time_as_key=True):
+                 data_format=PYTHON_DATA, time_as_key=True, aligned=False):
         super(TestLoopObserver, self).__init__(name, queue, interval, count, time_format, 
-                                               data_format, time_as_key)
+                                               data_format, time_as_key, aligned)
         self._field_names = ('test',)
         
     def _read_source(self):
+        import random
         data = { self._field_names[0] : random.randint(1,999999) }
         return data
+
+class Histogram(object):
+    """
+    Counts of durations in fixed buckets, with their total and maximum.
+
+    Adding a duration is a binary search of the bucket bounds and a few additions, so a
+    histogram can be kept for every sample of every observer.
+
+    Args:
+      bounds: ascending upper bounds of the buckets, in seconds [default LATENCY_BOUNDS]
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is above every bound
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """
+        The upper bound of the bucket that holds the q quantile (0 < q <= 1), or the maximum
+        if that is smaller.  None if nothing has been added.
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        if i < len(self.bounds):
+            return min(self.bounds[i], self.max)
+        return self.max
+
+    def summary(self):
+        """
+        A dict of count, mean, max, p50, p99 and the nonzero buckets as [upper bound, count]
+        pairs (None for the bucket above every bound), ready for JSON.
+        """
+        bounds = self.bounds + (None,)
+        count = self.count
+        return {
+            'count': count,
+            'mean': self.total / count if count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': [[bounds[i], n] for i, n in enumerate(self.counts) if n],
+        }
+
+class Deriver(object):
+    """
+    Turn counter fields into deltas or per-second rates.
+
+    A Deriver remembers the previous value of each counter.  On the first datapoint, and on the
+    first datapoint of a new row, there is no previous value and the counter is reported as None.
+    A counter that goes backwards has either wrapped at 32 or 64 bits or been reset (the device
+    or process was restarted).  A wrap that implies a change of less than half the counter's
+    range is taken as a wrap; anything else is a reset, and the new value is the change since
+    the reset.
+
+    Args:
+      field_names: sequence of field names
+      field_types: the COUNTER, GAUGE or ENUM type of each field
+      mode: DERIVE_DELTA or DERIVE_RATE
+    """
+    def __init__(self, field_names, field_types, mode):
+        if len(field_types) != len(field_names):
+            raise ObserverError(_NO_FIELD_TYPES)
+        if mode not in (DERIVE_DELTA, DERIVE_RATE):
+            raise ObserverError(_INVALID_ARG.format(mode))
+        self._counters = frozenset(name for name, t in zip(field_names, field_types)
+                                   if t == COUNTER)
+        self._rate = mode == DERIVE_RATE
+        self._previous = {}  # row key -> (time, data)
+
+    def derive(self, now, data, key=None):
+        """
+        Derive one row of data.
+
+        Args:
+          now: monotonic() time that the data was read
+          data: dict of field names and typed values
+          key: identifies the row when the data has one row per device, process, etc.
+        """
+        last_time, last = self._previous.get(key, (None, None))
+        self._previous[key] = (now, data)
+        elapsed = now - last_time if last_time is not None else None
+        derived = OrderedDict()
+        for name, value in data.iteritems():
+            if name in self._counters:
+                if last is None or value is None or last.get(name) is None:
+                    value = None
+                else:
+                    value = _counter_delta(last[name], value)
+                    if self._rate:
+                        value = value / elapsed if elapsed > 0 else None
+            derived[name] = value
+        return derived
+
+    def derive_rows(self, now, rows):
+        """
+        Derive a dict of rows keyed by device, process, etc.  Rows that are no longer present
+        are forgotten.
+        """
+        derived = OrderedDict()
+        for key, data in rows.iteritems():
+            derived[key] = self.derive(now, data, key)
+        for key in [k for k in self._previous if k not in rows]:
+            del self._previous[key]
+        return derived
+
+def split_datapoint(datapoint):
+    """
+    Take apart a datapoint in PYTHON_DATA format.
+
+    Works with the timestamp either as a key or as the 'time' value.
+
+    Returns:
+      A (name, timestamp, data) tuple.
+    """
+    if 'data' in datapoint and 'time' in datapoint:
+        return datapoint['name'], datapoint['time'], datapoint['data']
+    for key, value in datapoint.iteritems():
+        if key != 'name':
+            return datapoint['name'], key, value
+    raise ObserverError(_NO_TIMESTAMP)
+
+def _queue_full():
+    """
+    The Queue.Full exception class.  An except clause evaluates this only when an exception is
+    raised, so the Queue module is not imported just in case.
+    """
+    from Queue import Full
+    return Full
+
+def _counter_delta(old, new):
+    """
+    The change in a counter, allowing for wraparound and resets.
+    """
+    if new >= old:
+        return new - old
+    for width in _COUNTER_WIDTHS:
+        if old < width:
+            wrapped = new + width - old
+            return wrapped if wrapped < width // 2 else new
+    return new
@@ -0,0 +1,202 @@
+"""
+The encoders module turns batches of datapoints into text ready to write to a file or socket.
+
+An encoder is compiled once for an observer's schema: the field order, the CSV line template
+and the JSON key prefixes are worked out when it is created rather than for every datapoint.
+encode() takes a whole batch of PYTHON_DATA datapoints (e.g. from Channel.drain()) and returns
+one string: a block of CSV lines, with the header written once per encoder, or NDJSON (one
+JSON object per line).
+
+Observers should use PYTHON_DATA and leave encoding to the consumer.  Encoders handle flat
+datapoints (one value per field); observers with a row of fields per device or process have
+their own CSV formatting.
+
+Example:
+    encoder = encoder_for(obs, CSV_DATA)
+    while running:
+        out.write(encoder.encode(channel.drain_wait(100, 5)))
+"""
+from operator import itemgetter
+from ptrial.observer.core import ObserverError, CSV_DATA, JSON_DATA, split_datapoint
+from ptrial.observer.queues import Gap
+
+# Private constants
+_NO_ENCODER = 'No batch encoder for data format {}'
+_NO_FIELDS  = 'Encoder for {} has no field names and no datapoint to take them from'
+_NESTED     = 'Observer {} has a row of fields per key; use its own data_format instead'
+
+
+class _Encoder(object):
+    """
+    Base class for compiled batch encoders.  The schema is compiled from field_names, or from
+    the first datapoint encoded if no field names are given.
+    """
+    def __init__(self, name, field_names=None):
+        self.name = name
+        self._field_names = ()
+        if field_names:
+            self._compile(tuple(field_names))
+
+    @property
+    def field_names(self):
+        return self._field_names
+
+    def encode(self, datapoints):
+        raise NotImplementedError
+
+    def _compile(self, field_names):
+        self._field_names = field_names
+        if len(field_names) == 1:
+            # itemgetter with one key returns a value rather than a tuple
+            getter = itemgetter(field_names[0])
+            self._values = lambda data: (getter(data),)
+        else:
+            self._values = itemgetter(*field_names)
+
+    def _compile_from(self, datapoints):
+        for datapoint in datapoints:
+            if isinstance(datapoint, dict):
+                self._compile(tuple(split_datapoint(datapoint)[2].keys()))
+                return
+        raise ObserverError(_NO_FIELDS.format(self.name))
+
+class CsvEncoder(_Encoder):
+    """
+    Encode datapoints as CSV lines: the timestamp followed by each field in field_names order.
+
+    The header line is written before the first batch.  Call reset() to write it again (e.g.
+    when starting a new file).  Gap markers are left out; the missing timestamps show the gap.
+
+    Args:
+      name: observer name, for error messages
+      field_names: ordered sequence of field names [default from the first datapoint]
+      header: write the header before the first batch [default True]
+    """
+    def __init__(self, name, field_names=None, header=True):
+        self._header_written = not header
+        super(CsvEncoder, self).__init__(name, field_names)
+
+    def _compile(self, field_names):
+        super(CsvEncoder, self)._compile(field_names)
+        self._template = ','.join(['%s'] * (len(field_names) + 1)) + '\n'
+
+    @property
+    def header(self):
+        """
+        The header line, with a trailing newline.
+        """
+        return 'timestamp,' + ','.join(self._field_names) + '\n'
+
+    def reset(self):
+        """
+        Write the header again before the next batch.
+        """
+        self._header_written = False
+
+    def encode(self, datapoints):
+        """
+        Encode a batch of datapoints.
+
+        Returns:
+          A string of CSV lines, each ending with a newline; the header comes first if it has
+          not been written yet.
+        """
+        if not self._field_names:
+            if not datapoints:
+                return ''
+            self._compile_from(datapoints)
+        template = self._template
+        values = self._values
+        lines = []
+        if not self._header_written:
+            lines.append(self.header)
+            self._header_written = True
+        for datapoint in datapoints:
+            if not isinstance(datapoint, dict):
+                continue  # gap and end-of-data markers
+            _, ts, data = split_datapoint(datapoint)
+            lines.append(template % ((ts,) + values(data)))
+        return ''.join(lines)
+
+class NdjsonEncoder(_Encoder):
+    """
+    Encode datapoints as newline-delimited JSON, one object per line:
+
+      {"name": NAME, "time": TIMESTAMP, "data": {FIELD: VALUE, ...}}
+
+    Gap markers become {"name": NAME, "gap": {"count": N, "start": T1, "end": T2}} lines.
+
+    Args:
+      name: observer name, written in every line
+      field_names: ordered sequence of field names [default from the first datapoint]
+    """
+    def _compile(self, field_names):
+        import json  # not needed for CSV
+        super(NdjsonEncoder, self)._compile(field_names)
+        self._dumps = dumps = json.JSONEncoder().encode
+        self._prefix = '{"name": %s, "time": ' % dumps(self.name)
+        # each value is preceded by its (already quoted) key
+        self._keys = tuple('%s: ' % dumps(name) for name in field_names)
+
+    def encode(self, datapoints):
+        """
+        Encode a batch of datapoints.
+
+        Returns:
+          A string of JSON lines, each ending with a newline.
+        """
+        if not self._field_names:
+            if not datapoints:
+                return ''
+            self._compile_from(datapoints)
+        prefix = self._prefix
+        keys = self._keys
+        values = self._values
+        dumps = self._dumps
+        lines = []
+        for datapoint in datapoints:
+            if isinstance(datapoint, Gap):
+                lines.append('{"name": %s, "gap": {"count": %d, "start": %s, "end": %s}}\n' % (
+                    dumps(self.name), datapoint.count, _json_value(datapoint.start, dumps),
+                    _json_value(datapoint.end, dumps)))
+                continue
+            if not isinstance(datapoint, dict):
+                continue  # end-of-data marker
+            _, ts, data = split_datapoint(datapoint)
+            items = ', '.join([k + _json_value(v, dumps) for k, v in zip(keys, values(data))])
+            lines.append('%s%s, "data": {%s}}\n' % (prefix, _json_value(ts, dumps), items))
+        return ''.join(lines)
+
+def encoder_for(observer, data_format, header=True):
+    """
+    Compile a batch encoder for an observer's schema.
+
+    Args:
+      observer: the observer whose datapoints will be encoded
+      data_format: CSV_DATA or JSON_DATA (which gives NDJSON)
+      header: for CSV, write the header before the first batch
+
+    Raises:
+      ObserverError if the observer is nested (e.g. DiskStatsObserver).
+    """
+    if observer.nested:
+        raise ObserverError(_NESTED.format(observer.name))
+    names = observer.field_names
+    if isinstance(names, basestring):
+        names = names.split(',')[1:]  # the observer's own CSV header
+    if data_format == CSV_DATA:
+        return CsvEncoder(observer.name, names, header)
+    if data_format == JSON_DATA:
+        return NdjsonEncoder(observer.name, names)
+    raise ObserverError(_NO_ENCODER.format(data_format))
+
+def _json_value(value, dumps):
+    """
+    Encode one value, taking a short cut for the common types.
+    """
+    vtype = type(value)
+    if vtype is int or vtype is long:
+        return str(value)
+    if value is None:
+        return 'null'
+    return dumps(value)
@@ -0,0 +1,246 @@
+"""
+The fetch module answers "what is new since my last poll" from an observer's in-memory History.
+
+A HistoryHandler is a WSGI application for one History.  A poller passes the cursor from its
+previous response and gets only the datapoints after it:
+
+  GET /path?since=CURSOR&fields=a,b&limit=N
+
+  200  {"name": NAME, "cursor": C, "more": false, "truncated": false,
+        "fields": ["a", "b"], "rows": [[timestamp, a, b], ...]}
+  204  nothing after the cursor; the X-Cursor header repeats it
+  304  the response would be the same as the one with the ETag in If-None-Match
+
+Without since, the whole History (up to limit) is returned.  more is true when the limit left
+datapoints out; poll again at once with the new cursor to get them.  truncated is true when the
+History has dropped datapoints after the cursor that the poller never saw.
+
+Nothing is read or encoded for a 204 or 304 response beyond a binary search of the timestamps,
+so pollers that run every second cost little when nothing has changed.
+
+A BatchHandler serves every History on a node in one response, so a collector polling many
+nodes makes one request per node rather than one per observer.  Each observer has its own
+cursor:
+
+  GET /batch?since.NAME=CURSOR&...&limit=N
+
+  200  {"node": NODE, "streams": {NAME: {"cursor": C, "more": false, "truncated": false,
+                                         "fields": [...], "rows": [...]}, ...}}
+
+Streams with nothing after their cursor are left out.  Responses are gzip-compressed for
+clients that accept it.  make_server() runs handlers on a threaded HTTP/1.1 server that keeps
+connections open between requests.
+"""
+import json
+from urlparse import parse_qs
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+from SocketServer import ThreadingMixIn
+import zlib
+
+# Public constants
+BATCH_PATH = '/batch'
+
+# Private constants
+_BAD_CURSOR = 'since must be a number'
+_BAD_LIMIT  = 'limit must be a whole number >= 1'
+_BAD_FIELD  = 'Unknown field: {}'
+_SINCE_PREFIX = 'since.'
+_GZIP_MIN = 1024  # smaller bodies are sent as they are
+_GZIP_WBITS = 16 + zlib.MAX_WBITS  # zlib writes a gzip header and trailer
+
+
+class HistoryHandler(object):
+    """
+    WSGI application that serves incremental fetches from a History.
+
+    Query parameters are taken from environ['params'] when a dispatcher (e.g. resty's
+    PathDispatcher) has parsed them, and from the query string otherwise.
+
+    Example:
+        history = obs.keep_history(3600)
+        dispatcher.register('GET', '/stats/disk/since', HistoryHandler(obs.name, history))
+
+    Args:
+      name: the observer name, returned in every response
+      history: the History to serve
+    """
+    def __init__(self, name, history):
+        self.name = name
+        self.history = history
+
+    def __call__(self, environ, start_response):
+        params = environ.get('params')
+        if params is None:
+            params = dict((k, v[-1]) for k, v in
+                          parse_qs(environ.get('QUERY_STRING', '')).iteritems())
+        try:
+            since, fields, limit = self._parse(params)
+        except ValueError as e:
+            return _respond(start_response, '400 Bad Request', str(e) + '\n')
+        history = self.history
+
+        # fast paths: nothing after the cursor, or nothing changed since the client's copy
+        last_time = history.last_time
+        if since is not None and (last_time is None or last_time <= since):
+            start_response('204 No Content', [('X-Cursor', repr(since))])
+            return []
+        etag = '"{:x}-{:x}"'.format(history.version,
+                                    zlib.crc32(environ.get('QUERY_STRING', '')) & 0xffffffff)
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', [('ETag', etag)])
+            return []
+
+        result = _history_result(history, since, fields, limit)
+        result['name'] = self.name
+        cursor = result['cursor']
+        body = json.dumps(result)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('ETag', etag),
+                                  ('X-Cursor', repr(cursor))])
+        return [body]
+
+    def _parse(self, params):
+        since = _cursor(params.get('since'))
+        fields = params.get('fields')
+        if fields:
+            fields = tuple(fields.split(','))
+            for name in fields:
+                if name not in self.history.field_names:
+                    raise ValueError(_BAD_FIELD.format(name))
+        else:
+            fields = None
+        return since, fields, _limit(params.get('limit'))
+
+class BatchHandler(object):
+    """
+    WSGI application that serves incremental fetches from several Histories in one response.
+
+    Example:
+        handler = BatchHandler('10.0.12.8')
+        handler.add(obs.name, obs.keep_history(3600))
+        make_server(('', 8080), handler).serve_forever()
+
+    Args:
+      node: the node name or address, returned in every response
+    """
+    def __init__(self, node):
+        self.node = node
+        self._histories = {}
+
+    def add(self, name, history):
+        """
+        Serve a History as the stream NAME.
+        """
+        self._histories[name] = history
+
+    def __call__(self, environ, start_response):
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            limit = _limit(query.get('limit', [None])[-1])
+            cursors = {}
+            for key, values in query.iteritems():
+                if key.startswith(_SINCE_PREFIX):
+                    cursors[key[len(_SINCE_PREFIX):]] = _cursor(values[-1])
+        except ValueError as e:
+            return _respond(start_response, '400 Bad Request', str(e) + '\n')
+        streams = {}
+        for name, history in self._histories.iteritems():
+            since = cursors.get(name)
+            last_time = history.last_time
+            if last_time is None or (since is not None and last_time <= since):
+                continue
+            streams[name] = _history_result(history, since, None, limit)
+        body = json.dumps({'node': self.node, 'streams': streams})
+        headers = [('Content-Type', 'application/json')]
+        if len(body) >= _GZIP_MIN and 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+def make_server(address, app):
+    """
+    A threaded HTTP/1.1 server for a WSGI application.  Connections are kept open between
+    requests when the response has a Content-Length, as the handlers in this module always do.
+
+    Args:
+      address: (host, port) to listen on; port 0 picks a free port (see server_address)
+    """
+    server = _ThreadingWSGIServer(address, _KeepAliveRequestHandler)
+    server.set_app(app)
+    return server
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers:
+            # the end of the body can only be shown by closing the connection
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = 1
+
+class _KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        """
+        Handle requests until the client closes the connection or asks for it to be closed.
+        """
+        while True:
+            self.raw_requestline = self.rfile.readline(65537)
+            if not self.raw_requestline or len(self.raw_requestline) > 65536:
+                return
+            if not self.parse_request():
+                return
+            handler = _KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                                              self.get_environ())
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+            if self.close_connection:
+                return
+
+    def log_message(self, format, *args):
+        pass  # one line per poll of every node is too much for stderr
+
+def _history_result(history, since, fields, limit):
+    first_time = history.first_time
+    rows, cursor, more = history.since(since, fields, limit)
+    return {
+        'cursor': cursor,
+        'more': more,
+        'truncated': (since is not None and since < first_time
+                      and history.version > len(history)),
+        'fields': list(fields or history.field_names),
+        'rows': rows,
+    }
+
+def _cursor(value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(_BAD_CURSOR)
+
+def _limit(value):
+    if not value:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(_BAD_LIMIT)
+    if limit < 1:
+        raise ValueError(_BAD_LIMIT)
+    return limit
+
+def _respond(start_response, status, body):
+    start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
@@ -0,0 +1,476 @@
+"""
+The history module keeps recent datapoints in memory in a compact form.
+
+A History holds a fixed number of datapoints as columns: one typed array per field plus one for
+timestamps.  Once it is full, each new datapoint replaces the oldest.  New datapoints go into an
+open block of plain arrays; when the block is full it is sealed, which compresses each column.
+Observer data changes slowly from one datapoint to the next, so a sealed block takes a small
+fraction of the memory of the arrays it came from.  Memory use depends on the capacity and on
+the data, not on how quickly (or whether) anyone reads it.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import izip
+from ptrial.observer.core import ObserverError, ENUM
+import threading
+import zlib
+
+# Private constants
+_INVALID_CAPACITY = 'History capacity must be >= 1'
+_TOO_MANY_STATES  = 'Enum field "{}" has more than {} states'
+_NOT_FLAT         = 'Field "{}" is not a scalar; History holds one row per datapoint'
+_MAX_STATES = 65535
+_NAN = float('nan')
+_TIME_SCALE = 1000.0  # timestamps are kept to the millisecond
+_BLOCK_SIZE = 1024    # datapoints in a block
+# unsigned typecode of each item size, for XORing a column's items with the ones before them
+_XOR_TYPECODES = dict((array(code).itemsize, code) for code in 'BHIL')
+
+
+class History(object):
+    """
+    A fixed-capacity buffer of datapoints stored as compressed columns.
+
+    Numeric fields are stored as arrays of the given typecode.  Doubles (the default) hold
+    integers exactly up to 2**53 and store None as NaN.  With an integer typecode, None is
+    stored as the largest value of an unsigned type or the smallest of a signed one.  A field
+    whose value does not fit the typecode (e.g. a float, or a byte count over 2**32 for 'I') is
+    stored as doubles from then on.  ENUM fields are stored as 16-bit codes with a table of the
+    states seen.  Timestamps are kept to the nearest millisecond.
+
+    Datapoints are kept in blocks of 1024.  Sealed blocks store each column with every item
+    XORed with the one before it, compressed with zlib, so a field that holds steady costs
+    almost nothing and timestamps at a regular interval cost next to nothing.  Reading from a
+    sealed block decompresses only the columns asked for.
+
+    The schema can be given when the History is created or taken from the first datapoint
+    appended.  Timestamps must not go backwards.
+
+    One thread (the observer's) appends while others read; appends and reads take a lock, so
+    a reader never sees a datapoint half written or a block being sealed.
+
+    Args:
+      capacity: the number of datapoints kept
+      field_names: ordered sequence of field names [default from the first datapoint]
+      field_types: the type of each field, as in ObserverBase.field_types [default all numeric]
+      typecode: array typecode for numeric fields [default 'd']
+
+    Example:
+        # a week of 1 second datapoints in a few MB
+        obs = MemoryObserver('mem', q, fields=('MemFree', 'Cached', 'Dirty'))
+        history = obs.keep_history(7 * 24 * 3600)
+        ...
+        for timestamp, data in history.range(start, end):
+            ...
+    """
+    def __init__(self, capacity, field_names=None, field_types=None, typecode='d'):
+        if capacity < 1:
+            raise ObserverError(_INVALID_CAPACITY)
+        self._capacity = capacity
+        self._block_size = min(_BLOCK_SIZE, capacity)
+        self._typecode = typecode
+        self._len = 0
+        self._version = 0  # datapoints appended since the History was created
+        self._blocks = []  # sealed _Blocks, oldest first
+        self._last_times = []  # the last timestamp in each sealed block
+        self._skip = 0  # datapoints at the start of the first sealed block that were replaced
+        self._field_names = ()
+        self._typecodes = []  # per column, the typecode of the open block's array
+        self._missing = []  # per column, the value that stands for None
+        self._times = array('d')  # the open block
+        self._columns = []
+        self._states = {}  # enum field name -> list of states; the code is the list index
+        self._cached_block = None  # the sealed block last read, and its decompressed columns
+        self._cache = {}
+        self._lock = threading.Lock()
+        if field_names:
+            self._build(field_names, field_types)
+
+    def _build(self, field_names, field_types=None):
+        if not field_types:
+            field_types = (None,) * len(field_names)
+        self._field_names = tuple(field_names)
+        for name, ftype in zip(field_names, field_types):
+            if ftype == ENUM:
+                self._typecodes.append('H')
+                self._missing.append(None)
+                self._states[name] = []
+            else:
+                self._typecodes.append(self._typecode)
+                self._missing.append(_missing(self._typecode))
+        self._columns = [array(typecode) for typecode in self._typecodes]
+
+    def append(self, timestamp, data):
+        """
+        Add a datapoint, replacing the oldest if the History is full.
+
+        Args:
+          timestamp: Unix time of the datapoint
+          data: dict of field names and values, as returned by an observer
+        """
+        with self._lock:
+            if not self._field_names:
+                self._build(tuple(data.keys()))
+            states = self._states
+            values = []
+            for name, missing in zip(self._field_names, self._missing):
+                value = data.get(name)
+                if name in states:
+                    value = self._code(name, value)
+                elif value is None:
+                    value = missing
+                elif isinstance(value, dict):
+                    raise ObserverError(_NOT_FLAT.format(name))
+                values.append(value)
+            columns = self._columns
+            for j, value in enumerate(values):
+                try:
+                    try:
+                        columns[j].append(value)
+                    except (OverflowError, TypeError):
+                        if self._typecodes[j] == 'd':
+                            raise
+                        self._widen(j).append(value)
+                except (OverflowError, TypeError):
+                    for column in columns[:j]:
+                        column.pop()
+                    raise
+            self._times.append(round(timestamp * _TIME_SCALE) / _TIME_SCALE)
+            self._len += 1
+            self._version += 1
+            if len(self._times) == self._block_size:
+                self._seal()
+            if self._len > self._capacity:
+                self._drop(self._len - self._capacity)
+
+    def range(self, start=None, end=None, fields=None):
+        """
+        Generate (timestamp, data) tuples for datapoints with start <= timestamp < end, oldest
+        first.  Either bound can be None for no limit.
+
+        The datapoints are read when the first one is asked for.
+
+        Args:
+          fields: the field names to include [default all fields]
+        """
+        with self._lock:
+            names, cols = self._select(fields)
+            first = self._bisect(start) if start is not None else 0
+            last = self._bisect(end) if end is not None else self._len
+            rows = self._rows(first, last, cols)
+        for row in rows:
+            yield row[0], OrderedDict(zip(names, row[1:]))
+
+    def since(self, cursor=None, fields=None, limit=None):
+        """
+        Get the datapoints after a cursor, oldest first, for incremental polling.  The cursor is
+        the timestamp of the last datapoint the caller has; None means from the oldest.
+
+        Args:
+          fields: the field names to include [default all fields]
+          limit: the most datapoints returned [default no limit]
+
+        Returns:
+          A (rows, cursor, more) tuple.  Each row is a list of the timestamp followed by the
+          field values.  cursor is the timestamp of the last row (the given cursor if there are
+          no rows) and more is True if there are datapoints after it that were left out because
+          of the limit.
+        """
+        with self._lock:
+            names, cols = self._select(fields)
+            first = self._bisect(cursor, after=True) if cursor is not None else 0
+            last = self._len if limit is None else min(self._len, first + limit)
+            rows = self._rows(first, last, cols)
+            more = last < self._len
+        return rows, (rows[-1][0] if rows else cursor), more
+
+    def columns(self, start=None, end=None, fields=None):
+        """
+        Get the datapoints with start <= timestamp < end as columns.
+
+        Returns:
+          A (timestamps, columns) tuple.  timestamps is an array of doubles; columns is an
+          OrderedDict of field name to array (to a list of states for ENUM fields).  Missing
+          values are stored as in the History: NaN, or the typecode's missing value.
+        """
+        with self._lock:
+            names, cols = self._select(fields)
+            first = self._bisect(start) if start is not None else 0
+            last = self._bisect(end) if end is not None else self._len
+            rows = self._rows(first, last, cols)
+            typecodes = [self._typecodes[j] for j in cols]
+            missing = [self._missing[j] for j in cols]
+        times = array('d', [row[0] for row in rows])
+        out = OrderedDict()
+        for n, (name, typecode, none) in enumerate(zip(names, typecodes, missing), 1):
+            values = [row[n] for row in rows]
+            if name in self._states:
+                out[name] = values
+            else:
+                out[name] = array(typecode, [none if v is None else v for v in values])
+        return times, out
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def field_names(self):
+        return self._field_names
+
+    @property
+    def version(self):
+        """
+        The number of datapoints ever appended.  It changes whenever the History does, so it can
+        be used to tell whether anything is new (e.g. in an HTTP ETag).
+        """
+        return self._version
+
+    @property
+    def first_time(self):
+        """
+        Timestamp of the oldest datapoint, or None if the History is empty.
+        """
+        with self._lock:
+            return self._time_at(0) if self._len else None
+
+    @property
+    def last_time(self):
+        """
+        Timestamp of the newest datapoint, or None if the History is empty.
+        """
+        with self._lock:
+            return self._time_at(self._len - 1) if self._len else None
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the stored datapoints, in bytes: the compressed blocks and the open
+        block's arrays.
+        """
+        with self._lock:
+            total = sum(block.nbytes for block in self._blocks)
+            for column in [self._times] + self._columns:
+                total += column.itemsize * len(column)
+            return total
+
+    def __len__(self):
+        return self._len
+
+    def _seal(self):
+        """
+        Compress the open block and start a new one.
+        """
+        block = _Block(self._times, self._columns, self._typecodes)
+        self._blocks.append(block)
+        self._last_times.append(self._times[-1])
+        self._times = array('d')
+        self._columns = [array(typecode) for typecode in self._typecodes]
+
+    def _drop(self, count):
+        """
+        Forget the oldest datapoints, and any sealed block that holds none of the rest.
+        """
+        self._len -= count
+        self._skip += count
+        blocks = self._blocks
+        while blocks and self._skip >= blocks[0].count:
+            self._skip -= blocks[0].count
+            del blocks[0]
+            del self._last_times[0]
+
+    def _widen(self, j):
+        """
+        Store column j as doubles from now on, starting with the open block.
+
+        Returns:
+          The new column.
+        """
+        missing = self._missing[j]
+        self._columns[j] = array('d', [_NAN if v == missing else v for v in self._columns[j]])
+        self._typecodes[j] = 'd'
+        self._missing[j] = _NAN
+        return self._columns[j]
+
+    def _segments(self, first, last):
+        """
+        Generate (segment, lo, hi) for the datapoints first to last (oldest is 0), where segment
+        is a sealed block's index or len(self._blocks) for the open block, and lo and hi are
+        indexes in that segment.
+        """
+        blocks = self._blocks
+        pos = 0
+        for k in xrange(len(blocks) + 1):
+            if k < len(blocks):
+                start = self._skip if k == 0 else 0
+                count = blocks[k].count - start
+            else:
+                start = 0
+                count = len(self._times)
+            lo, hi = max(first, pos), min(last, pos + count)
+            if lo < hi:
+                yield k, start + lo - pos, start + hi - pos
+            pos += count
+            if pos >= last:
+                return
+
+    def _segment_times(self, k):
+        if k == len(self._blocks):
+            return self._times
+        return self._decoded(k, 'times')
+
+    def _decoded(self, k, column):
+        """
+        A column (or 'times') of sealed block k, decompressed.  The last block read is cached.
+        """
+        block = self._blocks[k]
+        if self._cached_block is not block:
+            self._cached_block = block
+            self._cache = {}
+        values = self._cache.get(column)
+        if values is None:
+            if column == 'times':
+                values = block.times()
+            else:
+                values = block.column(column)
+            self._cache[column] = values
+        return values
+
+    def _rows(self, first, last, cols):
+        """
+        The datapoints first to last as [timestamp, value, ...] lists of the given columns, with
+        missing values as None and enum codes as states.
+        """
+        names = self._field_names
+        decoders = [self._states.get(names[j]) for j in cols]
+        rows = []
+        for k, lo, hi in self._segments(first, last):
+            times = self._segment_times(k)
+            if k == len(self._blocks):
+                columns = [self._columns[j] for j in cols]
+                missing = [self._missing[j] for j in cols]
+            else:
+                block = self._blocks[k]
+                columns = [self._decoded(k, j) for j in cols]
+                missing = [_missing(block.typecodes[j]) for j in cols]
+            readers = zip(columns, decoders, missing)
+            for i in xrange(lo, hi):
+                row = [times[i]]
+                for column, states, none in readers:
+                    value = column[i]
+                    if states is not None:
+                        value = states[value]
+                    elif value == none or value != value:  # the missing value, or NaN
+                        value = None
+                    row.append(value)
+                rows.append(row)
+        return rows
+
+    def _time_at(self, n):
+        for k, lo, hi in self._segments(n, n + 1):
+            return self._segment_times(k)[lo]
+
+    def _bisect(self, timestamp, after=False):
+        """
+        Number of datapoints with a timestamp before the given one (or not after it, if after is
+        True).
+        """
+        find = bisect_right if after else bisect_left
+        k = find(self._last_times, timestamp)
+        before = sum(block.count for block in self._blocks[:k]) - (self._skip if k else 0)
+        start = self._skip if k == 0 else 0
+        return before + find(self._segment_times(k), timestamp, start) - start
+
+    def _select(self, fields):
+        """
+        The field names and column indexes to read.
+        """
+        if fields is None:
+            return self._field_names, range(len(self._field_names))
+        index = dict((name, j) for j, name in enumerate(self._field_names))
+        return tuple(fields), [index[name] for name in fields]
+
+    def _code(self, name, value):
+        states = self._states[name]
+        try:
+            return states.index(value)
+        except ValueError:
+            if len(states) >= _MAX_STATES:
+                raise ObserverError(_TOO_MANY_STATES.format(name, _MAX_STATES))
+            states.append(value)
+            return len(states) - 1
+
+class _Block(object):
+    """
+    A sealed block: the timestamps and columns of up to _BLOCK_SIZE datapoints, compressed.
+
+    Timestamps are stored as the first in milliseconds and the differences after it; each
+    column as its items XORed with the ones before them.  Both are then compressed with zlib.
+    """
+    __slots__ = ('count', 'typecodes', '_first', '_times', '_columns')
+
+    def __init__(self, times, columns, typecodes):
+        self.count = len(times)
+        self.typecodes = tuple(typecodes)
+        ms = [int(round(t * _TIME_SCALE)) for t in times]
+        self._first = ms[0]
+        # doubles hold the differences exactly, on 32-bit builds too
+        self._times = zlib.compress(array('d', [b - a for a, b in izip(ms, ms[1:])]).tostring())
+        self._columns = tuple(_pack(column) for column in columns)
+
+    @property
+    def nbytes(self):
+        return len(self._times) + sum(len(column) for column in self._columns)
+
+    def times(self):
+        deltas = array('d')
+        deltas.fromstring(zlib.decompress(self._times))
+        ms = self._first
+        times = array('d', [ms / _TIME_SCALE])
+        for delta in deltas:
+            ms += int(delta)
+            times.append(ms / _TIME_SCALE)
+        return times
+
+    def column(self, j):
+        return _unpack(self._columns[j], self.typecodes[j])
+
+def _pack(column):
+    """
+    Compress an array, XORing each item with the one before it first.
+    """
+    raw = column.tostring()
+    view = _XOR_TYPECODES.get(column.itemsize)
+    if view is not None and column:
+        items = array(view, raw)
+        xored = array(view, items[:1])
+        xored.extend([b ^ a for a, b in izip(items, items[1:])])
+        raw = xored.tostring()
+    return zlib.compress(raw)
+
+def _unpack(packed, typecode):
+    """
+    Decompress an array compressed by _pack().
+    """
+    raw = zlib.decompress(packed)
+    column = array(typecode)
+    view = _XOR_TYPECODES.get(column.itemsize)
+    if view is not None:
+        items = array(view, raw)
+        for i in xrange(1, len(items)):
+            items[i] ^= items[i - 1]
+        raw = items.tostring()
+    column.fromstring(raw)
+    return column
+
+def _missing(typecode):
+    """
+    The value that stands for None in an array of the given typecode.
+    """
+    if typecode in 'fd':
+        return _NAN
+    bits = 8 * array(typecode).itemsize
+    if typecode.isupper():
+        return 2 ** bits - 1
+    return -2 ** (bits - 1)
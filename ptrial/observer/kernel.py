@@ -3,88 +3,241 @@ The observer.kernel modules gathers continuous kernel metrics.  These metrics ar
 /proc and /sys.
 """
 from collections import OrderedDict
-from ptrial.observer.core import LoopObserver, INTEGER_TIME, PYTHON_DATA
+from ptrial.observer.core import (LoopObserver, ObserverError, monotonic, INTEGER_TIME,
+                                  PYTHON_DATA, CSV_DATA, COUNTER, GAUGE, ENUM, split_datapoint)
+import errno
+import io
 import os
 import os.path
-import string
-import subprocess
+
+# Public constants
+DISKSTATS = '/proc/diskstats'
+MEMINFO   = '/proc/meminfo'
 
 # Private constants
 _INVALID_PATH     = 'No such path "{}"'
-_PATH_PART_NOT_FOUND = 'Partition for "{}" directory not found'
 _PID_NOT_FOUND    = 'Process {} not found'
+_SOURCE_GONE      = 'Source "{}" is gone'
+_FIELD_NOT_FOUND  = 'Field "{}" not found in {}'
+
+# errors that mean the process or device behind a /proc or /sys file no longer exists
+_VANISHED = frozenset([errno.ENOENT, errno.ESRCH, errno.ENODEV, errno.ENXIO])
+_READ_BUFSIZE = 4096
+_DIGITS = '0123456789'
+
+# pread into a caller-supplied buffer is Python 3.7+; elsewhere seek and readinto
+_preadv = getattr(os, 'preadv', None)
+
+# Process stats fields and their indexes in /proc/<pid>/stat (see proc(5); zero-based)
+_PROCESS_FIELDS = ('state', 'minflt', 'cminflt', 'majflt', 'cmajflt', 'utime', 'stime', 'priority',
+                   'nthreads', 'rss')
+_PROCESS_INDEXES = (2, 9, 10, 11, 12, 13, 14, 17, 19, 23)
+_PROCESS_TYPES = (ENUM, COUNTER, COUNTER, COUNTER, COUNTER, COUNTER, COUNTER, GAUGE, GAUGE, GAUGE)
+_PROCESS_CONVERTERS = tuple((i, str if t == ENUM else int)
+                            for i, t in zip(_PROCESS_INDEXES, _PROCESS_TYPES))
+_PPID_INDEX = 3
 
+# Block I/O stats fields, common to /sys/block/<dev>/stat and /proc/diskstats
+_STORAGE_FIELDS = ('rd_comp', 'rd_mrgd', 'rd_blk', 'rd_tm', 'wr_comp', 'wr_mrgd', 'wr_blk', 'wr_tm',
+                   'io_prog', 'io_tm', 'io_tmw')
+_STORAGE_TYPES = (COUNTER,) * 8 + (GAUGE, COUNTER, COUNTER)
+
+
+class SourceGoneError(ObserverError):
+    """
+    The process or device behind an observed file no longer exists.
+    """
+    pass
+
+class ProcReader(object):
+    """
+    Re-read a /proc or /sys file through a descriptor that stays open.
+
+    Opening and closing a file for every datapoint costs more than reading it.  The file is
+    opened on the first read and kept open; each read rewinds to offset 0, which makes the
+    kernel generate fresh contents, and reads into a buffer that is reused (and grown when a
+    file outgrows it).
+
+    A descriptor for /proc/<pid>/... stays bound to the process it was opened for, so a PID
+    that is reused by a new process is never mistaken for the old one.  When the process or
+    device goes away the reader closes the descriptor and raises SourceGoneError; callers do
+    not need to check os.path.exists first.
+
+    Args:
+      path: the file to read
+      bufsize: initial buffer size in bytes
+    """
+    def __init__(self, path, bufsize=_READ_BUFSIZE):
+        self.path = path
+        self._buf = bytearray(bufsize)
+        self._file = None
+
+    def read(self):
+        """
+        Return the current contents of the file as a string.
+        """
+        try:
+            if self._file is None:
+                self._file = io.FileIO(self.path, 'r')
+            nbytes = self._read_into(self._buf)
+            while nbytes == len(self._buf):
+                # the file may be longer than the buffer; grow it and read again from the start
+                self._buf = bytearray(len(self._buf) * 2)
+                nbytes = self._read_into(self._buf)
+        except (IOError, OSError) as e:
+            if e.errno not in _VANISHED:
+                raise
+            nbytes = 0
+        if not nbytes:
+            self.close()
+            raise SourceGoneError(_SOURCE_GONE.format(self.path))
+        return memoryview(self._buf)[:nbytes].tobytes()
+
+    def close(self):
+        """
+        Close the descriptor.  The next read() opens the file again.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_into(self, buf):
+        if _preadv is not None:
+            return _preadv(self._file.fileno(), [buf], 0)
+        self._file.seek(0)
+        return self._file.readinto(buf)
 
 class StorageObserver(LoopObserver):
     """
     Get the block I/O stats for a device.
+
+    Values are integers.  io_prog (I/Os in progress) is a gauge; the other fields are counters.
+
+    Args:
+      path: any path on the device's filesystem
+      derive: report counters as deltas or rates (DERIVE_DELTA or DERIVE_RATE) [default None]
     """
     # https://www.kernel.org/doc/Documentation/iostats.txt
     
     def __init__(self, name, queue, path=None, interval=1, count=0, time_format=INTEGER_TIME, 
-                 data_format=PYTHON_DATA, time_as_key=True):
+                 data_format=PYTHON_DATA, time_as_key=True, aligned=False, derive=None):
         super(StorageObserver, self).__init__(name, queue, interval, count, time_format, 
-                                              data_format, time_as_key)
+                                              data_format, time_as_key, aligned)
         if not os.path.exists(path):
             raise ObserverError(_INVALID_PATH.format(path))
         self._path = path
         self._block_device = self._find_block_device()
         self._device_stats = self._find_stat_path()
-        self._field_names = ('rd_comp', 'rd_mrgd', 'rd_blk', 'rd_tm', 'wr_comp', 'wr_mrgd', 
-                             'wr_blk', 'wr_tm', 'io_prog', 'io_tm', 'io_tmw')        
+        self._reader = ProcReader(self._device_stats)
+        self._field_names = _STORAGE_FIELDS
+        self._field_types = _STORAGE_TYPES
+        self.set_derivation(derive)
 
     def _find_block_device(self):
         """
         Get the block device associated with a path (directory).  Any path can be provided; it does
         not have to be the the top-level directory at which a block device is mounted.
         """
-        # build a dict of mountpoints (directory) and device names
-        # 'mount' output looks like this:
-        #     /dev/vda9 on /data.local type xfs (rw,noatime)
-        mountpoint = {}
-        mounts = subprocess.check_output(['mount']).split('\n')
-        for mount in mounts:
-            fields = mount.split()
-            if not fields:
-                continue
-            mountpoint[fields[2]] = fields[0]
-
-        # search all mountpoints for the path, recursing backward through the path name if necessary
-        path = self._path
-        previous = ''
-        while path != previous:
-            if path in mountpoint.keys():
-                # we have the partition; get the real device file if it's a symlink
-                try:
-                    realdev = os.readlink(mountpoint[path])
-                    blockdev = os.path.basename(realdev)
-                except OSError:
-                    # it's not a symlink
-                    blockdev = os.path.basename(mountpoint[path])
-                return blockdev
-            # go back one level in the path
-            previous = path
-            path = os.path.dirname(path)
-        raise ObserverError(_PATH_PART_NOT_FOUND.format(self._path))
-    
+        from ptrial.observer.mounts import mount_table  # only storage observers need it
+        return mount_table().device(self._path)
+
     def _find_stat_path(self):
         """
         Find the path to the device stats in sysfs
         """
-        # Block device trees vary a little.  If the newer path doesn't work, try the older
-        # one (2.6.18 era).  If that doesn't work, open() will raise IOError.
+        # /sys/dev/block/<major>:<minor> finds partitions and device-mapper devices alike.  If it
+        # is missing, try the newer /sys/block path, then the older one (2.6.18 era).  If that
+        # doesn't work, open() will raise IOError.
+        from ptrial.observer.mounts import mount_table
+        table = mount_table()
+        stat_path = os.path.join(table.sysfs_path(table.find(self._path)), 'stat')
+        if os.path.exists(stat_path):
+            return stat_path
         stat_path = '/sys/block/{}/stat'.format(self._block_device)
         if not os.path.exists(stat_path):
-            stat_path = '/sys/block/{}/{}/stat'.format(self._block_device.rstrip(string.digits),
+            stat_path = '/sys/block/{}/{}/stat'.format(self._block_device.rstrip(_DIGITS),
                                                        self._block_device)
         return stat_path
   
     def _read_source(self):
-        with open(self._device_stats) as f:
-            statline = f.readline().strip()
-        data = OrderedDict(zip(self._field_names, statline.split()))
+        statline = self._reader.read()
+        data = OrderedDict(zip(self._field_names, [int(v) for v in statline.split()]))
         return data
 
+class DiskStatsObserver(LoopObserver):
+    """
+    Get the block I/O stats for a set of devices from a single read of /proc/diskstats.
+
+    The returned data is a dict of device name to a dict of the same fields as StorageObserver.
+    With derivation, each device's counters are derived separately.
+    Devices are kernel names as they appear in /proc/diskstats (sda, sda1, nvme0n1, dm-0).  A
+    device that is not present is left out of the data rather than raising an error, since
+    devices come and go.
+
+    CSV data is one line per device: the timestamp, the device name, then the fields.
+
+    Args:
+      devices: a device name or iterable of device names; None (the default) or 'all' for
+        every device
+      source: path of the diskstats file [default /proc/diskstats]
+      derive: report counters as deltas or rates (DERIVE_DELTA or DERIVE_RATE) [default None]
+    """
+    # The cost of a datapoint is one open and read no matter how many devices are watched.
+    # Newer kernels append discard and flush fields; only the original 11 are used.
+    nested = True
+
+    def __init__(self, name, queue, devices=None, interval=1, count=0, time_format=INTEGER_TIME,
+                 data_format=PYTHON_DATA, time_as_key=True, aligned=False, source=DISKSTATS,
+                 derive=None):
+        super(DiskStatsObserver, self).__init__(name, queue, interval, count, time_format,
+                                                data_format, time_as_key, aligned)
+        if devices is None or devices == 'all':
+            self._devices = None
+        elif isinstance(devices, basestring):
+            self._devices = frozenset((devices,))
+        else:
+            self._devices = frozenset(devices)
+        self._reader = ProcReader(source)
+        self._field_names = _STORAGE_FIELDS
+        self._field_types = _STORAGE_TYPES
+        self.set_derivation(derive)
+
+    @property
+    def field_names(self):
+        """
+        As for ObserverBase, but the CSV header includes the device column.
+        """
+        if self._data_format is CSV_DATA:
+            return 'timestamp,device,' + ','.join(self._field_names)
+        return self._field_names
+
+    def _read_source(self):
+        lines = self._reader.read().splitlines()
+        devices = self._devices
+        nfields = len(self._field_names)
+        data = OrderedDict()
+        for line in lines:
+            # major, minor, name, stats...
+            parts = line.split(None, 3)
+            if len(parts) < 4 or (devices is not None and parts[2] not in devices):
+                continue
+            data[parts[2]] = OrderedDict(zip(self._field_names,
+                                             [int(v) for v in parts[3].split()[:nfields]]))
+        return data
+
+    def _derive(self, data):
+        return self._deriver.derive_rows(monotonic(), data)
+
+    def _csv_data(self, data):
+        """
+        One CSV line per device.
+        """
+        _, ts, rows = split_datapoint(data)
+        lines = []
+        for device, row in rows.iteritems():
+            lines.append(','.join([str(ts), device] + [str(row[k]) for k in self._field_names]))
+        return '\n'.join(lines)
+
 class ProcessObserver(LoopObserver):
     """
     Get stats for a process/task.
@@ -129,6 +282,10 @@ class ProcessObserver(LoopObserver):
     
     Items like start time and name are not returned because they never change.  The caller
     can get those bits of static info from utility functions.
+
+    state is a string; the other values are integers.  minflt through stime are counters and
+    priority, nthreads and rss are gauges.  With derivation (DERIVE_DELTA or DERIVE_RATE passed
+    as derive), counters are reported as deltas or per-second rates.
     
     See http://man7.org/linux/man-pages/man5/proc.5.html for complete details.
     """
@@ -137,45 +294,283 @@ class ProcessObserver(LoopObserver):
     # proc(5) man page.  Remember zero-based: subtract 1 to match indexes shown in man page.
     
     def __init__(self, name, queue, pid=None, interval=1, count=0, time_format=INTEGER_TIME, 
-                 data_format=PYTHON_DATA, time_as_key=True):
+                 data_format=PYTHON_DATA, time_as_key=True, aligned=False, derive=None):
         super(ProcessObserver, self).__init__(name, queue, interval, count, time_format, 
-                                              data_format, time_as_key)
-        self._field_names = ('state', 'minflt', 'cminflt', 'majflt', 'cmajflt', 'utime', 'stime',
-                             'priority', 'nthreads', 'rss')
-        self._field_indexes = (2, 9, 10, 11, 12, 13, 14, 17, 19, 23)
+                                              data_format, time_as_key, aligned)
+        self._field_names = _PROCESS_FIELDS
+        self._field_indexes = _PROCESS_INDEXES
+        self._field_types = _PROCESS_TYPES
+        self.set_derivation(derive)
         self._pid = pid
+        self._reader = ProcReader('/proc/{}/stat'.format(pid))
         
     def _read_source(self):
-        statpath = '/proc/{}/stat'.format(self._pid)
-        if not os.path.exists(statpath):
-            raise ObserverError(_PID_NOT_FOUND.format(self._pid))
-        
-        with open(statpath) as f:
-            statline = f.readline().strip()
-        stat_list =  statline.split()
+        try:
+            statline = self._reader.read()
+        except SourceGoneError:
+            raise SourceGoneError(_PID_NOT_FOUND.format(self._pid))
+        stat_list = _split_stat(statline)
         stats = []
-        for i in self._field_indexes:
-            stats.append(stat_list[i])
+        for i, convert in _PROCESS_CONVERTERS:
+            stats.append(convert(stat_list[i]))
         data = OrderedDict(zip(self._field_names, stats))
         return data
 
+class _ProcEntry(object):
+    """
+    What the process table remembers about a PID between datapoints.
+    """
+    __slots__ = ('pid', 'comm', 'ppid', 'included', 'persistent', 'reader')
+
+    def __init__(self, pid, comm, ppid, reader):
+        self.pid = pid
+        self.comm = comm
+        self.ppid = ppid
+        self.included = False
+        self.persistent = False
+        self.reader = reader
+
+class ProcessTableObserver(LoopObserver):
+    """
+    Get stats for every process on the system, or for those that match a filter.
+
+    /proc is scanned once per datapoint.  The returned data is a dict containing:
+
+      processes  a dict of PID to the same fields that ProcessObserver returns
+      started    a dict of PID to {'comm': command name, 'ppid': parent PID} for each process
+                 first seen in this datapoint (on the first datapoint, every process)
+      exited     a list of PIDs that have gone away since the previous datapoint
+
+    A process that exits is reported as an event, not raised as an error.
+
+    Filters are applied when a process is first seen and the result is remembered, so a process
+    that doesn't match costs nothing on later datapoints beyond the directory scan.  When more
+    than one filter is given a process must match all of them.
+
+    CSV data is one line per process: the timestamp, the PID, then the fields.  Events are not
+    included in CSV data.
+
+    Args:
+      names: iterable of command names (as in /proc/<pid>/comm) to include
+      uid: include only processes owned by this user ID
+      ppid: include only this process and its descendants
+      max_open: number of stat files to keep open between datapoints; processes beyond this
+                limit have their stat file opened for each read
+      derive: report counters as deltas or rates (DERIVE_DELTA or DERIVE_RATE) [default None]
+    """
+    # The process tree filter uses the parent PID at the time a process is first seen.  A
+    # process that is reparented after that keeps its place in (or out of) the tree.
+    nested = True
+
+    def __init__(self, name, queue, names=None, uid=None, ppid=None, interval=1, count=0,
+                 time_format=INTEGER_TIME, data_format=PYTHON_DATA, time_as_key=True,
+                 aligned=False, max_open=512, derive=None):
+        super(ProcessTableObserver, self).__init__(name, queue, interval, count, time_format,
+                                                   data_format, time_as_key, aligned)
+        self._field_names = _PROCESS_FIELDS
+        self._field_indexes = _PROCESS_INDEXES
+        self._field_types = _PROCESS_TYPES
+        self.set_derivation(derive)
+        self._names = frozenset(names) if names is not None else None
+        self._uid = uid
+        self._root = ppid
+        self._max_open = max_open
+        self._nopen = 0
+        self._known = {}  # PID directory name -> _ProcEntry
+
+    @property
+    def field_names(self):
+        """
+        As for ObserverBase, but the CSV header includes the PID column.
+        """
+        if self._data_format is CSV_DATA:
+            return 'timestamp,pid,' + ','.join(self._field_names)
+        return self._field_names
+
+    def _read_source(self):
+        known = self._known
+        pids = set(p for p in os.listdir('/proc') if p.isdigit())
+
+        exited = []
+        for p in set(known).difference(pids):
+            entry = known.pop(p)
+            if entry.included:
+                exited.append(entry.pid)
+                self._forget(entry)
+
+        started = OrderedDict()
+        new = [p for p in pids if p not in known]
+        if new:
+            self._examine(new, started)
+
+        processes = OrderedDict()
+        vanished = []
+        for p, entry in known.iteritems():
+            if not entry.included:
+                continue
+            try:
+                processes[entry.pid] = self._read_entry(entry)
+            except SourceGoneError:
+                # exited since the scan; its PID may already belong to a new process
+                exited.append(entry.pid)
+                self._forget(entry)
+                vanished.append(p)
+        for p in vanished:
+            del known[p]
+
+        data = OrderedDict()
+        data['processes'] = processes
+        data['started'] = started
+        data['exited'] = sorted(exited)
+        return data
+
+    def _examine(self, new, started):
+        """
+        Read the static details of newly seen processes and decide whether they are included.
+        """
+        known = self._known
+        examined = []
+        for p in new:
+            reader = ProcReader('/proc/{}/stat'.format(p), bufsize=1024)
+            try:
+                fields = _split_stat(reader.read())
+            except SourceGoneError:
+                continue  # came and went between the scan and the read
+            entry = _ProcEntry(int(p), fields[1], int(fields[_PPID_INDEX]), reader)
+            known[p] = entry
+            examined.append(entry)
+
+        for entry in sorted(examined, key=lambda e: e.pid):
+            entry.included = self._matches(entry)
+            if entry.included:
+                started[entry.pid] = {'comm': entry.comm, 'ppid': entry.ppid}
+                if self._nopen < self._max_open:
+                    entry.persistent = True
+                    self._nopen += 1
+                else:
+                    entry.reader.close()  # reopened for each read
+            else:
+                entry.reader.close()
+                entry.reader = None
+
+    def _matches(self, entry):
+        if self._names is not None and entry.comm not in self._names:
+            return False
+        if self._uid is not None:
+            try:
+                if os.stat('/proc/{}'.format(entry.pid)).st_uid != self._uid:
+                    return False
+            except OSError:
+                return False
+        if self._root is not None:
+            return self._in_tree(entry)
+        return True
+
+    def _in_tree(self, entry):
+        """
+        Walk up the parents of a process until the root of the filter tree is found.
+        """
+        known = self._known
+        seen = set()
+        while entry is not None and entry.pid not in seen:
+            if entry.pid == self._root:
+                return True
+            seen.add(entry.pid)
+            entry = known.get(str(entry.ppid))
+        return False
+
+    def _read_entry(self, entry):
+        stat_list = _split_stat(entry.reader.read())
+        if not entry.persistent:
+            entry.reader.close()
+        return OrderedDict(zip(self._field_names,
+                               [convert(stat_list[i]) for i, convert in _PROCESS_CONVERTERS]))
+
+    def _derive(self, data):
+        data['processes'] = self._deriver.derive_rows(monotonic(), data['processes'])
+        return data
+
+    def _forget(self, entry):
+        entry.reader.close()
+        if entry.persistent:
+            self._nopen -= 1
+
+    def _csv_data(self, data):
+        """
+        One CSV line per process.
+        """
+        _, ts, data = split_datapoint(data)
+        rows = data['processes']
+        lines = []
+        for pid, row in rows.iteritems():
+            lines.append(','.join([str(ts), str(pid)] + [str(row[k]) for k in self._field_names]))
+        return '\n'.join(lines)
+
 class MemoryObserver(LoopObserver):
     """
     Get system physical memory info.
+
+    Field names are the labels in /proc/meminfo (MemTotal, MemFree, Cached, ...).  Values are
+    integers; sizes are converted from kB to bytes.  By default every field is returned.
     
     See https://www.centos.org/docs/5/html/5.2/Deployment_Guide/s2-proc-meminfo.html
+
+    Args:
+      fields: iterable of the field names to return, in order [default all fields]
+      source: path of the meminfo file [default /proc/meminfo]
     """
+    # The layout of /proc/meminfo is fixed for the life of the kernel, so it is worked out
+    # once: the position of each wanted value in the whitespace-split file and its unit.  Each
+    # datapoint is then a split and an index per field.  The layout is worked out again if the
+    # number of tokens changes.
     
+    def __init__(self, name, queue=None, interval=1, count=0, time_format=INTEGER_TIME,
+                 data_format=PYTHON_DATA, time_as_key=True, aligned=False, fields=None,
+                 source=MEMINFO):
+        super(MemoryObserver, self).__init__(name, queue, interval, count, time_format,
+                                             data_format, time_as_key, aligned)
+        self._reader = ProcReader(source)
+        self._wanted = tuple(fields) if fields is not None else None
+        self._ntokens = None
+        self._positions = ()  # (token index, multiplier) for each field
+        self._build_schema(self._reader.read().split())
+
     def _read_source(self):
-        # /proc/meminfo is formatted with labeled values, so just compress and parse
-        # into a dictionary.  Field names are provided by the output itself.
-        with open('/proc/meminfo','rb') as f:
-            raw_meminfo = f.read()
-        data = OrderedDict()
-        for item in raw_meminfo.replace(' ', '').replace('kB','').split('\n'):
-            if ':' not in item:
-                continue
-            key, val = item.split(':')
-            data[key] = val
-        self._field_names = tuple(data.keys())
-        return data
\ No newline at end of file
+        tokens = self._reader.read().split()
+        if len(tokens) != self._ntokens:
+            self._build_schema(tokens)
+        return OrderedDict(zip(self._field_names,
+                               [int(tokens[i]) * scale for i, scale in self._positions]))
+
+    def _build_schema(self, tokens):
+        """
+        Find the token index and unit multiplier of each wanted field.
+        """
+        # each line is "Label:  value [kB]"
+        layout = OrderedDict()
+        i = 0
+        while i + 1 < len(tokens):
+            key = tokens[i].rstrip(':')
+            if i + 2 < len(tokens) and tokens[i + 2] == 'kB':
+                layout[key] = (i + 1, 1024)
+                i += 3
+            else:
+                layout[key] = (i + 1, 1)
+                i += 2
+        names = self._wanted if self._wanted is not None else tuple(layout.keys())
+        for key in names:
+            if key not in layout:
+                raise ObserverError(_FIELD_NOT_FOUND.format(key, self._reader.path))
+        self._field_names = names
+        self._field_types = (GAUGE,) * len(names)
+        self._positions = tuple(layout[key] for key in names)
+        self._ntokens = len(tokens)
+
+def _split_stat(statline):
+    """
+    Split a /proc/<pid>/stat line into fields.  The command name is in parentheses and may
+    itself contain spaces and parentheses, so it is taken as one field.
+    """
+    start = statline.index('(')
+    end = statline.rindex(')')
+    return [statline[:start].strip(), statline[start + 1:end]] + statline[end + 1:].split()
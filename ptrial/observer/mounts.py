@@ -0,0 +1,162 @@
+"""
+The mounts module keeps an index of the mount table for finding the filesystem and block device
+that a path is on.
+
+A MountTable is built from /proc/self/mountinfo, which (unlike the output of mount) has the
+device numbers of each filesystem, escapes spaces in mount points and shows bind mounts and
+device-mapper (LVM) devices as they really are.  The table is parsed again only when the
+kernel reports that the mount table has changed: it marks /proc/self/mounts with POLLPRI after
+every mount and unmount.
+
+Observers share one table through mount_table(), so finding the devices for any number of
+observers costs one parse of mountinfo.
+"""
+from collections import namedtuple
+import os
+import threading
+from ptrial.observer.core import ObserverError
+
+# Public constants
+MOUNTINFO = '/proc/self/mountinfo'
+MOUNTS    = '/proc/self/mounts'
+SYSFS     = '/sys'
+
+# Private constants
+_NOT_MOUNTED  = 'No mounted filesystem found for "{}"'
+_NO_DEVICE    = 'Filesystem at "{}" ({} on {}) is not on a block device'
+_shared = []
+_shared_lock = threading.Lock()
+
+
+MountEntry = namedtuple('MountEntry', ('mount_id', 'parent_id', 'major', 'minor', 'root',
+                                       'mount_point', 'options', 'fstype', 'source'))
+
+class MountTable(object):
+    """
+    An index of mount points, refreshed when the mount table changes.
+
+    Args:
+      mountinfo: the mountinfo file to parse
+      watch: a file that the kernel marks with POLLPRI when the mount table changes; None
+             parses mountinfo on every refresh()
+      sysfs: where sysfs is mounted
+    """
+    def __init__(self, mountinfo=MOUNTINFO, watch=MOUNTS, sysfs=SYSFS):
+        self._mountinfo = mountinfo
+        self._sysfs = sysfs
+        self._poll = None
+        self._watch = None
+        if watch is not None:
+            import select
+            if hasattr(select, 'poll'):
+                self._watch = open(watch)
+                self._poll = select.poll()
+                self._poll.register(self._watch, select.POLLPRI | select.POLLERR)
+        self._mounts = {}
+        self._parse()
+
+    def refresh(self):
+        """
+        Parse mountinfo again if the mount table has changed.
+
+        Returns:
+          True if the table was parsed again.
+        """
+        if self._poll is not None and not self._poll.poll(0):
+            return False
+        self._parse()
+        return True
+
+    def find(self, path):
+        """
+        The MountEntry of the filesystem that a path is on: the mount point that is the longest
+        prefix of the path, after symbolic links are resolved.
+        """
+        self.refresh()
+        mounts = self._mounts
+        current = os.path.realpath(path)
+        previous = None
+        while current != previous:
+            entry = mounts.get(current)
+            if entry is not None:
+                return entry
+            previous = current
+            current = os.path.dirname(current)
+        raise ObserverError(_NOT_MOUNTED.format(path))
+
+    def device(self, path):
+        """
+        The kernel name of the block device (e.g. sda1, dm-3, nvme0n1p2) that a path is on.
+        """
+        entry = self.find(path)
+        link = self.sysfs_path(entry)
+        if os.path.exists(link):
+            return os.path.basename(os.path.realpath(link))
+        if entry.source.startswith('/dev/'):
+            return os.path.basename(os.path.realpath(entry.source))
+        raise ObserverError(_NO_DEVICE.format(path, entry.fstype, entry.mount_point))
+
+    def sysfs_path(self, entry):
+        """
+        The sysfs directory of a filesystem's device, /sys/dev/block/<major>:<minor>.  It holds
+        the device's stat file whether it is a whole disk or a partition.
+        """
+        return os.path.join(self._sysfs, 'dev', 'block',
+                            '{}:{}'.format(entry.major, entry.minor))
+
+    def entries(self):
+        """
+        The visible mounts, ordered by mount point.
+        """
+        self.refresh()
+        return [self._mounts[k] for k in sorted(self._mounts)]
+
+    def close(self):
+        if self._watch is not None:
+            self._poll.unregister(self._watch)
+            self._watch.close()
+            self._watch = self._poll = None
+
+    def _parse(self):
+        mounts = {}
+        with open(self._mountinfo) as f:
+            for line in f:
+                entry = _parse_line(line)
+                if entry is not None:
+                    mounts[entry.mount_point] = entry  # later mounts hide earlier ones
+        self._mounts = mounts  # replaced whole, so readers never see a partial table
+
+def mount_table():
+    """
+    The MountTable shared by every observer in the process.
+    """
+    with _shared_lock:
+        if not _shared:
+            _shared.append(MountTable())
+        return _shared[0]
+
+def _parse_line(line):
+    """
+    Parse one line of mountinfo (see proc(5)):
+
+      36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+
+    There may be any number of optional fields before the '-' separator.
+    """
+    fields = line.split()
+    try:
+        sep = fields.index('-', 6)
+        major, minor = fields[2].split(':')
+        return MountEntry(int(fields[0]), int(fields[1]), int(major), int(minor),
+                          _unescape(fields[3]), _unescape(fields[4]), fields[5],
+                          fields[sep + 1], _unescape(fields[sep + 2]))
+    except (ValueError, IndexError):
+        return None
+
+def _unescape(field):
+    """
+    Undo the octal escapes that mountinfo uses for space, tab, newline and backslash.
+    """
+    if '\\' not in field:
+        return field
+    return field.decode('string_escape')
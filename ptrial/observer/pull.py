@@ -0,0 +1,265 @@
+"""
+The pull module collects observer data from many nodes at once.
+
+Each node runs a BatchHandler (see ptrial.observer.fetch) for its observers' Histories.  A
+NodeClient polls one node: it keeps the cursor of every stream on the node, so each poll gets
+only what is new, and keeps its HTTP connections open between polls.  A Collector polls all of
+its nodes concurrently from a fixed number of worker threads, so a round over 200 nodes takes
+about as long as the slowest node rather than the sum of all of them, and no more than
+max_in_flight requests are ever outstanding.
+
+Example:
+    collector = Collector(max_in_flight=32)
+    for address in addresses:
+        collector.add(address, 8080)
+    while trial_running:
+        for node, streams in collector.collect().iteritems():
+            if isinstance(streams, PullError):
+                ...
+            for name, result in streams.iteritems():
+                store(node, name, result['fields'], result['rows'])
+        time.sleep(60)
+"""
+from collections import deque
+import httplib
+import json
+import socket
+import threading
+import time
+from urllib import urlencode
+import zlib
+from ptrial.observer.fetch import BATCH_PATH
+
+# Public constants
+DEFAULT_TIMEOUT = 10        # seconds to wait for a node to connect or answer
+DEFAULT_IN_FLIGHT = 32      # most requests outstanding at once across all nodes
+DEFAULT_CONNECTIONS = 2     # most idle connections kept per node
+
+# Private constants
+_BAD_STATUS = 'Node {} answered {} {}'
+_BAD_RESPONSE = 'Node {} sent a response that could not be decoded: {}'
+_UNREACHABLE = 'Node {} could not be reached: {}'
+_DUPLICATE_NODE = 'Node {} was already added'
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class PullError(Exception):
+    """
+    A node could not be polled.
+    """
+    pass
+
+class NodeClient(object):
+    """
+    Poll one node's BatchHandler for the datapoints after each stream's cursor.
+
+    Connections are kept open and reused.  A connection that the node has closed while idle is
+    replaced and the request sent again once.
+
+    Args:
+      host: node address
+      port: port the node's BatchHandler is served on
+      timeout: seconds to wait for the node to connect or answer
+      limit: most datapoints per stream in one response [default no limit]
+      connections: most idle connections kept open
+      path: path of the node's BatchHandler
+    """
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT, limit=None,
+                 connections=DEFAULT_CONNECTIONS, path=BATCH_PATH):
+        self.host = host
+        self.port = port
+        self.cursors = {}  # stream name -> cursor of the last datapoint received
+        self._timeout = timeout
+        self._limit = limit
+        self._max_idle = connections
+        self._path = path
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'bytes': 0, 'reconnects': 0,
+                       'last_latency': None}
+
+    @property
+    def name(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def pull(self):
+        """
+        Get everything new since the last pull and move the cursors past it.
+
+        Returns:
+          A dict of stream name and result, where a result is a dict with the stream's fields,
+          rows ([timestamp, value, ...] lists), cursor and the more and truncated flags (see
+          ptrial.observer.fetch).  Streams with nothing new are left out.
+
+        Raises:
+          PullError if the node cannot be reached or its answer is not understood.
+        """
+        start = time.time()
+        try:
+            body = self._request(self._target())
+            try:
+                streams = json.loads(body)['streams']
+                cursors = dict((name, result['cursor']) for name, result in streams.iteritems())
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise PullError(_BAD_RESPONSE.format(self.name, e))
+        except PullError:
+            self._stats['errors'] += 1
+            raise
+        self.cursors.update(cursors)
+        self._stats['last_latency'] = time.time() - start
+        return streams
+
+    def status(self):
+        """
+        Report on the requests made to the node.
+        """
+        status = dict(self._stats)
+        status['idle_connections'] = len(self._idle)
+        return status
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    def _target(self):
+        query = [('since.' + name, repr(cursor)) for name, cursor in self.cursors.iteritems()]
+        if self._limit:
+            query.append(('limit', self._limit))
+        if not query:
+            return self._path
+        return '{}?{}'.format(self._path, urlencode(query))
+
+    def _request(self, target):
+        conn, reused = self._acquire()
+        try:
+            try:
+                response = self._send(conn, target)
+            except (httplib.BadStatusLine, socket.error):
+                if not reused:
+                    raise
+                # the node closed the idle connection; try once more on a new one
+                conn.close()
+                self._stats['reconnects'] += 1
+                response = self._send(conn, target)
+            body = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise PullError(_UNREACHABLE.format(self.name, e))
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        self._stats['requests'] += 1
+        self._stats['bytes'] += len(body)
+        if response.status != httplib.OK:
+            raise PullError(_BAD_STATUS.format(self.name, response.status, response.reason))
+        if response.getheader('Content-Encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, _GZIP_WBITS)
+            except zlib.error as e:
+                raise PullError(_BAD_RESPONSE.format(self.name, e))
+        return body
+
+    def _send(self, conn, target):
+        conn.request('GET', target, headers={'Accept-Encoding': 'gzip'})
+        return conn.getresponse()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return httplib.HTTPConnection(self.host, self.port, timeout=self._timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+class Collector(object):
+    """
+    Poll many nodes concurrently.
+
+    Args:
+      max_in_flight: most requests outstanding at once
+      timeout, limit: as for NodeClient
+    """
+    def __init__(self, max_in_flight=DEFAULT_IN_FLIGHT, timeout=DEFAULT_TIMEOUT, limit=None):
+        self._max_in_flight = max(1, max_in_flight)
+        self._timeout = timeout
+        self._limit = limit
+        self._clients = []
+        self._round_time = None
+
+    def add(self, host, port):
+        """
+        Add a node to poll.
+
+        Returns:
+          The node's NodeClient.
+        """
+        for client in self._clients:
+            if (client.host, client.port) == (host, port):
+                raise ValueError(_DUPLICATE_NODE.format(client.name))
+        client = NodeClient(host, port, self._timeout, self._limit)
+        self._clients.append(client)
+        return client
+
+    @property
+    def clients(self):
+        return list(self._clients)
+
+    def collect(self):
+        """
+        Poll every node once.
+
+        Returns:
+          A dict of node name (host:port) and either the node's streams, as returned by
+          NodeClient.pull(), or the PullError that stopped it being polled.
+        """
+        start = time.time()
+        pending = deque(self._clients)
+        results = {}
+
+        def work():
+            while True:
+                try:
+                    client = pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    results[client.name] = client.pull()
+                except PullError as e:
+                    results[client.name] = e
+
+        workers = [threading.Thread(target=work)
+                   for _ in range(min(self._max_in_flight, len(pending)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self._round_time = time.time() - start
+        return results
+
+    def status(self):
+        """
+        Report on the last round and on each node.
+        """
+        return {
+            'round_time': self._round_time,
+            'max_in_flight': self._max_in_flight,
+            'nodes': dict((client.name, client.status()) for client in self._clients),
+        }
+
+    def close(self):
+        """
+        Close every node's idle connections.
+        """
+        for client in self._clients:
+            client.close()
@@ -0,0 +1,339 @@
+"""
+The queues module provides bounded observer output queues that never block the observer
+indefinitely and never lose data silently.
+
+When a BoundedQueue is full, its overflow policy decides what is lost: the new datapoint, the
+oldest one, or (when downsampling) a growing share of new datapoints.  Every run of lost
+datapoints is marked in the stream by a Gap object at the point where the datapoints are
+missing, and the total is available as the queue's gaps attribute.
+
+A Channel is a BoundedQueue for consumers that take everything at once.  put_many() queues a
+batch of datapoints under one lock, and drain() and drain_wait() swap out the whole contents
+of the queue in one step instead of taking the lock (and raising Empty) once per item.
+"""
+from collections import deque
+from Queue import Queue, Empty
+import time
+from ptrial.observer.core import ObserverError, split_datapoint
+
+# Public constants: overflow policies
+BLOCK       = 'block'        # wait up to a timeout for room, then drop the new datapoint
+DROP_NEWEST = 'drop-newest'  # drop the new datapoint
+DROP_OLDEST = 'drop-oldest'  # drop the oldest queued datapoint to make room
+DOWNSAMPLE  = 'downsample'   # keep a shrinking share of new datapoints while the queue is full
+
+DEFAULT_CHANNEL_SIZE = 65536
+
+# Private constants
+_INVALID_POLICY = 'Unknown queue overflow policy "{}"'
+_INVALID_MAXSIZE = 'A bounded queue needs a maxsize >= 1'
+_MAX_STRIDE = 64
+
+
+class Gap(object):
+    """
+    Marks datapoints lost from a stream.
+
+    Attributes:
+      count: number of datapoints lost
+      start: timestamp of the first lost datapoint
+      end: timestamp of the last lost datapoint
+
+    Timestamps are taken from PYTHON_DATA datapoints with integer time; for other formats they
+    are the Unix time at which the datapoint was dropped.
+    """
+    __slots__ = ('count', 'start', 'end')
+
+    def __init__(self, timestamp):
+        self.count = 1
+        self.start = self.end = timestamp
+
+    def add(self, timestamp):
+        self.count += 1
+        if timestamp < self.start:
+            self.start = timestamp
+        if timestamp > self.end:
+            self.end = timestamp
+
+    def merge(self, gap):
+        self.count += gap.count
+        self.start = min(self.start, gap.start)
+        self.end = max(self.end, gap.end)
+
+    def __repr__(self):
+        return 'Gap(count={}, start={}, end={})'.format(self.count, self.start, self.end)
+
+class BoundedQueue(Queue):
+    """
+    A Queue that holds at most maxsize datapoints and handles overflow by policy.
+
+    put() never raises Full and never blocks for longer than the BLOCK timeout; put(item, False)
+    and put_nowait() drop the new datapoint at once instead of waiting.  Gap markers
+    are not counted toward maxsize; consecutive losses share one marker, so markers never
+    outnumber the datapoints around them.  Consumers receive Gap objects from get() like any
+    other item (and call task_done() for them as usual).
+
+    Args:
+      maxsize: the most datapoints held
+      policy: BLOCK, DROP_NEWEST, DROP_OLDEST or DOWNSAMPLE [default DROP_OLDEST]
+      timeout: seconds a BLOCK put waits for room
+    """
+    def __init__(self, maxsize, policy=DROP_OLDEST, timeout=1):
+        if maxsize < 1:
+            raise ObserverError(_INVALID_MAXSIZE)
+        if policy not in (BLOCK, DROP_NEWEST, DROP_OLDEST, DOWNSAMPLE):
+            raise ObserverError(_INVALID_POLICY.format(policy))
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.timeout = timeout
+        self.gaps = 0       # datapoints lost since the queue was created
+        self._ndata = 0     # datapoints (not gap markers) in the queue
+        self._stride = 1    # DOWNSAMPLE: keep one in this many new datapoints
+        self._skipped = 0
+        self._markers = []  # items queued by put_marker()
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Queue a datapoint, applying the overflow policy if the queue is full.  The timeout
+        argument is accepted for compatibility; the BLOCK timeout is used instead.  If block is
+        False, a full BLOCK queue drops the new datapoint without waiting.
+        """
+        with self.not_full:
+            self._put_datapoint(item, block)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_marker(self, item):
+        """
+        Queue an item that is not a datapoint (e.g. LoopObserver.end_data).  Markers are never
+        dropped and do not count toward maxsize.
+        """
+        with self.mutex:
+            self._markers.append(item)
+            self._append(item)
+
+    def full(self):
+        with self.mutex:
+            return self._ndata >= self.maxsize
+
+    def _put_datapoint(self, item, block=True):
+        if self._ndata >= self.maxsize:
+            if not self._make_room(item, block):
+                return
+        elif self.policy == DOWNSAMPLE and self._ndata < self.maxsize // 2:
+            self._stride = 1
+        self._append(item)
+        self._ndata += 1
+
+    def _make_room(self, item, block=True):
+        """
+        Apply the overflow policy to a full queue.
+
+        Returns:
+          True if the new item should be queued (room has been made), False if it was dropped.
+        """
+        policy = self.policy
+        if policy == BLOCK:
+            if not block:
+                self._lose(item)
+                return False
+            deadline = time.time() + self.timeout
+            while self._ndata >= self.maxsize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._lose(item)
+                    return False
+                self.not_full.wait(remaining)
+            return True
+        if policy == DROP_NEWEST:
+            self._lose(item)
+            return False
+        if policy == DOWNSAMPLE:
+            self._skipped += 1
+            if self._skipped < self._stride:
+                self._lose(item)
+                return False
+            self._skipped = 0
+            self._stride = min(self._stride * 2, _MAX_STRIDE)
+        self._drop_oldest()
+        return True
+
+    def _drop_oldest(self):
+        """
+        Remove the oldest datapoint and mark the loss where it was.
+        """
+        q = self.queue
+        i = 0
+        while isinstance(q[i], Gap) or self._is_marker(q[i]):
+            i += 1
+        q.rotate(-i)
+        oldest = q.popleft()
+        self._ndata -= 1
+        self.unfinished_tasks -= 1  # the dropped datapoint will never be task_done()
+        timestamp = _timestamp(oldest)
+        # the items before the dropped one are now at the end of the deque
+        before = q[-1] if i else None
+        after = q[0] if len(q) > i else None
+        if isinstance(before, Gap):
+            before.add(timestamp)
+            if isinstance(after, Gap):
+                before.merge(q.popleft())
+                self.unfinished_tasks -= 1
+        elif isinstance(after, Gap):
+            after.add(timestamp)
+        else:
+            q.appendleft(Gap(timestamp))
+            self.unfinished_tasks += 1
+        q.rotate(i)
+        self.gaps += 1
+
+    def _is_marker(self, item):
+        for marker in self._markers:
+            if item is marker:
+                return True
+        return False
+
+    def _lose(self, item):
+        """
+        Drop a new datapoint and mark the loss at the tail of the queue.
+        """
+        q = self.queue
+        if q and isinstance(q[-1], Gap):
+            q[-1].add(_timestamp(item))
+        else:
+            self._append(Gap(_timestamp(item)))
+        self.gaps += 1
+
+    def _append(self, item):
+        self._put(item)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def _get(self):
+        item = self.queue.popleft()
+        if isinstance(item, Gap):
+            return item
+        for n, marker in enumerate(self._markers):
+            if item is marker:
+                del self._markers[n]
+                return item
+        self._ndata -= 1
+        return item
+
+class Channel(BoundedQueue):
+    """
+    A BoundedQueue with batch publishing and draining.
+
+    Items taken with drain() or drain_wait() count as done; do not call task_done() for them.
+    The batch methods are meant for a single consumer; get() still works for others.
+
+    Example:
+        channel = Channel()
+        obs = MemoryObserver('mem', channel)
+        ...
+        for datapoint in channel.drain_wait(100, 5):
+            ...
+
+    Args:
+      maxsize: the most datapoints held [default DEFAULT_CHANNEL_SIZE]
+      policy: overflow policy, as for BoundedQueue [default DROP_OLDEST]
+      timeout: seconds a BLOCK put waits for room
+    """
+    def __init__(self, maxsize=DEFAULT_CHANNEL_SIZE, policy=DROP_OLDEST, timeout=1):
+        BoundedQueue.__init__(self, maxsize, policy, timeout)
+        self._wanted = 1  # items a waiting consumer needs before it is woken
+
+    def put_many(self, items):
+        """
+        Queue a sequence of datapoints under one lock, applying the overflow policy to each.
+        """
+        with self.not_full:
+            for item in items:
+                self._put_datapoint(item)
+
+    def drain(self):
+        """
+        Take everything in the channel without waiting.
+
+        Returns:
+          A list of the items, oldest first (empty if there are none).
+        """
+        with self.mutex:
+            return self._swap()
+
+    def drain_wait(self, count, timeout=None):
+        """
+        Wait until the channel holds at least count items, or for timeout seconds, and take
+        everything in it.  An end-of-data marker ends the wait early.
+
+        Returns:
+          A list of the items, oldest first (empty if the timeout passed with none).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.not_empty:
+            self._wanted = max(1, count)
+            try:
+                while len(self.queue) < count and not self._markers:
+                    if deadline is None:
+                        self.not_empty.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            finally:
+                self._wanted = 1
+            return self._swap()
+
+    def _swap(self):
+        items = self.queue
+        if not items:
+            return []
+        self.queue = deque()
+        self._ndata = 0
+        self._markers = []
+        self.unfinished_tasks -= len(items)
+        if self.unfinished_tasks <= 0:
+            self.unfinished_tasks = 0
+            self.all_tasks_done.notify_all()
+        self.not_full.notify_all()
+        return list(items)
+
+    def _append(self, item):
+        # wake the consumer only when it has enough to do, not once per item
+        self._put(item)
+        self.unfinished_tasks += 1
+        if len(self.queue) >= self._wanted or self._markers:
+            self.not_empty.notify()
+
+def drain(q):
+    """
+    Take everything in a queue without waiting: in one step from a Channel, item by item from
+    any other Queue.
+
+    Returns:
+      A list of the items, oldest first.
+    """
+    if isinstance(q, Channel):
+        return q.drain()
+    items = []
+    while True:
+        try:
+            items.append(q.get(block=False))
+        except Empty:
+            return items
+        q.task_done()
+
+def _timestamp(item):
+    """
+    The timestamp of a datapoint if it can be found, otherwise the current time.
+    """
+    if isinstance(item, dict):
+        try:
+            timestamp = split_datapoint(item)[1]
+            if isinstance(timestamp, (int, long, float)):
+                return timestamp
+        except (ObserverError, KeyError):
+            pass
+    return time.time()
@@ -0,0 +1,136 @@
+"""
+The scheduler module drives many loop observers from a single thread.
+
+Each LoopObserver normally runs in a thread of its own and sleeps between datapoints.  That is
+fine for a handful of observers, but a node with hundreds of them ends up with hundreds of
+sleeping threads.  A Scheduler keeps the observers in a heap ordered by the time their next
+datapoint is due and takes each datapoint as its deadline arrives.
+"""
+import heapq
+import itertools
+import threading
+from ptrial.observer.core import ObserverError, monotonic
+
+# Private constants
+_NO_QUEUE = 'No output queue set for observer {}'
+_BLOCKING_QUEUE = ('Observer {} has a bounded queue with no put_marker(); use a BoundedQueue or '
+                   'Channel so that a full queue cannot block the scheduler')
+
+
+class Scheduler(object):
+    """
+    Run the sampling loop for any number of LoopObservers in one thread.
+
+    The interval, count and stop() behavior of each observer is the same as when it runs in a
+    thread of its own.  An observer that is stopped or runs out of datapoints gets the end-of-data
+    marker in its queue and is dropped from the schedule.  Observers can be added while the
+    scheduler is running.  Aligned observers are sampled on their wall-clock interval boundaries.
+    An observer that raises an exception is stopped and finished the same way, and the exception
+    is kept in errors; the other observers carry on.
+
+    Nothing an observer does may block the scheduler thread, so a bounded queue must be a
+    BoundedQueue or Channel, which take the end-of-data marker even when full.  A plain Queue
+    must be unbounded.
+
+    Example:
+        sched = Scheduler()
+        sched.add(StorageObserver('var', q1, '/var'))
+        sched.add(MemoryObserver('mem', q2))
+        thread = Thread(target=sched.run)
+        thread.start()
+        ...
+        sched.stop()
+        thread.join()
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()  # tie breaker for observers with the same deadline
+        self._cond = threading.Condition()
+        self._errors = {}  # observer name -> exception that stopped it
+        self._run = True
+
+    def add(self, observer, delay=0):
+        """
+        Schedule an observer.  Its first datapoint is taken after delay seconds, or on the first
+        interval boundary after that for an aligned observer.
+        """
+        if not observer.queue:
+            raise ObserverError(_NO_QUEUE.format(observer.name))
+        queue = observer.queue
+        if not hasattr(queue, 'put_marker') and getattr(queue, 'maxsize', 0) > 0:
+            raise ObserverError(_BLOCKING_QUEUE.format(observer.name))
+        deadline, tick = observer.first_tick(monotonic() + delay)
+        with self._cond:
+            self._push(deadline, tick, observer)
+            self._cond.notify()
+
+    def run(self):
+        """
+        Take datapoints as they come due until stop() is called.
+
+        Use this method as a run target for a Thread object.
+        """
+        while True:
+            with self._cond:
+                if not self._run:
+                    break
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, _, obs, tick = self._heap[0]
+                delay = deadline - monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                lateness = -delay
+
+            # sample outside the lock so that add() and stop() are never held up by a slow source
+            if not obs.running:
+                obs.finish()
+                continue
+            try:
+                obs.sample(tick, lateness, block=False)
+            except Exception as e:
+                # the source is gone or could not be read; don't let one observer take down the
+                # rest
+                self._errors[obs.name] = e
+                obs.stop()
+                obs.finish()
+                continue
+            deadline, tick = obs.next_tick(deadline, tick, monotonic())
+            with self._cond:
+                self._push(deadline, tick, obs)
+        self._shutdown()
+
+    def stop(self):
+        """
+        Stop all observers and the scheduler loop.
+        """
+        with self._cond:
+            self._run = False
+            self._cond.notify()
+
+    @property
+    def errors(self):
+        """
+        The exception that stopped each observer that failed, by observer name.
+        """
+        return dict(self._errors)
+
+    def __len__(self):
+        """
+        Number of observers on the schedule.
+        """
+        return len(self._heap)
+
+    def _push(self, deadline, tick, observer):
+        heapq.heappush(self._heap, (deadline, next(self._seq), observer, tick))
+
+    def _shutdown(self):
+        with self._cond:
+            remaining = [entry[2] for entry in self._heap]
+            self._heap = []
+        for obs in remaining:
+            obs.stop()
+            obs.finish()
@@ -0,0 +1,368 @@
+"""
+The stream module serves live observer data to any number of HTTP clients from one thread.
+
+A StreamServer is the only consumer of its observers' queues.  It moves each batch of
+datapoints into a StreamLog, a bounded log of recent datapoints numbered in sequence, and every
+subscriber reads the log from its own cursor.  Subscribing never takes data away from anyone
+else, and memory use is the size of the logs plus at most one batch per subscriber.
+
+A subscriber is sent more data only when its socket has taken everything sent so far, so a slow
+client never holds up the observers or other clients.  If a client falls so far behind that the
+log has dropped datapoints it has not seen, its cursor moves to the oldest datapoint and the
+loss is sent as a gap (see ptrial.observer.queues.Gap).
+
+Clients use plain HTTP with chunked transfer encoding:
+
+  GET /streams                          JSON list of stream names
+  GET /stream/NAME[?format=ndjson|csv][&from=latest|oldest]
+
+Each chunk is a batch of datapoints as NDJSON lines (the default) or CSV lines after a header
+(see ptrial.observer.encoders).  When the observer finishes and the client has everything, the
+response ends.
+
+The server runs on asyncore, the event loop in the Python 2 standard library.
+
+Example:
+    server = StreamServer(('', 8081))
+    server.add(StorageObserver('var', Channel(), '/var'))
+    thread = Thread(target=server.run)
+    thread.start()
+    ...
+    server.stop()
+    thread.join()
+"""
+import asyncore
+from collections import deque
+from itertools import islice
+import json
+import socket
+import threading
+import time
+from urllib import unquote
+from urlparse import urlparse, parse_qs
+from ptrial.observer.core import ObserverError, CSV_DATA, JSON_DATA
+from ptrial.observer.encoders import encoder_for
+from ptrial.observer.queues import Gap, drain
+
+# Public constants
+DEFAULT_LOG_SIZE = 3600   # datapoints kept per stream for subscribers to catch up
+DEFAULT_BATCH = 1000      # most datapoints sent in one chunk
+DEFAULT_POLL = 0.1        # seconds between queue drains
+
+# Private constants
+_DUPLICATE_STREAM = 'A stream named {} already exists'
+_NO_QUEUE = 'No output queue set for observer {}'
+_NESTED_STREAM = 'Observer {} has a row of fields per key and cannot be streamed'
+_MAX_REQUEST = 8192
+_FORMATS = {'ndjson': JSON_DATA, 'csv': CSV_DATA}
+_CONTENT_TYPES = {JSON_DATA: 'application/x-ndjson', CSV_DATA: 'text/csv'}
+_STATUS = {
+    200: '200 OK',
+    400: '400 Bad Request',
+    404: '404 Not Found',
+    405: '405 Method Not Allowed',
+}
+
+
+class StreamLog(object):
+    """
+    A bounded log of recent datapoints from one observer.  Each datapoint has a sequence number
+    one more than the one before it; cursors are sequence numbers.
+
+    Args:
+      capacity: number of datapoints kept
+    """
+    def __init__(self, capacity=DEFAULT_LOG_SIZE):
+        self._items = deque(maxlen=capacity)
+        self.first_seq = 0  # sequence number of the oldest datapoint kept
+        self.next_seq = 0   # sequence number the next datapoint will get
+        self.ended = False
+
+    def extend(self, items):
+        """
+        Add datapoints (and gap markers) to the end of the log.
+        """
+        self._items.extend(items)
+        self.next_seq += len(items)
+        self.first_seq = self.next_seq - len(self._items)
+
+    def since(self, cursor, limit=DEFAULT_BATCH):
+        """
+        Get up to limit datapoints starting at the cursor.
+
+        Returns:
+          A (items, cursor, lost) tuple: the datapoints, the cursor to use next time and the
+          number of datapoints that were dropped from the log before they could be read.
+        """
+        lost = 0
+        if cursor < self.first_seq:
+            lost = self.first_seq - cursor
+            cursor = self.first_seq
+        start = cursor - self.first_seq
+        items = list(islice(self._items, start, start + limit))
+        return items, cursor + len(items), lost
+
+class StreamServer(asyncore.dispatcher):
+    """
+    Serve the datapoints of any number of observers to any number of HTTP subscribers.
+
+    Observers must use PYTHON_DATA and have a queue (a Channel is best, since it is drained in
+    one step).  They run as usual, in threads or a Scheduler; the server takes everything they
+    put in their queues.  Observers with a row of fields per device or process cannot be
+    streamed.
+
+    If a stream's datapoints cannot be encoded, the subscribers reading them are disconnected
+    and the error is kept in errors; other streams and subscribers carry on.
+
+    Args:
+      address: (host, port) to listen on; port 0 picks a free port (see the address attribute)
+      log_size: datapoints kept per stream for subscribers to catch up
+      batch: most datapoints sent to a subscriber in one chunk
+      poll: seconds between queue drains
+    """
+    def __init__(self, address, log_size=DEFAULT_LOG_SIZE, batch=DEFAULT_BATCH,
+                 poll=DEFAULT_POLL):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(64)
+        self.address = self.socket.getsockname()
+        self._log_size = log_size
+        self._batch = batch
+        self._poll = poll
+        # name -> (observer, StreamLog); replaced, never changed in place, so the server thread
+        # can iterate over it while add() runs on another thread
+        self._streams = {}
+        self._add_lock = threading.Lock()
+        self._encoders = {}  # (name, format) -> encoder shared by subscribers
+        self._chunks = {}  # chunks encoded since the last pump, for subscribers at one cursor
+        self._subscribers = set()
+        self._errors = {}  # stream name -> the last error encoding it
+        self._run = True
+
+    def add(self, observer):
+        """
+        Serve an observer's datapoints as the stream /stream/<observer name>.  Streams can be
+        added while the server is running.
+        """
+        if not observer.queue:
+            raise ObserverError(_NO_QUEUE.format(observer.name))
+        if observer.nested:
+            raise ObserverError(_NESTED_STREAM.format(observer.name))
+        with self._add_lock:
+            if observer.name in self._streams:
+                raise ObserverError(_DUPLICATE_STREAM.format(observer.name))
+            streams = dict(self._streams)
+            streams[observer.name] = (observer, StreamLog(self._log_size))
+            self._streams = streams
+
+    def run(self):
+        """
+        Serve subscribers until stop() is called.
+
+        Use this method as a run target for a Thread object.
+        """
+        while self._run:
+            asyncore.loop(self._poll, map=self._map, count=1)
+            self.pump()
+        for dispatcher in self._map.values():
+            dispatcher.close()  # the listening socket and every client
+
+    def stop(self):
+        """
+        Stop the server on the next iteration.
+        """
+        self._run = False
+
+    def pump(self):
+        """
+        Move new datapoints from the observer queues to the logs and give subscribers that are
+        ready their next batch.
+        """
+        for observer, log in self._streams.itervalues():
+            if log.ended:
+                continue
+            items = drain(observer.queue)
+            if items and items[-1] is observer.end_data:
+                items.pop()
+                log.ended = True
+            if items:
+                log.extend(items)
+        self._chunks.clear()
+        for subscriber in list(self._subscribers):
+            subscriber.refill()
+
+    @property
+    def errors(self):
+        """
+        The last error encoding each stream that has failed, by stream name.
+        """
+        return dict(self._errors)
+
+    def status(self):
+        """
+        Report on streams and subscribers.
+        """
+        return {
+            'subscribers': len(self._subscribers),
+            'streams': dict((name, {'first': log.first_seq, 'next': log.next_seq,
+                                    'ended': log.ended})
+                            for name, (_, log) in self._streams.iteritems()),
+        }
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Subscriber(pair[0], self)
+
+    def _encode(self, name, fmt, cursor, items):
+        """
+        Encode the items read from a stream at a cursor.  Subscribers that are keeping up read
+        the same items, so each batch is encoded once for all of them.
+        """
+        key = (name, fmt, cursor, len(items))
+        body = self._chunks.get(key)
+        if body is None:
+            body = self._chunks[key] = self._encoder(name, fmt).encode(items)
+        return body
+
+    def _encoder(self, name, fmt):
+        encoder = self._encoders.get((name, fmt))
+        if encoder is None:
+            observer = self._streams[name][0]
+            encoder = self._encoders[name, fmt] = encoder_for(observer, fmt, header=False)
+        return encoder
+
+    def _subscribe(self, subscriber, name):
+        stream = self._streams.get(name)
+        if stream is None:
+            return None
+        self._subscribers.add(subscriber)
+        return stream
+
+    def _unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+class _Subscriber(asyncore.dispatcher):
+    """
+    One client connection: read the request, then send chunks from the cursor onwards.
+    """
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server._map)
+        self._server = server
+        self._request = ''
+        self._out = ''
+        self._name = None
+        self._format = None
+        self._log = None
+        self._cursor = 0
+        self._header = False  # CSV header still to be sent
+        self._closing = False  # close once everything in _out is sent
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if self._log is not None or self._closing:
+            return  # nothing more is expected from the client; keep reading to see it close
+        self._request += data
+        if '\r\n\r\n' in self._request or '\n\n' in self._request:
+            self._start()
+        elif len(self._request) > _MAX_REQUEST:
+            self._respond(400, 'Request too long\n')
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+        if not self._out:
+            if self._closing:
+                self.close()
+            else:
+                self.refill()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self._server._unsubscribe(self)
+        asyncore.dispatcher.close(self)
+
+    def refill(self):
+        """
+        Queue the next chunk if everything sent so far has gone.
+        """
+        log = self._log
+        if log is None or self._out or self._closing:
+            return
+        server = self._server
+        cursor = self._cursor
+        items, self._cursor, lost = log.since(cursor, server._batch)
+        try:
+            body = ''
+            if lost:
+                gap = Gap(time.time())
+                gap.count = lost
+                body = server._encoder(self._name, self._format).encode([gap])
+                cursor += lost
+            if items:
+                body += server._encode(self._name, self._format, cursor, items)
+            if body and self._header:
+                body = server._encoder(self._name, self._format).header + body
+                self._header = False
+        except Exception as e:
+            # a datapoint this stream's encoder cannot handle; drop this client, not the server
+            server._errors[self._name] = e
+            self.close()
+            return
+        if body:
+            self._out = '%x\r\n%s\r\n' % (len(body), body)
+        if log.ended and self._cursor == log.next_seq:
+            self._out += '0\r\n\r\n'
+            self._closing = True
+
+    def _start(self):
+        lines = self._request.splitlines()
+        parts = lines[0].split() if lines else []
+        if len(parts) < 2:
+            return self._respond(400, 'Bad request line\n')
+        method, target = parts[0], parts[1]
+        if method != 'GET':
+            return self._respond(405, 'Only GET is supported\n')
+        url = urlparse(target)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).iteritems())
+        if url.path == '/streams':
+            names = sorted(self._server._streams)
+            return self._respond(200, json.dumps(names) + '\n', 'application/json')
+        if not url.path.startswith('/stream/'):
+            return self._respond(404, 'Not Found\n')
+        fmt = _FORMATS.get(params.get('format', 'ndjson'))
+        if fmt is None:
+            return self._respond(400, 'format must be ndjson or csv\n')
+        name = unquote(url.path[len('/stream/'):])
+        stream = self._server._subscribe(self, name)
+        if stream is None:
+            return self._respond(404, 'No such stream\n')
+        self._name = name
+        self._format = fmt
+        self._log = log = stream[1]
+        self._cursor = log.first_seq if params.get('from') == 'oldest' else log.next_seq
+        self._header = fmt == CSV_DATA
+        self._out = ('HTTP/1.1 200 OK\r\n'
+                     'Content-Type: {}\r\n'
+                     'Transfer-Encoding: chunked\r\n'
+                     'Cache-Control: no-cache\r\n'
+                     '\r\n').format(_CONTENT_TYPES[fmt])
+
+    def _respond(self, code, body, content_type='text/plain'):
+        self._out = ('HTTP/1.1 {}\r\n'
+                     'Content-Type: {}\r\n'
+                     'Content-Length: {}\r\n'
+                     'Connection: close\r\n'
+                     '\r\n').format(_STATUS[code], content_type, len(body)) + body
+        self._closing = True
@@ -0,0 +1,404 @@
+"""
+The workers module runs observers in a pool of worker processes, so that collection on a large
+host can use more than one core.
+
+Observers are created in the parent process as usual, each with the queue its consumer reads.
+A WorkerPool splits them among its workers, balancing the number of datapoints each worker
+takes per second.  Each worker is a forked copy of the parent that runs its share of the
+observers in a Scheduler (see ptrial.observer.scheduler); the observers themselves are
+unchanged.  Their datapoints come back to the parent through a Ring, a byte ring buffer in
+shared memory, one per worker, and a thread in the parent puts them in the observers' queues.
+
+Datapoints are serialized with marshal rather than pickled.  OrderedDicts (and tuples) are
+tagged so that the parent gets back datapoints just like the ones the observer made.
+
+Observer state that lives in the worker (missed ticks, latency histograms, queue gaps) is not
+seen by the parent's copies of the observers; datapoints lost because a ring was full are
+marked with a Gap in the observer's queue and counted in WorkerPool.status().  A History kept
+by an observer is filled in the parent.
+
+Example:
+    pool = WorkerPool(4)
+    for pid in pids:
+        pool.add(ProcessObserver(str(pid), Channel(), pid=pid))
+    pool.start()
+    ...
+    pool.stop()
+"""
+from collections import OrderedDict
+import marshal
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+from ptrial.observer.core import ObserverError, split_datapoint
+from ptrial.observer.queues import Gap
+
+# Public constants
+DEFAULT_RING_SIZE = 2 ** 20  # bytes of datapoints in flight per worker
+DEFAULT_POLL = 0.05          # seconds between ring drains in the parent
+
+# Private constants
+_NO_QUEUE = 'No output queue set for observer {}'
+_TOO_BIG = 'A {} byte record does not fit in a {} byte ring'
+_STARTED = 'The worker pool is already started'
+_HEADER = struct.Struct('=QQQ')  # bytes written, bytes read, records dropped
+_LENGTH = struct.Struct('=I')
+_MARSHAL_VERSION = 2
+# record kinds
+_DATA = 0
+_END = 1
+_GAP = 2
+# tags for the values marshal cannot hold as they are
+_ODICT = '\x00odict'
+_TUPLE = '\x00tuple'
+_SCALARS = (int, long, float, str, unicode, bool, type(None))
+
+
+class Ring(object):
+    """
+    A byte ring buffer in shared memory for one writer process and one reader process.
+
+    Each record is a length and the bytes.  A record that does not fit in the free space is
+    dropped and counted rather than waited for, so a slow reader never holds up the writer.
+    The ring must be created before the processes fork.
+
+    Args:
+      size: bytes of record space
+    """
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        self._size = size
+        self._mem = mmap.mmap(-1, _HEADER.size + size)  # anonymous and shared across fork()
+        self._lock = multiprocessing.Lock()
+
+    def write(self, record):
+        """
+        Add a record.
+
+        Returns:
+          False if there was no room for it.
+        """
+        length = _LENGTH.size + len(record)
+        if length > self._size:
+            raise ObserverError(_TOO_BIG.format(len(record), self._size))
+        with self._lock:
+            written, read, dropped = _HEADER.unpack_from(self._mem)
+            if written - read + length > self._size:
+                _HEADER.pack_into(self._mem, 0, written, read, dropped + 1)
+                return False
+            self._copy_in(written, _LENGTH.pack(len(record)) + record)
+            _HEADER.pack_into(self._mem, 0, written + length, read, dropped)
+        return True
+
+    def read(self):
+        """
+        Take every record in the ring.
+
+        Returns:
+          A list of records, oldest first.
+        """
+        with self._lock:
+            written, read, dropped = _HEADER.unpack_from(self._mem)
+            if written == read:
+                return []
+            data = self._copy_out(read, written - read)
+            _HEADER.pack_into(self._mem, 0, written, written, dropped)
+        records = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            length, = _LENGTH.unpack_from(data, pos)
+            pos += _LENGTH.size
+            records.append(data[pos:pos + length])
+            pos += length
+        return records
+
+    @property
+    def dropped(self):
+        """
+        Number of records that did not fit.
+        """
+        with self._lock:
+            return _HEADER.unpack_from(self._mem)[2]
+
+    @property
+    def used(self):
+        """
+        Bytes waiting to be read.
+        """
+        with self._lock:
+            written, read, _ = _HEADER.unpack_from(self._mem)
+        return written - read
+
+    def close(self):
+        self._mem.close()
+
+    def _copy_in(self, offset, data):
+        start = _HEADER.size + offset % self._size
+        first = min(len(data), _HEADER.size + self._size - start)
+        self._mem[start:start + first] = data[:first]
+        if first < len(data):
+            self._mem[_HEADER.size:_HEADER.size + len(data) - first] = data[first:]
+
+    def _copy_out(self, offset, length):
+        start = _HEADER.size + offset % self._size
+        first = min(length, _HEADER.size + self._size - start)
+        data = self._mem[start:start + first]
+        if first < length:
+            data += self._mem[_HEADER.size:_HEADER.size + length - first]
+        return data
+
+class WorkerPool(object):
+    """
+    Run observers in worker processes and put their datapoints in the observers' queues.
+
+    Args:
+      workers: number of worker processes [default the number of CPUs]
+      ring_size: bytes of datapoints in flight per worker
+      poll: seconds between ring drains in the parent
+    """
+    def __init__(self, workers=None, ring_size=DEFAULT_RING_SIZE, poll=DEFAULT_POLL):
+        self._nworkers = workers or multiprocessing.cpu_count()
+        self._ring_size = ring_size
+        self._poll = poll
+        self._observers = []
+        self._shards = []  # per worker: (ring, process, [observer index, ...])
+        self._ended = set()  # indexes of observers whose end-of-data marker has been queued
+        self._stop = multiprocessing.Event()
+        self._reader = None
+        self._run = True
+
+    def add(self, observer):
+        """
+        Add an observer.  Observers must be added before start().
+        """
+        if self._shards:
+            raise ObserverError(_STARTED)
+        if not observer.queue:
+            raise ObserverError(_NO_QUEUE.format(observer.name))
+        self._observers.append(observer)
+
+    def start(self):
+        """
+        Start the worker processes and the thread that moves their datapoints to the queues.
+        """
+        if self._shards:
+            raise ObserverError(_STARTED)
+        for indexes in self._split():
+            ring = Ring(self._ring_size)
+            process = multiprocessing.Process(target=self._work, args=(ring, indexes))
+            process.daemon = True
+            self._shards.append((ring, process, indexes))
+        for _, process, _ in self._shards:
+            process.start()
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def stop(self):
+        """
+        Stop every observer, wait for the workers to exit and queue what they sent.  Observers
+        that a worker could not finish (because it died) get their end-of-data marker here.
+        """
+        self._stop.set()
+        for _, process, _ in self._shards:
+            process.join()
+        self._run = False
+        if self._reader is not None:
+            self._reader.join()
+        self._drain()
+        for index, observer in enumerate(self._observers):
+            if index not in self._ended:
+                self._ended.add(index)
+                observer.finish()
+
+    def status(self):
+        """
+        Report on each worker.
+        """
+        return {
+            'workers': [{'pid': process.pid,
+                         'alive': process.is_alive(),
+                         'observers': len(indexes),
+                         'ring_used': ring.used,
+                         'dropped': ring.dropped}
+                        for ring, process, indexes in self._shards],
+            'observers': len(self._observers),
+            'ended': len(self._ended),
+        }
+
+    def _split(self):
+        """
+        Share the observers among the workers, busiest observers first, each to the worker with
+        the fewest datapoints per second so far.
+        """
+        nworkers = min(self._nworkers, len(self._observers)) or 1
+        loads = [0.0] * nworkers
+        shards = [[] for _ in range(nworkers)]
+        by_rate = sorted(range(len(self._observers)),
+                         key=lambda i: -1.0 / max(self._observers[i].interval, 1e-3))
+        for index in by_rate:
+            worker = loads.index(min(loads))
+            loads[worker] += 1.0 / max(self._observers[index].interval, 1e-3)
+            shards[worker].append(index)
+        return shards
+
+    def _work(self, ring, indexes):
+        """
+        The body of a worker process: run its observers until the pool is stopped.
+        """
+        from ptrial.observer.scheduler import Scheduler
+        scheduler = Scheduler()
+        for index in indexes:
+            observer = self._observers[index]
+            observer.queue = _RingQueue(ring, index)
+            observer.history = None  # kept by the parent
+            scheduler.add(observer)
+        thread = threading.Thread(target=scheduler.run)
+        thread.daemon = True
+        thread.start()
+        while not self._stop.wait(1):
+            pass  # wait() with a timeout, so the process still sees signals
+        scheduler.stop()
+        thread.join()
+
+    def _read_loop(self):
+        while self._run:
+            self._drain()
+            time.sleep(self._poll)
+
+    def _drain(self):
+        observers = self._observers
+        for ring, _, _ in self._shards:
+            records = ring.read()
+            if not records:
+                continue
+            batches = OrderedDict()  # observer index -> items, so each queue is visited once
+            for record in records:
+                index, kind, payload = marshal.loads(record)
+                observer = observers[index]
+                if kind == _DATA:
+                    item = _unpack(payload)
+                    history = observer.history
+                    if history is not None and isinstance(item, dict):
+                        _, timestamp, data = split_datapoint(item)
+                        history.append(timestamp, data)
+                elif kind == _GAP:
+                    item = Gap(payload[1])
+                    item.count, item.start, item.end = payload
+                else:
+                    item = observer.end_data
+                    self._ended.add(index)
+                batches.setdefault(index, []).append((kind, item))
+            for index, items in batches.iteritems():
+                _put(observers[index].queue, items)
+
+class _RingQueue(object):
+    """
+    The queue an observer puts its datapoints in when it runs in a worker.  Datapoints that do
+    not fit in the ring are counted and sent as a Gap ahead of the next datapoint that does.
+    """
+    def __init__(self, ring, index):
+        self._ring = ring
+        self._index = index
+        self._gap = None  # (count, start, end) of datapoints not yet reported lost
+        self.gaps = 0
+
+    def put(self, item, block=True, timeout=None):
+        if self._gap is not None:
+            if not self._ring.write(marshal.dumps((self._index, _GAP, self._gap),
+                                                  _MARSHAL_VERSION)):
+                self._lose(item)
+                return
+            self._gap = None
+        if not self._ring.write(marshal.dumps((self._index, _DATA, _pack(item)),
+                                              _MARSHAL_VERSION)):
+            self._lose(item)
+
+    def put_marker(self, item):
+        """
+        Send the end-of-data marker, waiting for room if the ring is full.
+        """
+        if self._gap is not None:
+            self._write_waiting(marshal.dumps((self._index, _GAP, self._gap), _MARSHAL_VERSION))
+            self._gap = None
+        self._write_waiting(marshal.dumps((self._index, _END, None), _MARSHAL_VERSION))
+
+    def qsize(self):
+        return 0
+
+    def __nonzero__(self):
+        return True
+
+    def _lose(self, item):
+        self.gaps += 1
+        timestamp = time.time()
+        if isinstance(item, dict):
+            try:
+                timestamp = split_datapoint(item)[1]
+            except ObserverError:
+                pass
+        if self._gap is None:
+            self._gap = (1, timestamp, timestamp)
+        else:
+            count, start, end = self._gap
+            self._gap = (count + 1, min(start, timestamp), max(end, timestamp))
+
+    def _write_waiting(self, record):
+        while not self._ring.write(record):
+            time.sleep(DEFAULT_POLL)
+
+def _put(queue, items):
+    """
+    Queue a batch of items from one observer.  Markers go through put_marker() where the queue
+    has it, so a bounded queue never drops them.
+    """
+    put_marker = getattr(queue, 'put_marker', queue.put)
+    put_many = getattr(queue, 'put_many', None)
+    if put_many is not None and all(kind == _DATA for kind, _ in items):
+        put_many([item for _, item in items])
+        return
+    for kind, item in items:
+        if kind == _DATA:
+            queue.put(item)
+        else:
+            put_marker(item)
+
+def _pack(value):
+    """
+    Make a value that marshal can hold: OrderedDicts become tagged key and value sequences, and
+    tuples are tagged so they are not mistaken for those.  The values of an OrderedDict are a
+    tuple when they are all scalars and a list of packed values otherwise.
+    """
+    if isinstance(value, _SCALARS):
+        return value
+    if isinstance(value, OrderedDict):
+        values = value.values()
+        for v in values:
+            if not isinstance(v, _SCALARS):
+                return (_ODICT, tuple(value.iterkeys()), [_pack(v) for v in values])
+        return (_ODICT, tuple(value.iterkeys()), tuple(values))  # flat: nothing to unpack
+    if isinstance(value, dict):
+        return dict((k, _pack(v)) for k, v in value.iteritems())
+    if isinstance(value, tuple):
+        return (_TUPLE, [_pack(v) for v in value])
+    if isinstance(value, list):
+        return [_pack(v) for v in value]
+    return value  # sets and the like; marshal raises ValueError for anything else
+
+def _unpack(value):
+    if isinstance(value, _SCALARS):
+        return value
+    if isinstance(value, tuple):
+        if value[0] == _ODICT:
+            values = value[2]
+            if isinstance(values, tuple):
+                return OrderedDict(zip(value[1], values))
+            return OrderedDict(zip(value[1], [_unpack(v) for v in values]))
+        return tuple(_unpack(v) for v in value[1])
+    if isinstance(value, dict):
+        return dict((k, _unpack(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_unpack(v) for v in value]
+    return value
@@ -0,0 +1,7 @@
+"""
+The store package writes observations to disk and reads them back.
+
+Observations are stored in segment files: a header describing the observer's fields followed by
+fixed-width binary records, one per datapoint.  Segments can be appended to cheaply and read
+back through mmap without parsing.
+"""
@@ -0,0 +1,245 @@
+"""
+The query module finds stored observations by time without reading every data file.
+
+Each observer directory has a catalog (catalog.json) with an entry for every segment file: the
+time range it covers, its record count and a sparse index of every INDEX_STRIDE'th timestamp.
+A range query uses the catalog to pick the segments that overlap the range, and the sparse
+index to narrow each segment down to the records it needs before touching the data.
+
+Catalog entries are checked against each file's size and modification time, so segments that
+are still being written, or that were written by something that did not update the catalog,
+are indexed again when they are queried.
+
+Directory layout is the one used by manager.FileManager:
+
+  root/trial/node[/app]/observer/*.seg
+  root/trial/node[/app]/observer/rollup-<resolution>s/*.seg
+"""
+from bisect import bisect_left
+import json
+import os
+from ptrial.store.rollup import rollup_dir
+from ptrial.store.segment import SegmentReader, SegmentError, SEGMENT_SUFFIX
+
+# Public constants
+CATALOG = 'catalog.json'
+INDEX_STRIDE = 256  # records between sparse index entries
+
+# Private constants
+_CATALOG_VERSION = 1
+
+
+class Catalog(object):
+    """
+    The time ranges and sparse indexes of the segment files in one observer directory.
+
+    Args:
+      directory: the observer directory
+      stride: records between sparse index entries
+    """
+    def __init__(self, directory, stride=INDEX_STRIDE):
+        self.directory = directory
+        self._stride = stride
+        self._path = os.path.join(directory, CATALOG)
+        self._entries = {}
+        self._load()
+
+    def refresh(self):
+        """
+        Index new and changed segment files and forget deleted ones.  The catalog is saved if
+        anything changed.
+
+        Returns:
+          The catalog entries, ordered by the time of their first record.
+        """
+        changed = False
+        try:
+            names = set(f for f in os.listdir(self.directory) if f.endswith(SEGMENT_SUFFIX))
+        except OSError:
+            return []
+        for name in list(self._entries):
+            if name not in names:
+                del self._entries[name]
+                changed = True
+        for name in names:
+            if self._stale(name):
+                entry = self._index(name)
+                if entry is not None:
+                    self._entries[name] = entry
+                    changed = True
+                elif self._entries.pop(name, None) is not None:
+                    changed = True
+        if changed:
+            self.save()
+        return self.entries()
+
+    def update(self, path):
+        """
+        Index one segment file (e.g. when a writer closes it) and save the catalog.
+        """
+        name = os.path.basename(path)
+        entry = self._index(name)
+        if entry is not None:
+            self._entries[name] = entry
+            self.save()
+
+    def entries(self):
+        """
+        Catalog entries, ordered by the time of their first record.  Each entry is a dict with
+        the keys file, first, last, count, size, mtime, stride and index.
+        """
+        return sorted(self._entries.values(), key=lambda e: (e['first'], e['file']))
+
+    def save(self):
+        """
+        Write the catalog.  The file is replaced atomically so readers never see a partial one.
+        """
+        tmp = self._path + '.tmp.{}'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': _CATALOG_VERSION, 'segments': self._entries}, f)
+        os.rename(tmp, self._path)
+
+    def query(self, start=None, end=None, fields=None):
+        """
+        Generate (timestamp, data) tuples with start <= timestamp < end, oldest first.  Either
+        bound can be None for no limit.
+
+        Args:
+          fields: the field names to include [default all fields]
+        """
+        for entry in self.refresh():
+            if end is not None and entry['first'] >= end:
+                break
+            if start is not None and entry['last'] < start:
+                continue
+            try:
+                reader = SegmentReader(os.path.join(self.directory, entry['file']))
+            except (IOError, OSError, SegmentError):
+                continue  # removed or replaced since the catalog was refreshed
+            with reader:
+                first, last = _narrow(reader, entry, start, end)
+                for timestamp, data in reader.range(start, end, first, last):
+                    if fields is not None:
+                        data = dict((k, data[k]) for k in fields)
+                    yield timestamp, data
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                catalog = json.load(f)
+        except (IOError, ValueError):
+            return
+        if catalog.get('version') == _CATALOG_VERSION:
+            self._entries = dict((str(k), v) for k, v in catalog['segments'].iteritems())
+
+    def _stale(self, name):
+        entry = self._entries.get(name)
+        if entry is None or entry['stride'] != self._stride:
+            return True
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return True
+        return st.st_size != entry['size'] or st.st_mtime != entry['mtime']
+
+    def _index(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            st = os.stat(path)
+            reader = SegmentReader(path)
+        except (IOError, OSError, SegmentError):
+            return None
+        with reader:
+            count = len(reader)
+            if not count:
+                return None
+            return {
+                'file': name,
+                'first': reader.time(0),
+                'last': reader.time(count - 1),
+                'count': count,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'stride': self._stride,
+                'index': [reader.time(n) for n in xrange(0, count, self._stride)],
+            }
+
+class TrialStore(object):
+    """
+    Query access to the stored data for all trials under a root directory.
+
+    Example:
+        store = TrialStore('/data/trials')
+        for timestamp, data in store.query('trial-42', '10.0.12.8', 'var_storage',
+                                           start=t1405, end=t1420):
+            ...
+
+    Args:
+      root: top of the directory tree, as given to manager.FileManager
+    """
+    def __init__(self, root):
+        self.root = root
+        self._catalogs = {}
+
+    def trials(self):
+        return _subdirs(self.root)
+
+    def nodes(self, trial):
+        return _subdirs(os.path.join(self.root, trial))
+
+    def observers(self, trial, node, app=None):
+        path = os.path.join(*[p for p in (self.root, trial, node, app) if p])
+        return [d for d in _subdirs(path) if _has_segments(os.path.join(path, d))]
+
+    def catalog(self, trial, node, observer, app=None, resolution=None):
+        """
+        The Catalog for an observer directory, or for one of its rollup directories.  Catalogs
+        are kept between queries.
+        """
+        parts = [self.root, trial, node, app, observer]
+        if resolution:
+            parts.append(rollup_dir(resolution))
+        path = os.path.join(*[str(p) for p in parts if p])
+        if path not in self._catalogs:
+            self._catalogs[path] = Catalog(path)
+        return self._catalogs[path]
+
+    def query(self, trial, node, observer, start=None, end=None, app=None, fields=None,
+              resolution=None):
+        """
+        Generate (timestamp, data) tuples for an observer with start <= timestamp < end.
+
+        Args:
+          resolution: read the rollup at this resolution (seconds) instead of the raw data;
+                      rollup field names are <field>.<stat> (see ptrial.store.rollup)
+        """
+        catalog = self.catalog(trial, node, observer, app, resolution)
+        return catalog.query(start, end, fields)
+
+def _narrow(reader, entry, start, end):
+    """
+    Use the sparse index to find the records to search for start and end.
+
+    Returns:
+      (first, last) record numbers, or None for a bound that needs no search.
+    """
+    index = entry['index']
+    stride = entry['stride']
+    count = len(reader)
+    first = last = None
+    if start is not None:
+        i = bisect_left(index, start)
+        first = reader.bisect(start, max(0, (i - 1) * stride), min(count, i * stride))
+    if end is not None:
+        i = bisect_left(index, end)
+        last = reader.bisect(end, max(0, (i - 1) * stride), min(count, i * stride))
+    return first, last
+
+def _subdirs(path):
+    try:
+        return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+    except OSError:
+        return []
+
+def _has_segments(path):
+    return any(f.endswith(SEGMENT_SUFFIX) for f in os.listdir(path))
@@ -0,0 +1,173 @@
+"""
+The rollup module summarizes datapoints at coarser time resolutions as they arrive.
+
+A rollup keeps the min, max, mean, last value and count of each field over fixed time buckets
+(one minute, five minutes, one hour, ...).  Each bucket is summarized incrementally, so nothing
+but the running totals is kept in memory, and a bucket is emitted as soon as a datapoint
+arrives for a later one.
+
+Emitted buckets are ordinary datapoints whose fields are named <field>.<stat> and whose
+timestamp is the start of the bucket.  manager.FileManager stores them next to the raw data in
+rollup_dir(resolution) under the observer directory, where the query module reads them like
+any other segments.
+"""
+from collections import OrderedDict
+from ptrial.observer.core import ENUM, GAUGE
+
+# Public constants
+DEFAULT_RESOLUTIONS = (60, 300, 3600)
+STATS = ('min', 'max', 'mean', 'last', 'count')
+
+# Private constants
+_INVALID_RESOLUTION = 'Rollup resolution must be a whole number of seconds >= 1'
+
+
+def rollup_dir(resolution):
+    """
+    Name of the directory that holds rollups at the given resolution (seconds).
+    """
+    return 'rollup-{}s'.format(int(resolution))
+
+def rollup_fields(field_names, field_types=None):
+    """
+    Field names and types of the rollup of the given fields.  ENUM fields have only a last
+    value; other fields have every one of STATS.
+
+    Returns:
+      A (field_names, field_types) tuple.
+    """
+    if not field_types:
+        field_types = (None,) * len(field_names)
+    names = []
+    types = []
+    for name, ftype in zip(field_names, field_types):
+        if ftype == ENUM:
+            names.append(name + '.last')
+            types.append(ENUM)
+        else:
+            for stat in STATS:
+                names.append('{}.{}'.format(name, stat))
+                types.append(GAUGE)
+    return tuple(names), tuple(types)
+
+class Rollup(object):
+    """
+    Summarize datapoints into buckets of one resolution.
+
+    Args:
+      resolution: bucket length in seconds; buckets start on multiples of it (Unix time)
+      field_names: ordered sequence of field names
+      field_types: the type of each field [default all numeric]
+    """
+    def __init__(self, resolution, field_names, field_types=None):
+        if int(resolution) != resolution or resolution < 1:
+            raise ValueError(_INVALID_RESOLUTION)
+        self.resolution = int(resolution)
+        self._names = tuple(field_names)
+        types = field_types or (None,) * len(self._names)
+        self._enums = frozenset(n for n, t in zip(self._names, types) if t == ENUM)
+        self.field_names, self.field_types = rollup_fields(self._names, types)
+        self._bucket = None
+        self._acc = {}  # field name -> [min, max, sum, last, count]
+
+    def add(self, timestamp, data):
+        """
+        Add a datapoint.  Datapoints older than the current bucket are ignored.
+
+        Returns:
+          A (bucket start, summary) tuple for the bucket that this datapoint closed, or None.
+        """
+        bucket = int(timestamp) // self.resolution * self.resolution
+        closed = None
+        if bucket != self._bucket:
+            if self._bucket is not None:
+                if bucket < self._bucket:
+                    return None
+                closed = self.flush()
+            self._bucket = bucket
+        acc = self._acc
+        for name in self._names:
+            value = data.get(name)
+            if value is None:
+                continue
+            a = acc.get(name)
+            if a is None:
+                acc[name] = [value, value, value, value, 1]
+            elif name in self._enums:
+                a[3] = value
+            else:
+                if value < a[0]:
+                    a[0] = value
+                if value > a[1]:
+                    a[1] = value
+                a[2] += value
+                a[3] = value
+                a[4] += 1
+        return closed
+
+    def flush(self):
+        """
+        Close the current bucket, even if it is not over yet.
+
+        Returns:
+          A (bucket start, summary) tuple, or None if there is no open bucket.
+        """
+        if self._bucket is None:
+            return None
+        summary = OrderedDict()
+        acc = self._acc
+        for name in self._names:
+            a = acc.get(name)
+            if name in self._enums:
+                summary[name + '.last'] = a[3] if a else None
+                continue
+            if a is None:
+                a = [None, None, None, None, 0]
+            else:
+                a = a[:2] + [float(a[2]) / a[4]] + a[3:]
+            for stat, value in zip(STATS, a):
+                summary['{}.{}'.format(name, stat)] = value
+        bucket = self._bucket
+        self._bucket = None
+        self._acc = {}
+        return bucket, summary
+
+class RollupSet(object):
+    """
+    Summarize datapoints at several resolutions at once.
+
+    Args:
+      field_names: ordered sequence of field names
+      field_types: the type of each field [default all numeric]
+      resolutions: bucket lengths in seconds [default DEFAULT_RESOLUTIONS]
+    """
+    def __init__(self, field_names, field_types=None, resolutions=DEFAULT_RESOLUTIONS):
+        self.rollups = tuple(Rollup(r, field_names, field_types) for r in resolutions)
+
+    def add(self, timestamp, data):
+        """
+        Add a datapoint to every resolution.
+
+        Returns:
+          A list of (resolution, bucket start, summary) tuples for the buckets it closed.
+        """
+        closed = []
+        for rollup in self.rollups:
+            bucket = rollup.add(timestamp, data)
+            if bucket is not None:
+                closed.append((rollup.resolution,) + bucket)
+        return closed
+
+    def flush(self):
+        """
+        Close the open bucket at every resolution.
+
+        Returns:
+          A list of (resolution, bucket start, summary) tuples.
+        """
+        closed = []
+        for rollup in self.rollups:
+            bucket = rollup.flush()
+            if bucket is not None:
+                closed.append((rollup.resolution,) + bucket)
+        return closed
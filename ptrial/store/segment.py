@@ -0,0 +1,293 @@
+"""
+The segment module defines the binary file format for stored observations.
+
+A segment file holds datapoints from one observer:
+
+  preamble   8 bytes: the magic string 'PTSEG\\0' and a little-endian uint16 format version
+             8 bytes: uint32 header length and uint32 record size
+  header     JSON object describing the observer and its fields, padded with spaces to a
+             multiple of 8 bytes
+  records    fixed-width little-endian records: a double timestamp (Unix time) followed by
+             one value per field
+
+Numeric fields are stored as doubles; None is stored as NaN.  ENUM fields are stored as
+fixed-width strings padded with NUL bytes.  Because every record is the same size, record N
+is at a known offset and a time range can be found with a binary search on the timestamps.
+A partial record at the end of a file (e.g. after a crash) is ignored.
+"""
+from collections import OrderedDict
+import json
+import mmap
+import os
+import struct
+from ptrial.observer.core import ENUM
+
+# Public constants
+SEGMENT_SUFFIX = '.seg'
+FORMAT_VERSION = 1
+ENUM_WIDTH = 8  # bytes stored for each ENUM value
+
+# Private constants
+_MAGIC = 'PTSEG\0'
+_PREAMBLE = struct.Struct('<6sHII')
+_ALIGN = 8
+_NAN = float('nan')
+_BAD_MAGIC        = 'Not a segment file: {}'
+_BAD_VERSION      = 'Segment {} has unsupported format version {}'
+_SCHEMA_MISMATCH  = 'Segment {} holds different fields than observer {}'
+_NOT_FLAT         = 'Segment record for {} has a non-scalar value: {}'
+
+
+class SegmentError(Exception):
+    pass
+
+def record_format(field_types):
+    """
+    The struct format of a record for fields of the given types.
+    """
+    fmt = '<d'
+    for ftype in field_types:
+        fmt += '{}s'.format(ENUM_WIDTH) if ftype == ENUM else 'd'
+    return fmt
+
+class SegmentWriter(object):
+    """
+    Append datapoints to a segment file.
+
+    If the file exists and holds the same fields, records are appended to it.  Otherwise it is
+    created with a new header.
+
+    Args:
+      path: segment file path
+      name: observer name
+      field_names: ordered sequence of field names
+      field_types: the type of each field [default all numeric]
+      meta: optional dict of extra header items (node, trial, etc.)
+    """
+    def __init__(self, path, name, field_names, field_types=None, meta=None):
+        self.path = path
+        self._names = tuple(field_names)
+        self._types = tuple(field_types) if field_types else (None,) * len(self._names)
+        self._enums = frozenset(i for i, t in enumerate(self._types) if t == ENUM)
+        self._record = struct.Struct(record_format(self._types))
+        self._count = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = SegmentReader(path)
+            try:
+                if tuple(reader.field_names) != self._names:
+                    raise SegmentError(_SCHEMA_MISMATCH.format(path, name))
+                self._count = len(reader)
+                data_end = reader.data_offset + self._count * self._record.size
+            finally:
+                reader.close()
+            self._file = open(path, 'r+b')
+            self._file.truncate(data_end)  # drop a partial record
+            self._file.seek(data_end)
+        else:
+            header = {
+                'name': str(name),
+                'fields': list(self._names),
+                'types': list(self._types),
+                'record_format': self._record.format,
+            }
+            if meta:
+                header['meta'] = meta
+            self._file = open(path, 'wb')
+            self._file.write(_encode_header(header, self._record.size))
+        self._size = self._file.tell()
+
+    def append(self, timestamp, data):
+        """
+        Append one datapoint.  The data is buffered; see flush().
+
+        Args:
+          timestamp: Unix time of the datapoint
+          data: dict of field names and values
+        """
+        self.write(self.pack(timestamp, data))
+
+    def append_many(self, datapoints):
+        """
+        Append a sequence of (timestamp, data) tuples with one write.
+        """
+        self.write(''.join([self.pack(ts, data) for ts, data in datapoints]))
+
+    def pack(self, timestamp, data):
+        """
+        Pack a datapoint into a record.
+        """
+        values = [timestamp]
+        enums = self._enums
+        for i, name in enumerate(self._names):
+            value = data.get(name)
+            if i in enums:
+                value = '' if value is None else str(value)
+            elif value is None:
+                value = _NAN
+            elif isinstance(value, (dict, list, tuple)):
+                raise SegmentError(_NOT_FLAT.format(self.path, name))
+            values.append(value)
+        return self._record.pack(*values)
+
+    def write(self, records):
+        """
+        Write packed records.
+        """
+        self._file.write(records)
+        self._size += len(records)
+        self._count += len(records) // self._record.size
+
+    def flush(self, fsync=False):
+        """
+        Flush buffered records to the operating system, and to the disk if fsync is True.
+        """
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self._file.flush()
+            self._file.close()
+
+    @property
+    def size(self):
+        """
+        File size in bytes, including buffered records.
+        """
+        return self._size
+
+    @property
+    def record_size(self):
+        return self._record.size
+
+    def __len__(self):
+        return self._count
+
+class SegmentReader(object):
+    """
+    Read datapoints from a segment file through mmap.
+
+    Records are unpacked on demand; nothing is parsed when the file is opened beyond the header.
+    The file is mapped at its size when opened; call refresh() to see records appended since.
+
+    Args:
+      path: segment file path
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        preamble = self._file.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise SegmentError(_BAD_MAGIC.format(path))
+        magic, version, header_len, record_size = _PREAMBLE.unpack(preamble)
+        if magic != _MAGIC:
+            raise SegmentError(_BAD_MAGIC.format(path))
+        if version != FORMAT_VERSION:
+            raise SegmentError(_BAD_VERSION.format(path, version))
+        self.header = json.loads(self._file.read(header_len))
+        self.data_offset = _PREAMBLE.size + header_len
+        self.field_names = tuple(str(name) for name in self.header['fields'])
+        self.field_types = tuple(self.header['types'])
+        self._record = struct.Struct(str(self.header['record_format']))
+        if self._record.size != record_size:
+            raise SegmentError(_BAD_MAGIC.format(path))
+        self._enums = frozenset(i for i, t in enumerate(self.field_types) if t == ENUM)
+        self._time = struct.Struct('<d')
+        self._map = None
+        self._count = 0
+        self.refresh()
+
+    def refresh(self):
+        """
+        Map the file again to pick up appended records.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        size = os.fstat(self._file.fileno()).st_size
+        self._count = max(0, size - self.data_offset) // self._record.size
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    @property
+    def name(self):
+        return self.header['name']
+
+    @property
+    def record_size(self):
+        return self._record.size
+
+    def __len__(self):
+        return self._count
+
+    def time(self, n):
+        """
+        Timestamp of record n.
+        """
+        return self._time.unpack_from(self._map, self.data_offset + n * self._record.size)[0]
+
+    def record(self, n):
+        """
+        Record n as a (timestamp, data) tuple.
+        """
+        values = self._record.unpack_from(self._map, self.data_offset + n * self._record.size)
+        data = OrderedDict()
+        enums = self._enums
+        for i, name in enumerate(self.field_names):
+            value = values[i + 1]
+            if i in enums:
+                value = value.rstrip('\0')
+            elif value != value:  # NaN
+                value = None
+            data[name] = value
+        return values[0], data
+
+    def bisect(self, timestamp, lo=0, hi=None):
+        """
+        Number of records with a timestamp before the given one.  The search can be limited to
+        records lo to hi when an index has narrowed it down.
+        """
+        if hi is None:
+            hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start=None, end=None, first=None, last=None):
+        """
+        Generate (timestamp, data) tuples for records with start <= timestamp < end.  Either
+        bound can be None for no limit.
+
+        Args:
+          first, last: record numbers to use instead of searching for start and end
+        """
+        if first is None:
+            first = self.bisect(start) if start is not None else 0
+        if last is None:
+            last = self.bisect(end) if end is not None else self._count
+        for n in xrange(first, last):
+            yield self.record(n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _encode_header(header, record_size):
+    body = json.dumps(header, sort_keys=True)
+    preamble_size = _PREAMBLE.size
+    pad = -(preamble_size + len(body)) % _ALIGN
+    body += ' ' * pad
+    return _PREAMBLE.pack(_MAGIC, FORMAT_VERSION, len(body), record_size) + body
@@ -1,9 +1,14 @@
 """
 Tests for core context classes.
 """
+import os
+import shutil
+import stat
+import tempfile
 import unittest
-from ptrial.context.core import OperatingSystemContext, HardwareContext
+from ptrial.context.core import OperatingSystemContext, HardwareContext, HardwareContextError
 from ptrial.context.core import HOSTNAME, CPU_FILE, CPU_MODEL, CPU_NCORES
+from ptrial.context.em7 import EM7Context, DBPASS, DBUSER
 
 TEST_CPUINFO = 'cpuinfo'
 TEST_NCORES = 6
@@ -41,4 +46,69 @@ class HardwareContextTestCase(unittest.TestCase):
         model = self.hw[CPU_MODEL]
         self.assertEqual(ncores, TEST_NCORES)
         self.assertEqual(model, TEST_MODEL)
-    
\ No newline at end of file
+    
+    def test_lazy(self):
+        """
+        Nothing is read until a value is used; keys are known without reading.
+        """
+        hw = HardwareContext('no-such-cpuinfo')
+        self.assertEqual(sorted(hw), sorted([CPU_MODEL, CPU_NCORES]))
+        self.assertIn(CPU_MODEL, hw)
+        self.assertRaises(IOError, hw.__getitem__, CPU_MODEL)
+
+    def test_missing_value(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cpuinfo')
+            with open(path, 'w') as f:
+                f.write('processor\t: 0\nmodel name\t: Some CPU\n\n')
+            self.assertRaises(HardwareContextError, HardwareContext(path).__getitem__, CPU_MODEL)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Contexts reuse a snapshot while their source files are unchanged.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cpuinfo = os.path.join(self.tmpdir, 'cpuinfo')
+        self.snapshot = os.path.join(self.tmpdir, 'snap', 'hardware.json')
+        shutil.copy(TEST_CPUINFO, self.cpuinfo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reuse(self):
+        self.assertEqual(HardwareContext(self.cpuinfo, self.snapshot)[CPU_NCORES], TEST_NCORES)
+        self.assertTrue(os.path.exists(self.snapshot))
+        # the next context has its values before the source is read
+        hw = HardwareContext(self.cpuinfo, self.snapshot)
+        self.assertEqual(hw._items[CPU_MODEL], TEST_MODEL)
+        self.assertIsInstance(hw[CPU_MODEL], str)
+
+    def test_invalidated(self):
+        HardwareContext(self.cpuinfo, self.snapshot)[CPU_MODEL]
+        with open(self.cpuinfo) as f:
+            text = f.read()
+        with open(self.cpuinfo, 'w') as f:
+            f.write(text.replace('cpu cores\t: 6', 'cpu cores\t: 12'))
+        self.assertEqual(HardwareContext(self.cpuinfo, self.snapshot)[CPU_NCORES], 12)
+
+    def test_secrets(self):
+        """
+        Snapshots are private to their owner and leave out secret keys.
+        """
+        silo = os.path.join(self.tmpdir, 'silo.conf')
+        with open(silo, 'w') as f:
+            f.write('[LOCAL]\nipaddress = 10.0.0.1\ndbdir = /db\ndbuser = root\n'
+                    'dbpasswd = hunter2\nmodel_type = 1\n')
+        snapshot = os.path.join(self.tmpdir, 'snap', 'em7.json')
+        self.assertEqual(EM7Context(silo, silo, snapshot)[DBPASS], 'hunter2')
+        with open(snapshot) as f:
+            self.assertNotIn('hunter2', f.read())
+        self.assertEqual(stat.S_IMODE(os.stat(snapshot).st_mode), 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(snapshot)).st_mode), 0700)
+        em7 = EM7Context(silo, silo, snapshot)
+        self.assertEqual(em7._items[DBUSER], 'root')
+        self.assertEqual(em7[DBPASS], 'hunter2')
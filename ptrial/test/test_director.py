@@ -4,6 +4,7 @@ Tests for the Director classes.
 Use the 'runtest' command from the top-level directory.
 """
 import director
+from test_pull import start_agent
 import unittest
 import util
 
@@ -20,3 +21,32 @@ class DirectorInitTest(unittest.TestCase):
         
     def test_director_ctxt(self):
         pass
+
+    def test_add_node(self):
+        self.assertRaises(ValueError, self.nm.add_node, '10.0.1')
+        self.assertRaises(ValueError, self.nm.add_node, 'node1')
+        self.nm.add_node('10.0.12.8')
+
+class DirectorCollectTest(unittest.TestCase):
+    """
+    Collect from several node agents on loopback.
+    """
+    def setUp(self):
+        self.agents = [start_agent('node{}'.format(i)) for i in range(4)]
+        self.nm = director.Director(TESTER, DESCR, EMAIL, max_in_flight=2)
+        for _, port in self.agents:
+            self.nm.add_node('127.0.0.1', port)
+
+    def tearDown(self):
+        self.nm.close()
+        for process, _ in self.agents:
+            process.terminate()
+            process.join()
+
+    def test_collect(self):
+        results = self.nm.collect()
+        self.assertEqual(len(results), 4)
+        for streams in results.itervalues():
+            self.assertEqual(sorted(streams), ['cpu', 'disk'])
+        status = self.nm.collect_status()
+        self.assertEqual(len(status['nodes']), 4)
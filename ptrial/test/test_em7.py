@@ -1,4 +1,4 @@
-from ptrial.context.em7 import EM7Context, IPADDR, TYPE, BASE_VERSION
+from ptrial.context.em7 import EM7Context, EM7ContextError, IPADDR, TYPE, BASE_VERSION
 import unittest
 
 CONFIG = 'silo-test.conf'
@@ -17,3 +17,14 @@ class TestEm7Context(unittest.TestCase):
         self.assertEqual(_em7[IPADDR], TEST_IP)
         self.assertEqual(_em7[TYPE], TEST_APPLIANCE_TYPE)
         self.assertEqual(_em7[BASE_VERSION], TEST_VERSION)
+
+    def test_lazy(self):
+        """
+        The release file is not read for silo.conf attributes, and vice versa.
+        """
+        em7 = EM7Context(CONFIG, 'no-such-release')
+        self.assertEqual(em7[IPADDR], TEST_IP)
+        self.assertRaises(IOError, em7.__getitem__, BASE_VERSION)
+        em7 = EM7Context('no-such-silo.conf', RELEASE)
+        self.assertEqual(em7.basever, TEST_VERSION)
+        self.assertRaises(EM7ContextError, em7.__getitem__, IPADDR)
@@ -0,0 +1,85 @@
+"""
+Tests for batch encoders.
+"""
+from collections import OrderedDict
+import json
+from ptrial.observer.core import ObserverError, TestLoopObserver, CSV_DATA, JSON_DATA, PYTHON_DATA
+from ptrial.observer.encoders import CsvEncoder, NdjsonEncoder, encoder_for
+from ptrial.observer.kernel import DiskStatsObserver
+from ptrial.observer.queues import Gap
+import unittest
+
+def batch(n, time_as_key=True):
+    points = []
+    for t in range(100, 100 + n):
+        data = OrderedDict([('a', t), ('b', t * 0.5), ('state', 'R')])
+        if time_as_key:
+            points.append({'name': 'obs', t: data})
+        else:
+            points.append({'name': 'obs', 'time': t, 'data': data})
+    return points
+
+class CsvEncoderTestCase(unittest.TestCase):
+    def test_header_once(self):
+        encoder = CsvEncoder('obs', ('a', 'b', 'state'))
+        out = encoder.encode(batch(2))
+        self.assertEqual(out, 'timestamp,a,b,state\n100,100,50.0,R\n101,101,50.5,R\n')
+        self.assertEqual(encoder.encode(batch(1)), '100,100,50.0,R\n')
+        encoder.reset()
+        self.assertTrue(encoder.encode([]).startswith('timestamp,'))
+
+    def test_schema_from_data(self):
+        """
+        Without field names the schema comes from the first datapoint; markers are skipped.
+        """
+        encoder = CsvEncoder('obs')
+        self.assertEqual(encoder.encode([]), '')
+        out = encoder.encode([Gap(99)] + batch(1, time_as_key=False))
+        self.assertEqual(out, 'timestamp,a,b,state\n100,100,50.0,R\n')
+        self.assertEqual(encoder.field_names, ('a', 'b', 'state'))
+
+    def test_matches_observer(self):
+        """
+        A batch encodes the same as the observer's own CSV lines.
+        """
+        obs = TestLoopObserver('looper', None, data_format=CSV_DATA)
+        line = obs.get_datapoint()
+        encoder = encoder_for(obs, CSV_DATA)
+        out = encoder.encode([obs.datapoint])
+        self.assertEqual(out, obs.field_names + '\n' + line + '\n')
+
+class NdjsonEncoderTestCase(unittest.TestCase):
+    def test_lines(self):
+        encoder = NdjsonEncoder('obs', ('a', 'b', 'state'))
+        lines = encoder.encode(batch(3)).splitlines()
+        self.assertEqual(len(lines), 3)
+        for n, line in enumerate(lines):
+            point = json.loads(line, object_pairs_hook=OrderedDict)
+            self.assertEqual(point['name'], 'obs')
+            self.assertEqual(point['time'], 100 + n)
+            self.assertEqual(point['data'], batch(3, False)[n]['data'])
+            self.assertEqual(point['data'].keys(), ['a', 'b', 'state'])
+
+    def test_values(self):
+        encoder = NdjsonEncoder('o"bs', ('x',))
+        for value in (None, 1.25, 2 ** 70, u'caf\xe9', 'a"b', True):
+            line = encoder.encode([{'name': 'o"bs', 1: {'x': value}}])
+            self.assertEqual(json.loads(line), {'name': 'o"bs', 'time': 1, 'data': {'x': value}})
+
+    def test_gap(self):
+        encoder = NdjsonEncoder('obs', ('a', 'b', 'state'))
+        gap = Gap(10)
+        gap.add(12)
+        lines = encoder.encode([gap] + batch(1) + [object()]).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0]),
+                         {'name': 'obs', 'gap': {'count': 2, 'start': 10, 'end': 12}})
+
+    def test_encoder_for(self):
+        obs = TestLoopObserver('looper', None)
+        self.assertIsInstance(encoder_for(obs, JSON_DATA), NdjsonEncoder)
+        self.assertRaises(ObserverError, encoder_for, obs, PYTHON_DATA)
+        self.assertRaises(ObserverError, encoder_for, DiskStatsObserver('disks', None), CSV_DATA)
+
+if __name__ == "__main__":
+    unittest.main()
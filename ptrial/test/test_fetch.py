@@ -0,0 +1,118 @@
+"""
+Tests for incremental fetches from a History.
+"""
+import json
+import zlib
+from ptrial.observer.fetch import BatchHandler, HistoryHandler
+from ptrial.observer.history import History
+import unittest
+
+class HistoryHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.history = History(10, ('a', 'b'))
+        for t in range(100, 105):
+            self.history.append(t, {'a': t, 'b': -t})
+        self.handler = HistoryHandler('obs', self.history)
+
+    def get(self, query='', **headers):
+        environ = {'QUERY_STRING': query}
+        environ.update(headers)
+        response = {}
+        def start_response(status, response_headers):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict(response_headers)
+        response['body'] = ''.join(self.handler(environ, start_response))
+        return response
+
+    def test_since(self):
+        resp = self.get('since=102&fields=b')
+        self.assertEqual(resp['status'], 200)
+        data = json.loads(resp['body'])
+        self.assertEqual(data['fields'], ['b'])
+        self.assertEqual(data['rows'], [[103, -103], [104, -104]])
+        self.assertEqual(data['cursor'], 104)
+        self.assertFalse(data['more'])
+        self.assertFalse(data['truncated'])
+
+    def test_limit(self):
+        data = json.loads(self.get('limit=2')['body'])
+        self.assertEqual([row[0] for row in data['rows']], [100, 101])
+        self.assertTrue(data['more'])
+        data = json.loads(self.get('since={}&limit=2'.format(data['cursor']))['body'])
+        self.assertEqual(data['rows'][0], [102, 102, -102])
+
+    def test_nothing_new(self):
+        resp = self.get('since=104')
+        self.assertEqual(resp['status'], 204)
+        self.assertEqual(resp['body'], '')
+        self.assertEqual(resp['headers']['X-Cursor'], '104.0')
+
+    def test_etag(self):
+        resp = self.get('fields=a')
+        etag = resp['headers']['ETag']
+        self.assertEqual(self.get('fields=a', HTTP_IF_NONE_MATCH=etag)['status'], 304)
+        self.assertEqual(self.get('fields=b', HTTP_IF_NONE_MATCH=etag)['status'], 200)
+        self.history.append(105, {'a': 1, 'b': 2})
+        self.assertEqual(self.get('fields=a', HTTP_IF_NONE_MATCH=etag)['status'], 200)
+
+    def test_truncated(self):
+        for t in range(105, 120):
+            self.history.append(t, {'a': t, 'b': -t})
+        data = json.loads(self.get('since=101')['body'])
+        self.assertTrue(data['truncated'])
+        self.assertEqual(data['rows'][0][0], 110)
+
+    def test_bad_params(self):
+        self.assertEqual(self.get('since=yesterday')['status'], 400)
+        self.assertEqual(self.get('fields=c')['status'], 400)
+        self.assertEqual(self.get('limit=0')['status'], 400)
+
+    def test_params(self):
+        """
+        Parameters parsed by a dispatcher are used instead of the query string.
+        """
+        environ = {'QUERY_STRING': '', 'params': {'since': '103'}}
+        body = ''.join(self.handler(environ, lambda status, headers: None))
+        self.assertEqual(json.loads(body)['rows'], [[104, 104, -104]])
+
+class BatchHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = BatchHandler('node1')
+        for name in ('x', 'y'):
+            history = History(1000, ('a',))
+            for t in range(100, 105):
+                history.append(t, {'a': t})
+            self.handler.add(name, history)
+
+    def get(self, query='', **headers):
+        environ = {'QUERY_STRING': query}
+        environ.update(headers)
+        response = {}
+        def start_response(status, response_headers):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict(response_headers)
+        response['body'] = ''.join(self.handler(environ, start_response))
+        return response
+
+    def test_cursors(self):
+        data = json.loads(self.get('since.x=103&since.y=104')['body'])
+        self.assertEqual(data['node'], 'node1')
+        self.assertEqual(data['streams'].keys(), ['x'])
+        self.assertEqual(data['streams']['x']['rows'], [[104, 104]])
+
+    def test_gzip(self):
+        history = self.handler._histories['x']
+        for t in range(105, 500):
+            history.append(t, {'a': t})
+        resp = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(resp['headers']['Content-Encoding'], 'gzip')
+        data = json.loads(zlib.decompress(resp['body'], 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(data['streams']['x']['rows']), 400)
+        self.assertNotIn('Content-Encoding', self.get('since.x=499&since.y=104')['headers'])
+
+    def test_bad_params(self):
+        self.assertEqual(self.get('since.x=soon')['status'], 400)
+        self.assertEqual(self.get('limit=-1')['status'], 400)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests for the in-memory History ring buffer.
+"""
+from ptrial.observer.core import ObserverError, TestLoopObserver, COUNTER, ENUM, GAUGE
+from ptrial.observer.history import History
+from Queue import Queue
+from threading import Thread
+import random
+import unittest
+
+NAMES = ('state', 'count', 'level')
+TYPES = (ENUM, COUNTER, GAUGE)
+
+class HistoryTestCase(unittest.TestCase):
+    """
+    A History keeps the most recent datapoints in typed columns.
+    """
+    def setUp(self):
+        self.history = History(5, NAMES, TYPES)
+
+    def fill(self, start, stop):
+        for t in range(start, stop):
+            self.history.append(t, {'state': 'RS'[t % 2], 'count': t * 10, 'level': None})
+
+    def test_wrap(self):
+        self.fill(100, 108)
+        self.assertEqual(len(self.history), 5)
+        self.assertEqual(self.history.first_time, 103)
+        self.assertEqual(self.history.last_time, 107)
+        rows = list(self.history.range())
+        self.assertEqual([t for t, data in rows], range(103, 108))
+        self.assertEqual(rows[0][1].items(), [('state', 'S'), ('count', 1030), ('level', None)])
+
+    def test_range(self):
+        self.fill(100, 108)
+        self.assertEqual([t for t, data in self.history.range(104, 106)], [104, 105])
+        self.assertEqual([t for t, data in self.history.range(end=104)], [103])
+        self.assertEqual([t for t, data in self.history.range(200)], [])
+
+    def test_since(self):
+        self.fill(100, 108)
+        rows, cursor, more = self.history.since(104, fields=('count',))
+        self.assertEqual(rows, [[105, 1050], [106, 1060], [107, 1070]])
+        self.assertEqual((cursor, more), (107, False))
+        rows, cursor, more = self.history.since(None, limit=2)
+        self.assertEqual([row[0] for row in rows], [103, 104])
+        self.assertEqual(rows[0], [103, 'S', 1030, None])
+        self.assertEqual((cursor, more), (104, True))
+        self.assertEqual(self.history.since(107), ([], 107, False))
+        self.assertEqual(self.history.version, 8)
+
+    def test_columns(self):
+        self.fill(100, 103)
+        times, columns = self.history.columns(101, fields=('count', 'state'))
+        self.assertEqual(list(times), [101, 102])
+        self.assertEqual(columns.keys(), ['count', 'state'])
+        self.assertEqual(list(columns['count']), [1010, 1020])
+        self.assertEqual(columns['state'], ['S', 'R'])
+
+    def test_schema_from_data(self):
+        history = History(3)
+        history.append(1, {'a': 1})
+        self.assertEqual(history.field_names, ('a',))
+        self.assertRaises(ObserverError, history.append, 2, {'a': {'nested': 1}})
+
+    def test_size(self):
+        """
+        A week of 1 second memory datapoints fits in a few MB.
+        """
+        capacity = 7 * 24 * 3600
+        history = History(capacity, ('MemFree', 'Cached', 'Dirty'))
+        rand = random.Random(1)
+        free, cached = 6 << 30, 2 << 30
+        for t in xrange(8192):
+            free += 4096 * rand.randint(-50, 50)
+            cached += 4096 * rand.randint(-2, 3)
+            history.append(1426168800 + t + rand.random() / 100,
+                           {'MemFree': free, 'Cached': cached, 'Dirty': 4096 * rand.randint(0, 300)})
+        self.assertLess(history.nbytes * capacity / len(history), 5 * 2 ** 20)
+        self.assertEqual(list(history.range(1426168800 + 8191))[0][1]['MemFree'], free)
+
+    def test_blocks(self):
+        """
+        Datapoints read the same from sealed blocks as from the open one, across the wrap.
+        """
+        history = History(3000, NAMES, TYPES)
+        for t in xrange(5000):
+            history.append(t, {'state': 'RS'[t % 2], 'count': t * 10, 'level': None})
+        self.assertEqual(len(history), 3000)
+        self.assertEqual((history.first_time, history.last_time), (2000, 4999))
+        rows, cursor, more = history.since(2047, limit=3000)
+        self.assertEqual(len(rows), 2952)
+        self.assertEqual(rows[0], [2048, 'R', 20480, None])
+        self.assertEqual(rows[-1], [4999, 'S', 49990, None])
+        times, columns = history.columns(1000, 2003, fields=('count',))
+        self.assertEqual(list(times), [2000, 2001, 2002])
+        self.assertEqual(list(columns['count']), [20000, 20010, 20020])
+
+    def test_widen(self):
+        """
+        Values that do not fit an integer typecode are stored as doubles from then on.
+        """
+        history = History(2000, ('a',), typecode='I')
+        for t, value in enumerate([1, None, 2 ** 33, 2.5] + [7] * 1100):
+            history.append(t, {'a': value})
+        rows = history.since(None, limit=4)[0]
+        self.assertEqual([row[1] for row in rows], [1, None, 2 ** 33, 2.5])
+        self.assertEqual(history.columns()[1]['a'].typecode, 'd')
+        self.assertRaises(TypeError, history.append, 5000, {'a': 'x'})
+        self.assertEqual(len(history), 1104)
+
+    def test_integer_missing(self):
+        history = History(3, ('a',), typecode='I')
+        history.append(1426168800.25, {'a': None})
+        history.append(1426168801.5, {'a': 7})
+        self.assertEqual(history.since(None)[0], [[1426168800.25, None], [1426168801.5, 7]])
+
+    def test_long_span(self):
+        history = History(3, ('a',))
+        for t in (0.5, 1.5, 50 * 86400.25, 100 * 86400.125):
+            history.append(t, {'a': t})
+        self.assertEqual([t for t, data in history.range()],
+                         [1.5, 50 * 86400.25, 100 * 86400.125])
+        history.append(200 * 86400.0, {'a': 0})
+        self.assertEqual(history.first_time, 50 * 86400.25)
+
+    def test_concurrent_reads(self):
+        """
+        A reader sees whole datapoints, in order, while the History wraps under it.
+        """
+        history = History(50, ('a', 'b'))
+        def write():
+            for t in xrange(1, 20001):
+                history.append(t, {'a': t, 'b': -t})
+        writer = Thread(target=write)
+        writer.start()
+        while writer.is_alive():
+            rows, cursor, more = history.since(None)
+            self.assertEqual([row[0] for row in rows], sorted(set(row[0] for row in rows)))
+            for t, a, b in rows:
+                self.assertEqual((a, b), (t, -t))
+        writer.join()
+        self.assertEqual(history.last_time, 20000)
+
+    def test_observer(self):
+        q = Queue()
+        obs = TestLoopObserver('looper', q, count=2)
+        history = obs.keep_history(10)
+        t = Thread(target=obs.run)
+        t.start()
+        t.join()
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history.field_names, ('test',))
+        for timestamp, data in history.range():
+            self.assertIn(data['test'], range(1, 1000000))
@@ -1,13 +1,41 @@
 """
 Unit test cases for kernel observers
 """
-from ptrial.observer.kernel import ProcessObserver, StorageObserver
+from ptrial.observer.core import CSV_DATA, DERIVE_DELTA, DERIVE_RATE, ObserverError
+from ptrial.observer.kernel import (DiskStatsObserver, MemoryObserver, ProcessObserver,
+                                    ProcessTableObserver, ProcReader, SourceGoneError,
+                                    StorageObserver)
+import os
+import subprocess
 import util
 from Queue import Queue, Empty
 from threading import Thread
 import time
 import unittest
 
+class ProcReaderTest(unittest.TestCase):
+    """
+    A ProcReader re-reads a file through a descriptor that stays open.
+    """
+    def test_grow_buffer(self):
+        reader = ProcReader('cpuinfo', bufsize=16)
+        with open('cpuinfo') as f:
+            expected = f.read()
+        self.assertEqual(reader.read(), expected)
+        self.assertEqual(reader.read(), expected)
+        reader.close()
+
+    def test_missing_file(self):
+        reader = ProcReader('/proc/no-such-file')
+        self.assertRaises(SourceGoneError, reader.read)
+
+    def test_exited_process(self):
+        proc = subprocess.Popen(['sleep', '0.1'])
+        reader = ProcReader('/proc/{}/stat'.format(proc.pid))
+        self.assertTrue(reader.read().startswith(str(proc.pid)))
+        proc.wait()
+        self.assertRaises(SourceGoneError, reader.read)
+        
 class StorageObserverTest(unittest.TestCase):
     """
     A StorageObserver grabs stats for a storage device for a directory/partition.
@@ -43,6 +71,184 @@ class StorageObserverTest(unittest.TestCase):
         self.obs.stop()
         t.join()
 
+class DiskStatsObserverTest(unittest.TestCase):
+    """
+    A DiskStatsObserver grabs stats for many devices from one read of /proc/diskstats.
+    """
+    SOURCE = 'diskstats'
+
+    def test_all_devices(self):
+        obs = DiskStatsObserver('disks', Queue(), source=self.SOURCE, time_as_key=False)
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data.keys(), ['loop0', 'vda', 'vda1', 'vdb', 'nvme0n1', 'dm-0'])
+        self.assertEqual(tuple(data['vda'].keys()), obs.field_names)
+        self.assertEqual(data['vda']['rd_comp'], 30569)
+        self.assertEqual(data['vdb']['io_tmw'], 302)
+
+    def test_selected_devices(self):
+        obs = DiskStatsObserver('disks', Queue(), ['vda', 'dm-0', 'sdz'], source=self.SOURCE,
+                                time_as_key=False)
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data.keys(), ['vda', 'dm-0'])
+        self.assertEqual(data['dm-0']['io_prog'], 2)
+
+    def test_delta(self):
+        obs = DiskStatsObserver('disks', Queue(), ['vda'], source=self.SOURCE, time_as_key=False,
+                                derive=DERIVE_DELTA)
+        data = obs.get_datapoint()['data']
+        self.assertIsNone(data['vda']['rd_comp'])
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data['vda']['rd_comp'], 0)
+        self.assertEqual(data['vda']['io_prog'], 0)
+
+    def test_csv(self):
+        obs = DiskStatsObserver('disks', Queue(), ['vda', 'vdb'], source=self.SOURCE,
+                                data_format=CSV_DATA)
+        lines = obs.get_datapoint().split('\n')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(obs.field_names.startswith('timestamp,device,rd_comp'))
+        self.assertEqual(lines[1].split(',')[1:], ['vdb', '1262', '0', '52466', '302', '0', '0',
+                                                   '0', '0', '0', '472', '302'])
+
+    def test_device_strings(self):
+        """
+        'all' means every device, and a single name is one device.
+        """
+        obs = DiskStatsObserver('disks', Queue(), 'all', source=self.SOURCE, time_as_key=False)
+        every = DiskStatsObserver('disks', Queue(), source=self.SOURCE, time_as_key=False)
+        self.assertEqual(obs.get_datapoint()['data'].keys(), every.get_datapoint()['data'].keys())
+        obs = DiskStatsObserver('disks', Queue(), 'vda', source=self.SOURCE, time_as_key=False)
+        self.assertEqual(obs.get_datapoint()['data'].keys(), ['vda'])
+
+    def test_no_history(self):
+        obs = DiskStatsObserver('disks', Queue(), source=self.SOURCE)
+        self.assertRaises(ObserverError, obs.keep_history, 10)
+
+    def test_live(self):
+        obs = DiskStatsObserver('disks', Queue())
+        data = obs.get_datapoint()
+        self.assertEqual(data['name'], 'disks')
+
+class ProcessObserverReadTest(unittest.TestCase):
+    """
+    Read stats for this process and for one that has exited.
+    """
+    def test_self(self):
+        obs = ProcessObserver('self', Queue(), os.getpid(), time_as_key=False)
+        data = obs.get_datapoint()['data']
+        self.assertEqual(tuple(data.keys()), obs.field_names)
+        self.assertIn(data['state'], 'RS')
+
+    def test_rate(self):
+        obs = ProcessObserver('self', Queue(), os.getpid(), time_as_key=False, derive=DERIVE_RATE)
+        obs.get_datapoint()
+        data = obs.get_datapoint()['data']
+        self.assertIsInstance(data['utime'], float)
+        self.assertGreaterEqual(data['utime'], 0)
+        self.assertIsInstance(data['rss'], int)
+
+    def test_gone(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        obs = ProcessObserver('gone', Queue(), proc.pid)
+        self.assertRaises(ObserverError, obs.get_datapoint)
+
+class ProcessTableObserverTest(unittest.TestCase):
+    """
+    A ProcessTableObserver follows a set of processes that come and go.
+    """
+    def setUp(self):
+        self.procs = []
+
+    def tearDown(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+    def spawn(self):
+        proc = subprocess.Popen(['sleep', '30'])
+        self.procs.append(proc)
+        return proc
+
+    def test_all(self):
+        obs = ProcessTableObserver('all', Queue(), time_as_key=False)
+        data = obs.get_datapoint()['data']
+        self.assertIn(os.getpid(), data['processes'])
+        self.assertIn(os.getpid(), data['started'])
+        self.assertEqual(tuple(data['processes'][os.getpid()].keys()), obs.field_names)
+        data = obs.get_datapoint()['data']
+        self.assertNotIn(os.getpid(), data['started'])
+        self.assertIn(os.getpid(), data['processes'])
+
+    def test_tree(self):
+        """
+        Children of the root are picked up as they start and reported when they exit.
+        """
+        obs = ProcessTableObserver('tree', Queue(), ppid=os.getpid(), time_as_key=False)
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data['processes'].keys(), [os.getpid()])
+        child = self.spawn()
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data['started'].keys(), [child.pid])
+        self.assertEqual(data['started'][child.pid]['comm'], 'sleep')
+        self.assertEqual(data['started'][child.pid]['ppid'], os.getpid())
+        self.assertIn(child.pid, data['processes'])
+        child.kill()
+        child.wait()
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data['exited'], [child.pid])
+        self.assertNotIn(child.pid, data['processes'])
+
+    def test_names_and_limit(self):
+        """
+        Only matching processes are returned, with or without a persistent descriptor.
+        """
+        children = [self.spawn().pid for i in range(3)]
+        obs = ProcessTableObserver('sleepers', Queue(), names=['sleep'], ppid=os.getpid(),
+                                   time_as_key=False, max_open=1)
+        for i in range(2):
+            data = obs.get_datapoint()['data']
+            self.assertEqual(sorted(data['processes'].keys()), children)
+
+    def test_csv(self):
+        obs = ProcessTableObserver('self', Queue(), ppid=os.getpid(), data_format=CSV_DATA)
+        line = obs.get_datapoint()
+        self.assertEqual(line.split(',')[1], str(os.getpid()))
+        self.assertTrue(obs.field_names.startswith('timestamp,pid,state'))
+
+class MemoryObserverTest(unittest.TestCase):
+    """
+    A MemoryObserver returns /proc/meminfo fields as integers.
+    """
+    SOURCE = 'meminfo'
+
+    def test_read(self):
+        obs = MemoryObserver('mem', Queue(), time_as_key=False)
+        data = obs.get_datapoint()['data']
+        self.assertIn('MemTotal', data)
+        self.assertEqual(tuple(data.keys()), obs.field_names)
+
+    def test_all_fields(self):
+        obs = MemoryObserver('mem', Queue(), time_as_key=False, source=self.SOURCE)
+        self.assertEqual(len(obs.field_names), 54)
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data['MemTotal'], 6147400 * 1024)
+        self.assertEqual(data['HugePages_Total'], 0)
+        self.assertEqual(data.keys()[-1], 'DirectMap1G')
+
+    def test_selected_fields(self):
+        fields = ('Dirty', 'MemFree', 'Cached')
+        obs = MemoryObserver('mem', Queue(), time_as_key=False, fields=fields, source=self.SOURCE)
+        self.assertEqual(obs.field_names, fields)
+        data = obs.get_datapoint()['data']
+        self.assertEqual(data.items(), [('Dirty', 240 * 1024), ('MemFree', 5252264 * 1024),
+                                        ('Cached', 553852 * 1024)])
+
+    def test_unknown_field(self):
+        self.assertRaises(ObserverError, MemoryObserver, 'mem', Queue(), fields=('Bogus',),
+                          source=self.SOURCE)
+
 class ProcessObserverTest(unittest.TestCase):
     """
     A ProcessObserver grabs stats for a process as identified by a pid.
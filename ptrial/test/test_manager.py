@@ -4,9 +4,17 @@ Tests for the Manager classes.
 Use the 'runtest' command from the top-level directory.
 """
 import manager
-import observer
+from ptrial import observer
+from ptrial.observer.core import TestLoopObserver, ASCII_TIME, CSV_DATA
+from ptrial.observer.kernel import DiskStatsObserver
+from ptrial.observer.scheduler import Scheduler
+from ptrial.store.query import TrialStore
+from ptrial.store.segment import SegmentReader
 from Queue import Queue, Empty
 from threading import Thread
+import os
+import shutil
+import tempfile
 import time
 import unittest
 import util
@@ -22,4 +30,114 @@ class NodeManagerInitTest(unittest.TestCase):
         
     def test_hw_ctxt(self):
         pass
-    
\ No newline at end of file
+    
+class RotatingSegmentWriterTest(unittest.TestCase):
+    """
+    A RotatingSegmentWriter batches datapoints and starts new files by time or size.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_all(self, files):
+        times = []
+        for path in files:
+            with SegmentReader(path) as reader:
+                times.extend(t for t, data in reader.range())
+        return times
+
+    def test_hourly(self):
+        writer = manager.RotatingSegmentWriter(self.dir, 'obs', ('a',), buffer_size=1 << 20)
+        start = 1426168800  # on the hour
+        for t in range(start - 10, start + 10):
+            writer.append(t, {'a': t})
+        writer.close()
+        self.assertEqual(len(writer.files), 2)
+        self.assertEqual(self.read_all(writer.files), range(start - 10, start + 10))
+
+    def test_size_limit(self):
+        writer = manager.RotatingSegmentWriter(self.dir, 'obs', ('a', 'b'),
+                                               strategy=manager.SIZE_LIMIT, size_limit=1024,
+                                               buffer_size=100, fsync=manager.FSYNC_ROTATE)
+        for t in range(200):
+            writer.append(t, {'a': t, 'b': -t})
+        writer.close()
+        self.assertGreater(len(writer.files), 1)
+        for path in writer.files:
+            self.assertLessEqual(os.path.getsize(path), 1024)
+            first = self.read_all([path])[0]
+            self.assertEqual(os.path.basename(path), 'obs-{}.seg'.format(int(first)))
+        self.assertEqual(self.read_all(writer.files), range(200))
+
+class FileManagerTest(unittest.TestCase):
+    """
+    A FileManager drains observer queues into segment files in the trial tree.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store(self):
+        fm = manager.FileManager(self.dir, 'trial1', 'node1', write_interval=0.2,
+                                 fsync=manager.FSYNC_FLUSH, rollups=(60, 3600))
+        observers = [TestLoopObserver('looper{}'.format(i), Queue(), count=2) for i in range(3)]
+        sched = Scheduler()
+        for obs in observers:
+            fm.add_observer(obs)
+            sched.add(obs)
+        threads = [Thread(target=sched.run), Thread(target=fm.run)]
+        for t in threads:
+            t.start()
+        time.sleep(2.5)
+        sched.stop()
+        fm.stop()
+        for t in threads:
+            t.join()
+        for obs in observers:
+            path = fm.observer_path(obs.name)
+            self.assertTrue(path.startswith(os.path.join(self.dir, 'trial1', 'node1')))
+            files = [f for f in os.listdir(path) if f.endswith('.seg')]
+            self.assertEqual(len(files), 1)
+            self.assertIn('catalog.json', os.listdir(path))
+            with SegmentReader(os.path.join(path, files[0])) as reader:
+                self.assertEqual(len(reader), 2)
+                self.assertEqual(reader.header['meta']['trial'], 'trial1')
+            store = TrialStore(self.dir)
+            raw = list(store.query('trial1', 'node1', obs.name))
+            self.assertEqual(len(raw), 2)
+            rollup = list(store.query('trial1', 'node1', obs.name, resolution=60))
+            self.assertIn(len(rollup), (1, 2))
+            self.assertEqual(sum(data['test.count'] for ts, data in rollup), 2)
+
+    def test_nested(self):
+        fm = manager.FileManager(self.dir, 'trial1', 'node1')
+        self.assertRaises(ValueError, fm.add_observer, DiskStatsObserver('disks', Queue()))
+
+    def test_formats(self):
+        fm = manager.FileManager(self.dir, 'trial1', 'node1')
+        self.assertRaises(ValueError, fm.add_observer,
+                          TestLoopObserver('ascii', Queue(), time_format=ASCII_TIME))
+        self.assertRaises(ValueError, fm.add_observer,
+                          TestLoopObserver('csv', Queue(), data_format=CSV_DATA))
+
+    def test_bad_datapoint(self):
+        """
+        An observer whose datapoints cannot be stored is closed; the others carry on.
+        """
+        fm = manager.FileManager(self.dir, 'trial1', 'node1', rollups=())
+        bad = TestLoopObserver('bad', Queue(), count=1)
+        good = TestLoopObserver('good', Queue(), count=2)
+        fm.add_observer(bad)
+        fm.add_observer(good)
+        bad.queue.put({'name': 'bad', 'time': 'Thu Mar 12 14:00:00 2015', 'data': {'test': 1}})
+        good.run()
+        fm.drain()
+        bad.run()
+        fm.drain()
+        fm.close()
+        self.assertIsInstance(fm.errors['bad'], ValueError)
+        self.assertEqual(len(list(TrialStore(self.dir).query('trial1', 'node1', 'good'))), 2)
@@ -0,0 +1,95 @@
+"""
+Tests for the mount table index.
+"""
+import os
+import shutil
+import tempfile
+from ptrial.observer.core import ObserverError
+from ptrial.observer.mounts import MountTable, _parse_line
+import unittest
+
+MOUNTINFO = 'mountinfo'
+
+class MountTableTestCase(unittest.TestCase):
+    def setUp(self):
+        # a sysfs with the device links for the fixture's block devices
+        self.sysfs = tempfile.mkdtemp()
+        devdir = os.path.join(self.sysfs, 'dev', 'block')
+        os.makedirs(devdir)
+        for devnum, name in (('253:0', 'dm-0'), ('8:1', 'sda1'), ('8:17', 'sdb1')):
+            os.makedirs(os.path.join(self.sysfs, 'devices', 'block', name))
+            os.symlink('../../devices/block/' + name, os.path.join(devdir, devnum))
+        self.table = MountTable(MOUNTINFO, watch=None, sysfs=self.sysfs)
+
+    def tearDown(self):
+        self.table.close()
+        shutil.rmtree(self.sysfs)
+
+    def test_parse_line(self):
+        entry = _parse_line('44 17 0:40 / /tmp rw,nosuid master:7 propagate_from:2 - tmpfs '
+                            'tmpfs rw\n')
+        self.assertEqual((entry.mount_id, entry.parent_id, entry.major, entry.minor),
+                         (44, 17, 0, 40))
+        self.assertEqual((entry.mount_point, entry.fstype, entry.source), ('/tmp', 'tmpfs', 'tmpfs'))
+        self.assertIsNone(_parse_line('garbage\n'))
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.table.find('/').mount_point, '/')
+        self.assertEqual(self.table.find('/var/log/messages').mount_point, '/')
+        self.assertEqual(self.table.find('/srv/exports/a/b').mount_point, '/srv/exports')
+        self.assertEqual(self.table.find('/srv').mount_point, '/')
+
+    def test_escaped_mount_point(self):
+        entry = self.table.find('/data local/db')
+        self.assertEqual(entry.mount_point, '/data local')
+        self.assertEqual(self.table.device('/data local/db'), 'sdb1')
+
+    def test_bind_mount(self):
+        """
+        A bind mount is on the device of the filesystem it comes from.
+        """
+        entry = self.table.find('/srv/exports')
+        self.assertEqual(entry.root, '/exports')
+        self.assertEqual(self.table.device('/srv/exports'), 'sdb1')
+
+    def test_device_mapper(self):
+        self.assertEqual(self.table.device('/var'), 'dm-0')
+        self.assertEqual(self.table.sysfs_path(self.table.find('/var')),
+                         os.path.join(self.sysfs, 'dev', 'block', '253:0'))
+
+    def test_overmount(self):
+        """
+        The later of two mounts on one mount point hides the earlier one.
+        """
+        entry = self.table.find('/boot/grub')
+        self.assertEqual(entry.source, '/dev/sda2')
+        # no sysfs link for 8:2, so the device comes from the source
+        self.assertEqual(self.table.device('/boot'), 'sda2')
+
+    def test_not_block_device(self):
+        self.assertRaises(ObserverError, self.table.device, '/tmp/x')
+
+    def test_entries(self):
+        points = [e.mount_point for e in self.table.entries()]
+        self.assertEqual(points, sorted(points))
+        self.assertEqual(len(points), 7)
+
+    def test_refresh(self):
+        """
+        Without a watch file, every refresh parses mountinfo again.
+        """
+        self.assertTrue(self.table.refresh())
+
+    def test_watch(self):
+        """
+        The live table is parsed again only when the mount table changes.
+        """
+        table = MountTable()
+        try:
+            self.assertFalse(table.refresh())
+            self.assertEqual(table.find('/proc/self').fstype, 'proc')
+        finally:
+            table.close()
+
+if __name__ == '__main__':
+    unittest.main()
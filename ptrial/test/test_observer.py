@@ -2,8 +2,9 @@
 Test for the base classes in the observer.core module
 """
 from ptrial.observer.core import (ObserverBase, ObserverError, LoopObserver,
-                                   TestObserver, TestLoopObserver)
-from ptrial.observer.core import ASCII_TIME
+                                   TestObserver, TestLoopObserver, monotonic)
+from ptrial.observer.core import (ASCII_TIME, COUNTER, GAUGE, ENUM, DERIVE_DELTA, DERIVE_RATE,
+                                   Deriver, Histogram)
 from Queue import Queue, Empty
 from threading import Thread
 import time
@@ -113,3 +114,147 @@ class ObserverDataTestCase(unittest.TestCase):
         # stupid test but its a simple sanity check
         self.assertIn('time', dp)
         self.assertIsInstance(dp['time'], int)
+
+class AlignedLoopObserverTestCase(unittest.TestCase):
+    """
+    An aligned loop observer samples on wall-clock interval boundaries.
+    """
+    def test_consecutive_ticks(self):
+        """
+        Timestamps are whole seconds with no gaps and no repeats.
+        """
+        input_q = Queue()
+        obs = TestLoopObserver('aligned', input_q, count=3, aligned=True)
+        obs_thread = Thread(target=obs.run)
+        obs_thread.start()
+        stamps = []
+        while True:
+            data = input_q.get(timeout=Q_TIMEOUT)
+            if data is obs.end_data:
+                break
+            del data['name']
+            stamps.extend(data.keys())
+        obs_thread.join()
+        self.assertEqual(stamps, range(stamps[0], stamps[0] + 3))
+        self.assertEqual(obs.missed_ticks, 0)
+
+    def test_missed_ticks(self):
+        """
+        A loop that falls behind skips whole ticks and counts them.
+        """
+        obs = TestLoopObserver('aligned', Queue(), interval=5, aligned=True)
+        deadline, tick = obs.next_tick(100.0, 1000, 112.0)
+        self.assertEqual((deadline, tick), (110.0, 1010))
+        self.assertEqual(obs.missed_ticks, 1)
+        self.assertEqual(obs.status()['missed_ticks'], 1)
+
+    def test_first_tick(self):
+        obs = TestLoopObserver('aligned', Queue(), interval=15, aligned=True)
+        deadline, tick = obs.first_tick(50.0)
+        self.assertEqual(tick % 15, 0)
+        self.assertGreater(deadline, 50.0)
+        self.assertLessEqual(deadline, 65.0)
+
+    def test_first_tick_delayed(self):
+        """
+        A delayed start is aligned to the interval boundary after the delay.
+        """
+        obs = TestLoopObserver('aligned', Queue(), interval=1, aligned=True)
+        mono, wall = monotonic(), time.time()
+        deadline, tick = obs.first_tick(mono + 0.5)
+        self.assertAlmostEqual(wall + (deadline - mono), tick, places=2)
+        self.assertGreaterEqual(deadline, mono + 0.5)
+
+class InstrumentationTestCase(unittest.TestCase):
+    """
+    The sampling loop keeps latency histograms and counters.
+    """
+    def test_histogram(self):
+        hist = Histogram((0.001, 0.01, 0.1))
+        self.assertIsNone(hist.quantile(0.5))
+        for seconds in (0.0005, 0.0005, 0.005, 0.05, 3.0):
+            hist.add(seconds)
+        self.assertEqual(hist.counts, [2, 1, 1, 1])
+        self.assertEqual(hist.quantile(0.4), 0.001)
+        self.assertEqual(hist.quantile(0.5), 0.01)
+        self.assertEqual(hist.quantile(1), 3.0)
+        summary = hist.summary()
+        self.assertEqual(summary['count'], 5)
+        self.assertEqual(summary['max'], 3.0)
+        self.assertEqual(summary['buckets'], [[0.001, 2], [0.01, 1], [0.1, 1], [None, 1]])
+
+    def test_status(self):
+        obs = TestLoopObserver('obs', Queue())
+        for i in range(3):
+            obs.sample()
+        obs.sample(lateness=0.5)
+        status = obs.status()
+        self.assertEqual(status['samples'], 4)
+        self.assertEqual(status['late_ticks'], 1)
+        latency = status['latency']
+        for name in ('read', 'encode', 'enqueue'):
+            self.assertEqual(latency[name]['count'], 4)
+            self.assertLess(latency[name]['max'], 1)
+        self.assertEqual(latency['lateness']['count'], 1)
+        self.assertEqual(latency['lateness']['max'], 0.5)
+
+    def test_scheduler_lateness(self):
+        """
+        Ticks run by a Scheduler have their lateness recorded.
+        """
+        from ptrial.observer.scheduler import Scheduler
+        obs = TestLoopObserver('obs', Queue(), interval=0.01, count=3)
+        sched = Scheduler()
+        sched.add(obs)
+        thread = Thread(target=sched.run)
+        thread.start()
+        for i in range(4):
+            obs.queue.get(timeout=Q_TIMEOUT)
+        sched.stop()
+        thread.join()
+        self.assertEqual(obs.status()['latency']['lateness']['count'], 3)
+
+class DeriverTestCase(unittest.TestCase):
+    """
+    A Deriver turns counters into deltas and rates.
+    """
+    NAMES = ('count', 'level', 'state')
+    TYPES = (COUNTER, GAUGE, ENUM)
+
+    def row(self, count, level=7, state='S'):
+        return dict(zip(self.NAMES, (count, level, state)))
+
+    def test_delta(self):
+        d = Deriver(self.NAMES, self.TYPES, DERIVE_DELTA)
+        self.assertIsNone(d.derive(0.0, self.row(100))['count'])
+        data = d.derive(1.0, self.row(150, 9, 'R'))
+        self.assertEqual(data, {'count': 50, 'level': 9, 'state': 'R'})
+
+    def test_rate(self):
+        d = Deriver(self.NAMES, self.TYPES, DERIVE_RATE)
+        d.derive(10.0, self.row(100))
+        self.assertEqual(d.derive(12.0, self.row(150))['count'], 25.0)
+
+    def test_wrap(self):
+        d = Deriver(self.NAMES, self.TYPES, DERIVE_DELTA)
+        d.derive(0.0, self.row(2 ** 32 - 10))
+        self.assertEqual(d.derive(1.0, self.row(5))['count'], 15)
+        d.derive(2.0, self.row(2 ** 64 - 1))
+        self.assertEqual(d.derive(3.0, self.row(1))['count'], 2)
+
+    def test_reset(self):
+        d = Deriver(self.NAMES, self.TYPES, DERIVE_DELTA)
+        d.derive(0.0, self.row(5000))
+        self.assertEqual(d.derive(1.0, self.row(20))['count'], 20)
+
+    def test_rows(self):
+        d = Deriver(self.NAMES, self.TYPES, DERIVE_DELTA)
+        d.derive_rows(0.0, {'a': self.row(1), 'b': self.row(1)})
+        data = d.derive_rows(1.0, {'a': self.row(4)})
+        self.assertEqual(data['a']['count'], 3)
+        data = d.derive_rows(2.0, {'a': self.row(5), 'b': self.row(9)})
+        self.assertEqual(data['a']['count'], 1)
+        self.assertIsNone(data['b']['count'])
+
+    def test_untyped(self):
+        self.assertRaises(ObserverError, Deriver, self.NAMES, (), DERIVE_DELTA)
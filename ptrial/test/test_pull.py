@@ -0,0 +1,129 @@
+"""
+Tests for concurrent pulls from node agents on loopback.
+"""
+import multiprocessing
+from ptrial.observer.fetch import BatchHandler, make_server
+from ptrial.observer.history import History
+from ptrial.observer.pull import Collector, NodeClient, PullError
+import unittest
+
+def start_agent(node, points=5, fields=('a', 'b')):
+    """
+    Run a node agent in its own process.
+
+    Returns:
+      (process, port)
+    """
+    handler = BatchHandler(node)
+    for name in ('cpu', 'disk'):
+        history = History(100, fields)
+        for t in range(100, 100 + points):
+            history.append(t, dict((f, t) for f in fields))
+        handler.add(name, history)
+    server = make_server(('127.0.0.1', 0), handler)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    server.server_close()  # the agent process has its own copy of the socket
+    return process, server.server_address[1]
+
+class BatchPullTestCase(unittest.TestCase):
+    def setUp(self):
+        self.agents = [start_agent('node{}'.format(i)) for i in range(3)]
+
+    def tearDown(self):
+        for process, _ in self.agents:
+            process.terminate()
+            process.join()
+
+    def test_cursors(self):
+        client = NodeClient('127.0.0.1', self.agents[0][1])
+        streams = client.pull()
+        self.assertEqual(sorted(streams), ['cpu', 'disk'])
+        self.assertEqual(streams['cpu']['fields'], ['a', 'b'])
+        self.assertEqual(streams['cpu']['rows'][0], [100, 100, 100])
+        self.assertEqual(client.cursors, {'cpu': 104, 'disk': 104})
+        # nothing new, on the same connection
+        self.assertEqual(client.pull(), {})
+        status = client.status()
+        self.assertEqual(status['requests'], 2)
+        self.assertEqual(status['idle_connections'], 1)
+        client.close()
+
+    def test_limit(self):
+        client = NodeClient('127.0.0.1', self.agents[0][1], limit=2)
+        streams = client.pull()
+        self.assertEqual(len(streams['disk']['rows']), 2)
+        self.assertTrue(streams['disk']['more'])
+        streams = client.pull()
+        self.assertEqual(streams['disk']['rows'][0][0], 102)
+        client.close()
+
+    def test_collect(self):
+        collector = Collector(max_in_flight=2)
+        for _, port in self.agents:
+            collector.add('127.0.0.1', port)
+        results = collector.collect()
+        self.assertEqual(len(results), 3)
+        for streams in results.itervalues():
+            self.assertEqual(len(streams['cpu']['rows']), 5)
+        self.assertEqual(collector.collect(), dict((name, {}) for name in results))
+        self.assertIsNotNone(collector.status()['round_time'])
+        self.assertRaises(ValueError, collector.add, '127.0.0.1', self.agents[0][1])
+        collector.close()
+
+    def test_node_down(self):
+        process, port = self.agents[1]
+        process.terminate()
+        process.join()
+        collector = Collector()
+        for _, p in self.agents:
+            collector.add('127.0.0.1', p)
+        results = collector.collect()
+        self.assertIsInstance(results['127.0.0.1:{}'.format(port)], PullError)
+        self.assertEqual(sum(1 for r in results.itervalues() if isinstance(r, dict)), 2)
+        collector.close()
+
+class MalformedResponseTestCase(unittest.TestCase):
+    def test_malformed(self):
+        """
+        JSON that is not the expected shape is a PullError, and the cursors are left alone.
+        """
+        bodies = iter(['{"streams": []}', '{"streams": {"cpu": {"rows": []}}}', '[1]'])
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [next(bodies)]
+        server = make_server(('127.0.0.1', 0), app)
+        process = multiprocessing.Process(target=server.serve_forever)
+        process.daemon = True
+        process.start()
+        server.server_close()
+        try:
+            client = NodeClient('127.0.0.1', server.server_address[1])
+            for _ in range(3):
+                self.assertRaises(PullError, client.pull)
+            self.assertEqual(client.cursors, {})
+            self.assertEqual(client.status()['errors'], 3)
+            client.close()
+        finally:
+            process.terminate()
+            process.join()
+
+class CompressionTestCase(unittest.TestCase):
+    def test_gzip(self):
+        """
+        Large batches are compressed on the wire.
+        """
+        process, port = start_agent('node', points=100, fields=('a', 'b', 'c', 'd'))
+        try:
+            client = NodeClient('127.0.0.1', port)
+            streams = client.pull()
+            self.assertEqual(len(streams['cpu']['rows']), 100)
+            self.assertLess(client.status()['bytes'], 2000)
+            client.close()
+        finally:
+            process.terminate()
+            process.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Tests for bounded observer queues.
+"""
+from ptrial.observer.core import ObserverError, TestLoopObserver, split_datapoint
+from ptrial.observer.queues import BoundedQueue, Channel, Gap, drain
+from ptrial.observer.queues import BLOCK, DROP_NEWEST, DROP_OLDEST, DOWNSAMPLE
+from Queue import Empty, Queue
+from threading import Thread
+import time
+import unittest
+
+def datapoint(t):
+    return {'name': 'obs', t: {'value': t}}
+
+def contents(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get(block=False))
+        except Empty:
+            return items
+        q.task_done()
+
+def times(items):
+    return [split_datapoint(item)[1] for item in items if isinstance(item, dict)]
+
+class BoundedQueueTestCase(unittest.TestCase):
+    """
+    A BoundedQueue holds at most maxsize datapoints and marks the ones it drops.
+    """
+    def fill(self, q, n):
+        for t in range(n):
+            q.put(datapoint(t))
+
+    def test_invalid(self):
+        self.assertRaises(ObserverError, BoundedQueue, 0)
+        self.assertRaises(ObserverError, BoundedQueue, 5, 'sometimes')
+
+    def test_drop_oldest(self):
+        """
+        The newest datapoints are kept and one gap at the head covers the dropped ones.
+        """
+        q = BoundedQueue(3, DROP_OLDEST)
+        self.fill(q, 10)
+        self.assertEqual(q.qsize(), 4)
+        self.assertEqual(q.gaps, 7)
+        items = contents(q)
+        gap = items[0]
+        self.assertIsInstance(gap, Gap)
+        self.assertEqual((gap.count, gap.start, gap.end), (7, 0, 6))
+        self.assertEqual(times(items), [7, 8, 9])
+        q.join()  # every item delivered was task_done()
+
+    def test_drop_newest(self):
+        """
+        The oldest datapoints are kept and one gap at the tail covers the dropped ones.
+        """
+        q = BoundedQueue(3, DROP_NEWEST)
+        self.fill(q, 5)
+        self.assertEqual(q.gaps, 2)
+        q.put(datapoint(5))
+        items = contents(q)
+        gap = items[3]
+        self.assertEqual((gap.count, gap.start, gap.end), (3, 3, 5))
+        self.assertEqual(times(items), [0, 1, 2])
+        q.join()
+
+    def test_block(self):
+        """
+        A blocked put gives up after the timeout and drops the datapoint.
+        """
+        q = BoundedQueue(2, BLOCK, timeout=0.05)
+        self.fill(q, 3)
+        self.assertEqual(q.gaps, 1)
+        self.assertEqual(times(contents(q)), [0, 1])
+
+    def test_block_nowait(self):
+        """
+        A put that may not block drops the datapoint at once.
+        """
+        q = BoundedQueue(2, BLOCK, timeout=10)
+        self.fill(q, 2)
+        start = time.time()
+        q.put_nowait(datapoint(2))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(q.gaps, 1)
+
+    def test_downsample(self):
+        """
+        Under pressure, a shrinking share of new datapoints is kept and memory stays bounded.
+        """
+        q = BoundedQueue(4, DOWNSAMPLE)
+        self.fill(q, 100)
+        items = contents(q)
+        kept = times(items)
+        self.assertEqual(len(kept), 4)
+        self.assertEqual(q.gaps, 96)
+        self.assertEqual(sum(i.count for i in items if isinstance(i, Gap)), 96)
+        self.assertTrue(len(items) <= 2 * len(kept) + 1)
+
+    def test_marker(self):
+        """
+        Markers are never dropped and do not use up room for datapoints.
+        """
+        end = object()
+        q = BoundedQueue(2, DROP_OLDEST)
+        q.put(datapoint(0))
+        q.put_marker(end)
+        self.fill(q, 5)
+        items = contents(q)
+        self.assertIn(end, items)
+        self.assertEqual(times(items), [3, 4])
+        self.assertEqual(q.gaps, 4)
+
+class ChannelTestCase(unittest.TestCase):
+    """
+    A Channel publishes and drains whole batches.
+    """
+    def test_drain(self):
+        c = Channel(10)
+        self.assertEqual(c.drain(), [])
+        c.put_many([datapoint(t) for t in range(4)])
+        c.put(datapoint(4))
+        self.assertEqual(times(c.drain()), range(5))
+        self.assertEqual(c.qsize(), 0)
+        c.join()  # drained items count as done
+
+    def test_put_many_overflow(self):
+        c = Channel(3, DROP_OLDEST)
+        c.put_many([datapoint(t) for t in range(5)])
+        items = c.drain()
+        self.assertEqual(items[0].count, 2)
+        self.assertEqual(times(items), [2, 3, 4])
+        c.put_many([datapoint(t) for t in range(5, 8)])
+        self.assertEqual(times(c.drain()), [5, 6, 7])
+
+    def test_drain_wait_count(self):
+        """
+        drain_wait() returns as soon as enough items are in the channel.
+        """
+        c = Channel()
+        def publish():
+            for t in range(10):
+                c.put(datapoint(t))
+                time.sleep(0.01)
+        producer = Thread(target=publish)
+        producer.start()
+        items = c.drain_wait(5, timeout=5)
+        producer.join()
+        self.assertTrue(len(items) >= 5)
+        self.assertEqual(times(items + c.drain()), range(10))
+
+    def test_drain_wait_timeout(self):
+        c = Channel()
+        c.put(datapoint(0))
+        start = time.time()
+        items = c.drain_wait(5, timeout=0.1)
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(times(items), [0])
+        self.assertEqual(c.drain_wait(1, timeout=0.01), [])
+
+    def test_drain_wait_end(self):
+        """
+        An end-of-data marker ends the wait.
+        """
+        c = Channel()
+        obs = TestLoopObserver('looper', c, interval=0, count=2)
+        obs.run()
+        items = c.drain_wait(100, timeout=5)
+        self.assertEqual(len(items), 3)
+        self.assertIs(items[-1], obs.end_data)
+
+    def test_drain_plain_queue(self):
+        q = Queue()
+        for t in range(3):
+            q.put(datapoint(t))
+        self.assertEqual(times(drain(q)), [0, 1, 2])
+        q.join()
+
+class LoopObserverQueueTestCase(unittest.TestCase):
+    """
+    Loop observers report lost datapoints whatever kind of queue they use.
+    """
+    def test_bounded(self):
+        q = BoundedQueue(2, DROP_OLDEST)
+        obs = TestLoopObserver('looper', q, interval=0, count=5)
+        obs.run()
+        self.assertEqual(obs.status()['gaps'], 3)
+        items = contents(q)
+        self.assertIs(items[-1], obs.end_data)
+
+    def test_plain_full(self):
+        q = Queue(2)
+        obs = TestLoopObserver('looper', q, interval=0.01, count=3)
+        for i in range(3):
+            obs.sample()
+        self.assertEqual(obs.gaps, 1)
+        self.assertEqual(q.qsize(), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Tests for the WSGI path dispatcher.
+"""
+from resty import PathDispatcher
+from StringIO import StringIO
+import unittest
+
+def echo(environ, start_response):
+    start_response('200 OK', [])
+    return [repr(sorted(environ['params'].items()))]
+
+def untouched(environ, start_response):
+    start_response('200 OK', [])
+    return ['ok']
+
+class PathDispatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = PathDispatcher()
+        self.dispatcher.register('GET', '/hello', echo)
+        self.dispatcher.register('GET', '/stats/disk/<device>', echo)
+        self.dispatcher.register('GET', '/stats/<kind>/<device>/since', echo)
+        self.dispatcher.register('GET', '/lazy', untouched)
+        self.dispatcher.register('POST', '/form', echo)
+
+    def request(self, path, method='GET', query='', body=''):
+        environ = {
+            'PATH_INFO': path,
+            'REQUEST_METHOD': method,
+            'QUERY_STRING': query,
+            'wsgi.input': StringIO(body),
+        }
+        if body:
+            environ['CONTENT_LENGTH'] = str(len(body))
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        status = []
+        out = ''.join(self.dispatcher(environ, lambda s, h: status.append(s)))
+        return status[0], out, environ
+
+    def test_exact(self):
+        status, out, _ = self.request('/hello', query='name=joe&x=1&x=2')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(out, repr([('name', 'joe'), ('x', ['1', '2'])]))
+
+    def test_blank(self):
+        _, _, environ = self.request('/hello', query='part=&x=1')
+        self.assertIsNone(environ['params'].get('part'))
+
+    def test_route_params(self):
+        status, out, environ = self.request('/stats/disk/sda1', query='part=2')
+        self.assertEqual(out, repr([('device', 'sda1'), ('part', '2')]))
+        self.assertEqual(environ['wsgiorg.routing_args'], ((), {'device': 'sda1'}))
+        _, out, _ = self.request('/stats/net/eth0/since')
+        self.assertEqual(out, repr([('device', 'eth0'), ('kind', 'net')]))
+
+    def test_many_routes(self):
+        """
+        More routes than one regular expression has groups for.
+        """
+        for i in range(200):
+            self.dispatcher.register('GET', '/obs{}/<field>'.format(i), echo)
+        _, out, _ = self.request('/obs199/MemFree')
+        self.assertEqual(out, repr([('field', 'MemFree')]))
+        _, out, _ = self.request('/stats/disk/sda1')
+        self.assertEqual(out, repr([('device', 'sda1')]))
+
+    def test_not_found(self):
+        self.assertEqual(self.request('/stats/disk/sda1/extra')[0], '404 Not Found')
+        self.assertEqual(self.request('/stats/disk/')[0], '404 Not Found')
+        self.assertEqual(self.request('/hello', method='POST')[0], '404 Not Found')
+
+    def test_lazy(self):
+        """
+        Parameters are not parsed unless the handler reads them.
+        """
+        _, _, environ = self.request('/lazy', query='a=1')
+        self.assertIsNone(environ['params']._params)
+        self.assertEqual(environ['params'].get('a'), '1')
+
+    def test_form_body(self):
+        _, out, _ = self.request('/form', method='POST', body='a=1&b=two')
+        self.assertEqual(out, repr([('a', '1'), ('b', 'two')]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Tests for the observer scheduler.
+"""
+import errno
+from ptrial.observer.core import ObserverError, TestLoopObserver
+from ptrial.observer.queues import BLOCK, BoundedQueue
+from ptrial.observer.scheduler import Scheduler
+from Queue import Queue
+from threading import Thread, active_count
+import time
+import unittest
+
+Q_TIMEOUT = 3
+
+class SchedulerTestCase(unittest.TestCase):
+    """
+    A Scheduler runs many loop observers from one thread.
+    """
+    def setUp(self):
+        self.sched = Scheduler()
+        self.thread = Thread(target=self.sched.run)
+
+    def tearDown(self):
+        self.sched.stop()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def drain(self, q, obs):
+        items = []
+        while True:
+            data = q.get(timeout=Q_TIMEOUT)
+            if data is obs.end_data:
+                return items
+            items.append(data)
+
+    def test_count(self):
+        """
+        Every observer delivers its count of datapoints followed by the end marker.
+        """
+        observers = []
+        for i in range(20):
+            q = Queue()
+            obs = TestLoopObserver('looper{}'.format(i), q, count=2)
+            self.sched.add(obs)
+            observers.append((q, obs))
+        threads = active_count()
+        self.thread.start()
+        self.assertEqual(active_count(), threads + 1)
+        for q, obs in observers:
+            items = self.drain(q, obs)
+            self.assertEqual(len(items), 2)
+            self.assertEqual(items[0]['name'], obs.name)
+
+    def test_stop_observer(self):
+        """
+        Stopping one observer ends its stream without affecting the others.
+        """
+        q1, q2 = Queue(), Queue()
+        obs1 = TestLoopObserver('one', q1)
+        obs2 = TestLoopObserver('two', q2, count=3)
+        self.sched.add(obs1)
+        self.sched.add(obs2)
+        self.thread.start()
+        obs1.stop()
+        self.drain(q1, obs1)
+        self.assertEqual(len(self.drain(q2, obs2)), 3)
+
+    def test_stop_scheduler(self):
+        """
+        Stopping the scheduler puts the end marker in every queue.
+        """
+        q = Queue()
+        obs = TestLoopObserver('looper', q)
+        self.sched.add(obs)
+        self.thread.start()
+        time.sleep(1.5)
+        self.sched.stop()
+        self.thread.join()
+        self.assertGreaterEqual(len(self.drain(q, obs)), 1)
+        self.assertFalse(obs.running)
+
+    def test_failing_observer(self):
+        """
+        An observer that raises is stopped and finished; the others keep sampling.
+        """
+        class Failing(TestLoopObserver):
+            def _read_source(self):
+                raise IOError(errno.EACCES, 'Permission denied')
+        q1, q2 = Queue(), Queue()
+        bad = Failing('bad', q1)
+        good = TestLoopObserver('good', q2, interval=0.01, count=5)
+        self.sched.add(bad)
+        self.sched.add(good)
+        self.thread.start()
+        self.assertEqual(self.drain(q1, bad), [])
+        self.assertEqual(len(self.drain(q2, good)), 5)
+        self.assertFalse(bad.running)
+        self.assertIsInstance(self.sched.errors['bad'], IOError)
+        self.assertTrue(self.thread.is_alive())
+
+    def test_full_queue(self):
+        """
+        An observer whose queue is full loses datapoints without holding up the others.
+        """
+        full = BoundedQueue(1, BLOCK, timeout=10)
+        stuck = TestLoopObserver('stuck', full, interval=0.01, count=5)
+        q = Queue()
+        good = TestLoopObserver('good', q, interval=0.01, count=5)
+        self.sched.add(stuck)
+        self.sched.add(good)
+        start = time.time()
+        self.thread.start()
+        self.assertEqual(len(self.drain(q, good)), 5)
+        self.assertLess(time.time() - start, 5)
+        self.drain(full, stuck)
+        self.assertEqual(stuck.gaps, 4)
+
+    def test_no_queue(self):
+        obs = TestLoopObserver('looper', None)
+        self.assertRaises(ObserverError, self.sched.add, obs)
+
+    def test_blocking_queue(self):
+        """
+        A bounded plain Queue could block the thread on the end-of-data marker.
+        """
+        obs = TestLoopObserver('looper', Queue(maxsize=1))
+        self.assertRaises(ObserverError, self.sched.add, obs)
@@ -0,0 +1,179 @@
+"""
+Tests for the store package.
+"""
+from ptrial.observer.core import COUNTER, ENUM, GAUGE
+from ptrial.store.query import Catalog, TrialStore, CATALOG
+from ptrial.store.rollup import Rollup, RollupSet, rollup_dir
+from ptrial.store.segment import SegmentError, SegmentReader, SegmentWriter
+import os
+import shutil
+import tempfile
+import unittest
+
+NAMES = ('state', 'count', 'level')
+TYPES = (ENUM, COUNTER, GAUGE)
+
+def rows(start, stop):
+    for t in range(start, stop):
+        yield t, {'state': 'RS'[t % 2], 'count': t * 10, 'level': None if t % 3 else 0.5}
+
+class SegmentTestCase(unittest.TestCase):
+    """
+    Segments are written as fixed-width records and read back through mmap.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'obs.seg')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, start, stop):
+        writer = SegmentWriter(self.path, 'obs', NAMES, TYPES, meta={'node': '10.0.0.1'})
+        writer.append_many(rows(start, stop))
+        writer.close()
+        return writer
+
+    def test_round_trip(self):
+        writer = self.write(100, 110)
+        self.assertEqual(len(writer), 10)
+        self.assertEqual(writer.size, os.path.getsize(self.path))
+        with SegmentReader(self.path) as reader:
+            self.assertEqual(reader.name, 'obs')
+            self.assertEqual(reader.field_names, NAMES)
+            self.assertEqual(reader.header['meta']['node'], '10.0.0.1')
+            self.assertEqual(reader.data_offset % 8, 0)
+            self.assertEqual(len(reader), 10)
+            self.assertEqual(list(reader.range()), [(float(t), d) for t, d in rows(100, 110)])
+
+    def test_range(self):
+        self.write(100, 110)
+        with SegmentReader(self.path) as reader:
+            self.assertEqual([t for t, d in reader.range(103, 106)], [103, 104, 105])
+            self.assertEqual([t for t, d in reader.range(end=101)], [100])
+            self.assertEqual(list(reader.range(200)), [])
+
+    def test_append(self):
+        self.write(100, 105)
+        self.write(105, 108)
+        with SegmentReader(self.path) as reader:
+            self.assertEqual([t for t, d in reader.range()], range(100, 108))
+
+    def test_partial_record(self):
+        self.write(100, 105)
+        with open(self.path, 'ab') as f:
+            f.write('\1\2\3')
+        with SegmentReader(self.path) as reader:
+            self.assertEqual(len(reader), 5)
+        self.write(105, 106)
+        with SegmentReader(self.path) as reader:
+            self.assertEqual([t for t, d in reader.range()], range(100, 106))
+
+    def test_refresh(self):
+        writer = SegmentWriter(self.path, 'obs', NAMES, TYPES)
+        writer.append_many(rows(0, 2))
+        writer.flush()
+        reader = SegmentReader(self.path)
+        writer.append_many(rows(2, 4))
+        writer.flush()
+        self.assertEqual(len(reader), 2)
+        reader.refresh()
+        self.assertEqual(len(reader), 4)
+        reader.close()
+        writer.close()
+
+    def test_schema_mismatch(self):
+        self.write(0, 1)
+        self.assertRaises(SegmentError, SegmentWriter, self.path, 'obs', ('other',))
+
+    def test_not_segment(self):
+        with open(self.path, 'wb') as f:
+            f.write('timestamp,a,b\n1,2,3\n')
+        self.assertRaises(SegmentError, SegmentReader, self.path)
+
+class QueryTestCase(unittest.TestCase):
+    """
+    Range queries use the catalog and sparse index to read only overlapping records.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dir = os.path.join(self.root, 'trial1', 'node1', 'obs')
+        os.makedirs(self.dir)
+        # three segments of 1000 records each, 1 second apart
+        for n in range(3):
+            writer = SegmentWriter(os.path.join(self.dir, 'obs-{}.seg'.format(n)), 'obs',
+                                   NAMES, TYPES)
+            writer.append_many(rows(n * 1000, (n + 1) * 1000))
+            writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_catalog(self):
+        catalog = Catalog(self.dir, stride=100)
+        entries = catalog.refresh()
+        self.assertEqual([e['file'] for e in entries], ['obs-0.seg', 'obs-1.seg', 'obs-2.seg'])
+        self.assertEqual((entries[1]['first'], entries[1]['last']), (1000, 1999))
+        self.assertEqual(len(entries[1]['index']), 10)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, CATALOG)))
+        self.assertEqual(Catalog(self.dir, stride=100).entries(), entries)
+
+    def test_query(self):
+        catalog = Catalog(self.dir, stride=64)
+        times = [t for t, data in catalog.query(950, 2050)]
+        self.assertEqual(times, range(950, 2050))
+        self.assertEqual([t for t, d in catalog.query(end=3)], [0, 1, 2])
+        self.assertEqual([t for t, d in catalog.query(2998)], [2998, 2999])
+        self.assertEqual(list(catalog.query(5000)), [])
+
+    def test_fields(self):
+        store = TrialStore(self.root)
+        self.assertEqual(store.nodes('trial1'), ['node1'])
+        self.assertEqual(store.observers('trial1', 'node1'), ['obs'])
+        result = list(store.query('trial1', 'node1', 'obs', 10, 12, fields=('count',)))
+        self.assertEqual(result, [(10, {'count': 100}), (11, {'count': 110})])
+
+    def test_growing_segment(self):
+        catalog = Catalog(self.dir)
+        catalog.refresh()
+        writer = SegmentWriter(os.path.join(self.dir, 'obs-2.seg'), 'obs', NAMES, TYPES)
+        writer.append_many(rows(3000, 3010))
+        writer.close()
+        self.assertEqual([t for t, d in catalog.query(3005)], range(3005, 3010))
+
+class RollupTestCase(unittest.TestCase):
+    """
+    Rollups summarize datapoints into time buckets as they arrive.
+    """
+    def test_buckets(self):
+        rollup = Rollup(60, NAMES, TYPES)
+        self.assertEqual(rollup.field_names[:3], ('state.last', 'count.min', 'count.max'))
+        closed = [rollup.add(t, data) for t, data in rows(110, 250)]
+        closed = [c for c in closed if c is not None]
+        self.assertEqual([bucket for bucket, summary in closed], [60, 120, 180])
+        bucket, summary = closed[1]
+        self.assertEqual(summary['count.min'], 1200)
+        self.assertEqual(summary['count.max'], 1790)
+        self.assertEqual(summary['count.mean'], 1495.0)
+        self.assertEqual(summary['count.last'], 1790)
+        self.assertEqual(summary['count.count'], 60)
+        self.assertEqual(summary['level.count'], 20)
+        self.assertEqual(summary['state.last'], 'S')
+        self.assertEqual(rollup.flush()[0], 240)
+        self.assertIsNone(rollup.flush())
+
+    def test_empty_field(self):
+        rollup = Rollup(10, ('a',))
+        rollup.add(0, {'a': None})
+        bucket, summary = rollup.flush()
+        self.assertEqual(summary['a.count'], 0)
+        self.assertIsNone(summary['a.mean'])
+
+    def test_set(self):
+        rollups = RollupSet(NAMES, TYPES, (60, 300))
+        closed = []
+        for t, data in rows(0, 601):
+            closed.extend(rollups.add(t, data))
+        self.assertEqual([(r, b) for r, b, s in closed if r == 300], [(300, 0), (300, 300)])
+        self.assertEqual(len([c for c in closed if c[0] == 60]), 10)
+        self.assertEqual(rollup_dir(300), 'rollup-300s')
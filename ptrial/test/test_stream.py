@@ -0,0 +1,106 @@
+"""
+Tests for the observer stream server.
+"""
+import httplib
+import json
+from ptrial.observer.core import ObserverError, TestLoopObserver
+from ptrial.observer.kernel import DiskStatsObserver
+from ptrial.observer.queues import Channel
+from ptrial.observer.stream import StreamLog, StreamServer
+from threading import Thread
+import unittest
+
+class StreamLogTestCase(unittest.TestCase):
+    def test_since(self):
+        log = StreamLog(5)
+        log.extend(range(3))
+        self.assertEqual(log.since(0), ([0, 1, 2], 3, 0))
+        self.assertEqual(log.since(3), ([], 3, 0))
+        log.extend(range(3, 10))
+        self.assertEqual((log.first_seq, log.next_seq), (5, 10))
+        self.assertEqual(log.since(3, limit=2), ([5, 6], 7, 2))
+
+class StreamServerTestCase(unittest.TestCase):
+    """
+    Many subscribers read the same stream, each from its own cursor.
+    """
+    def setUp(self):
+        self.server = StreamServer(('127.0.0.1', 0), poll=0.01)
+        self.thread = Thread(target=self.server.run)
+        self.obs = TestLoopObserver('looper one', Channel(), interval=0, count=5)
+        self.server.add(self.obs)
+
+    def tearDown(self):
+        self.server.stop()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def get(self, path):
+        conn = httplib.HTTPConnection(*self.server.address, timeout=5)
+        conn.request('GET', path)
+        return conn.getresponse()
+
+    def test_streams(self):
+        self.thread.start()
+        resp = self.get('/streams')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(resp.read()), ['looper one'])
+        self.assertEqual(self.get('/stream/nothing').status, 404)
+        self.assertEqual(self.get('/stream/looper%20one?format=xml').status, 400)
+
+    def test_subscribers(self):
+        """
+        Every subscriber gets every datapoint, and the response ends with the observer.
+        """
+        self.obs.run()
+        self.thread.start()
+        ndjson = self.get('/stream/looper%20one?from=oldest')
+        csv = self.get('/stream/looper%20one?from=oldest&format=csv')
+        self.assertEqual(ndjson.getheader('transfer-encoding'), 'chunked')
+        lines = ndjson.read().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['name'], 'looper one')
+        lines = csv.read().splitlines()
+        self.assertEqual(lines[0], 'timestamp,test')
+        self.assertEqual(len(lines), 6)
+
+    def test_latest(self):
+        """
+        A subscriber starting at the latest datapoint sees only what comes after it.
+        """
+        self.obs.run()
+        self.server.pump()
+        self.thread.start()
+        self.assertEqual(self.get('/stream/looper%20one').read(), '')
+        self.assertEqual(self.server.status()['streams']['looper one']['next'], 5)
+
+    def test_bad_stream(self):
+        """
+        A stream that cannot be encoded drops its own subscribers and leaves the rest alone.
+        """
+        bad = TestLoopObserver('bad', Channel(), count=1)
+        self.server.add(bad)
+        bad.queue.put({'name': 'bad', 1: {'unexpected': 1}})
+        bad.queue.put_marker(bad.end_data)
+        self.obs.run()
+        self.thread.start()
+        self.assertRaises(httplib.HTTPException, self.get('/stream/bad?from=oldest').read)
+        self.assertIsInstance(self.server.errors['bad'], KeyError)
+        lines = self.get('/stream/looper%20one?from=oldest').read().splitlines()
+        self.assertEqual(len(lines), 5)
+
+    def test_add_running(self):
+        """
+        Streams added while the server runs are served, and the server keeps running.
+        """
+        self.thread.start()
+        for i in range(200):
+            self.server.add(TestLoopObserver('added{}'.format(i), Channel(), count=1))
+        self.assertEqual(len(json.loads(self.get('/streams').read())), 201)
+        self.assertTrue(self.thread.is_alive())
+
+    def test_nested(self):
+        self.assertRaises(ObserverError, self.server.add, DiskStatsObserver('disks', Channel()))
+
+if __name__ == "__main__":
+    unittest.main()
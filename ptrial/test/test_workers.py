@@ -0,0 +1,133 @@
+"""
+Tests for running observers in worker processes.
+"""
+from collections import OrderedDict
+import marshal
+import os
+from ptrial.observer.core import ObserverError, TestLoopObserver, CSV_DATA
+from ptrial.observer.kernel import DiskStatsObserver
+from ptrial.observer.queues import Channel
+from ptrial.observer.workers import Ring, WorkerPool, _RingQueue, _pack, _unpack
+from Queue import Queue
+import time
+import unittest
+
+Q_TIMEOUT = 5
+
+class RingTestCase(unittest.TestCase):
+    def test_wrap(self):
+        """
+        Records that run past the end of the buffer come back whole.
+        """
+        ring = Ring(64)
+        for n in range(20):
+            record = str(n) * 20
+            self.assertTrue(ring.write(record))
+            self.assertEqual(ring.read(), [record])
+        self.assertEqual(ring.read(), [])
+        ring.close()
+
+    def test_full(self):
+        ring = Ring(64)
+        self.assertTrue(ring.write('a' * 28))
+        self.assertTrue(ring.write('b' * 28))
+        self.assertFalse(ring.write('c'))
+        self.assertEqual(ring.dropped, 1)
+        self.assertEqual(ring.used, 64)
+        self.assertEqual(ring.read(), ['a' * 28, 'b' * 28])
+        self.assertRaises(ObserverError, ring.write, 'x' * 61)
+        ring.close()
+
+    def test_gap(self):
+        """
+        Datapoints that do not fit are sent as a Gap ahead of the next one that does.
+        """
+        ring = Ring(256)
+        queue = _RingQueue(ring, 3)
+        datapoint = {'name': 'obs', 100: OrderedDict([('a', 'x' * 150)])}
+        queue.put(datapoint)
+        queue.put({'name': 'obs', 101: OrderedDict([('a', 'x' * 150)])})
+        queue.put({'name': 'obs', 102: OrderedDict([('a', 'x' * 150)])})
+        self.assertEqual(queue.gaps, 2)
+        self.assertEqual(len(ring.read()), 1)
+        queue.put({'name': 'obs', 103: OrderedDict([('a', 1)])})
+        records = [marshal.loads(r) for r in ring.read()]
+        self.assertEqual(records[0], (3, 2, (2, 101, 102)))
+        self.assertEqual(records[1][0:2], (3, 0))
+        ring.close()
+
+class PackTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        data = OrderedDict([('processes', OrderedDict([(12, OrderedDict([('state', 'R'),
+                                                                         ('rss', 3)]))])),
+                            ('started', OrderedDict()),
+                            ('exited', [4, 5]),
+                            ('pair', (1, 2.5))])
+        datapoint = {'name': 'proc', 1426168800: data}
+        packed = marshal.loads(marshal.dumps(_pack(datapoint)))
+        unpacked = _unpack(packed)
+        self.assertEqual(unpacked, datapoint)
+        self.assertEqual(unpacked[1426168800]['processes'].keys(), [12])
+        self.assertIsInstance(unpacked[1426168800]['pair'], tuple)
+        self.assertEqual(_unpack(_pack('1,2,3')), '1,2,3')
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def drain(self, q, obs):
+        items = []
+        while True:
+            data = q.get(timeout=Q_TIMEOUT)
+            if data is obs.end_data:
+                return items
+            items.append(data)
+
+    def test_count(self):
+        """
+        Every observer delivers its datapoints and end marker to its own queue in the parent.
+        """
+        pool = WorkerPool(3, poll=0.01)
+        observers = []
+        for i in range(8):
+            obs = TestLoopObserver('obs{}'.format(i), Queue(), interval=0.01, count=5)
+            pool.add(obs)
+            observers.append(obs)
+        pool.start()
+        try:
+            for obs in observers:
+                items = self.drain(obs.queue, obs)
+                self.assertEqual(len(items), 5)
+                self.assertEqual(items[0]['name'], obs.name)
+            status = pool.status()
+            self.assertEqual(len(status['workers']), 3)
+            self.assertEqual(sum(w['observers'] for w in status['workers']), 8)
+            self.assertNotIn(os.getpid(), [w['pid'] for w in status['workers']])
+        finally:
+            pool.stop()
+        self.assertEqual(pool.status()['ended'], 8)
+
+    def test_stop(self):
+        """
+        Stopping the pool stops observers with no count; the parent keeps their history.
+        """
+        pool = WorkerPool(2, poll=0.01)
+        obs = DiskStatsObserver('disks', Channel(), interval=0.01, data_format=CSV_DATA)
+        other = TestLoopObserver('test', Channel(), interval=0.01)
+        history = other.keep_history(100)
+        pool.add(obs)
+        pool.add(other)
+        pool.start()
+        time.sleep(0.3)
+        pool.stop()
+        for o in (obs, other):
+            items = o.queue.drain()
+            self.assertIs(items[-1], o.end_data)
+            self.assertGreater(len(items), 1)
+        self.assertIsInstance(items[0], dict)
+        self.assertEqual(len(history), len(items) - 1)
+        self.assertRaises(ObserverError, pool.add, obs)
+
+    def test_no_queue(self):
+        pool = WorkerPool(1)
+        self.assertRaises(ObserverError, pool.add, TestLoopObserver('obs', None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
 
 import json
 from ptrial.observer.core import JSON_DATA, CSV_DATA
+from ptrial.observer.encoders import CsvEncoder
+from ptrial.observer.fetch import HistoryHandler
 from ptrial.observer.kernel import StorageObserver
-from Queue import Queue
+from ptrial.observer.queues import Channel, DROP_OLDEST
+from ptrial.observer.scheduler import Scheduler
 from threading import Thread
 import time
 
@@ -48,27 +51,25 @@ def diskstats(environ, start_response):
     start_response('200 OK', [ ('Content-type', 'text/csv') ])
     params = environ['params']
     part = params.get('part')  # not sure what this is...
-    yield obs.field_names + '\n'
-    while True:
-        try:
-            data = q.get(block=False)
-            yield data.encode('utf-8') + '\n'
-            q.task_done()
-        except Queue.Empty:
-            print "queue is empty"
-            break
+    # one buffer for the whole queue; gaps (datapoints dropped while nobody was polling) are
+    # left out
+    encoder = CsvEncoder(obs.name, obs.field_names)
+    yield encoder.encode(q.drain())
     
 def ctrl(environ, start_response):
     global run
-    start_response('200 OK', [ ('Content-type', 'text/plain') ])
     params = environ['params']
     cmd = params.get('cmd')
+    content_type = 'text/plain'
     resp = 'unknown command'
     if cmd == 'shutdown':
         run = False
         resp = 'stopping'
     elif cmd == 'status':
-        resp = json.dumps(obs.status())
+        # counters and latency histograms (read, encode, enqueue, lateness) of the sampling loop
+        content_type = 'application/json'
+        resp = json.dumps(obs.status(), sort_keys=True)
+    start_response('200 OK', [ ('Content-type', content_type) ])
     yield resp.encode('utf-8')
     
 def create_observer(environ, start_response):
@@ -100,12 +101,18 @@ if __name__ == '__main__':
     dispatcher.register('GET', '/ctrl', ctrl)
     dispatcher.register('PUT', '/observer', create_observer)
     
-    # spin up the Observer thread for disk stats
+    # schedule the Observer for disk stats; one scheduler thread runs all observers
     # these globals will be rolled into objects later... or something like that
     global obs, q
-    q = Queue()
-    obs = StorageObserver('var partition', q, '/var', data_format=CSV_DATA)
-    t = Thread(target=obs.run)
+    # keep at most an hour of datapoints if nobody polls
+    q = Channel(3600, DROP_OLDEST)
+    obs = StorageObserver('var partition', q, '/var')
+    # pollers ask for what is new since their last cursor without draining the queue
+    history = obs.keep_history(3600)
+    dispatcher.register('GET', '/stats/disk/since', HistoryHandler(obs.name, history))
+    sched = Scheduler()
+    sched.add(obs)
+    t = Thread(target=sched.run)
     t.start()
     time.sleep(5) # get some data in the queue
 
@@ -116,13 +123,10 @@ if __name__ == '__main__':
     print('Serving on port 8080...')
     while run:
         httpd.handle_request()
-    # throw out the rest of the items in the queue and stop the observer thread
-    obs.stop()
-    discard = 0
-    while not q.empty():
-        discard += 1
-        q.get()
-        q.task_done()
+    # stop the scheduler (which stops the observer) and throw out the rest of the queue
+    sched.stop()
+    t.join()
+    discard = len(q.drain())
     print 'discarded {} queue items'.format(discard)
     q.join()
     print 'shutdown complete'
\ No newline at end of file
@@ -1,24 +1,128 @@
 # From Python Cookbook, 3rd ed.
+# Parameters are parsed only when a handler reads them, and routes can have <name> segments.
 
 import cgi
+from collections import Mapping
+import re
+from urlparse import parse_qs
+
+_ROUTE_PARAM = re.compile(r'<(\w+)>')
+_BODYLESS = frozenset(('GET', 'HEAD', 'DELETE', 'OPTIONS'))
+_MAX_GROUPS = 99  # Python 2's re allows at most 100 groups in a pattern
 
 def notfound_404(environ, start_response):
     start_response('404 Not Found', [ ('Content-type', 'text/plain') ])
     return [b'Not Found']
 
+class LazyParams(Mapping):
+    """
+    Request parameters, parsed from the query string (and form body) on first use.
+
+    Values are strings, or lists of strings for parameters given more than once, as with
+    cgi.FieldStorage.getvalue().  Path parameters from the route take precedence.
+    """
+    def __init__(self, environ, route_args=None):
+        self._environ = environ
+        self._route_args = route_args
+        self._params = None
+
+    def _load(self):
+        environ = self._environ
+        params = {}
+        if environ.get('REQUEST_METHOD', 'GET').upper() in _BODYLESS or \
+           not environ.get('CONTENT_LENGTH'):
+            # blank values are left out, as cgi.FieldStorage does
+            for key, values in parse_qs(environ.get('QUERY_STRING', '')).iteritems():
+                params[key] = values[0] if len(values) == 1 else values
+        else:
+            form = cgi.FieldStorage(environ['wsgi.input'], environ=environ)
+            params = { key: form.getvalue(key) for key in form }
+        if self._route_args:
+            params.update(self._route_args)
+        self._params = params
+        return params
+
+    def __getitem__(self, key):
+        return (self._params if self._params is not None else self._load())[key]
+
+    def __iter__(self):
+        return iter(self._params if self._params is not None else self._load())
+
+    def __len__(self):
+        return len(self._params if self._params is not None else self._load())
+
 class PathDispatcher:
+    """
+    Dispatch WSGI requests to handlers by method and path.
+
+    A path is matched exactly, or against routes with parameters such as /stats/disk/<device>,
+    where each <name> matches one path segment.  The parameterized routes for a method are
+    compiled into as few regular expressions as the re module's limit on groups allows.  Path
+    parameters are in environ['params'] with the query parameters, and in
+    environ['wsgiorg.routing_args'].
+    """
     def __init__(self):
         self.pathmap = { }
+        self._routes = { }    # method -> list of (path, function)
+        self._matchers = { }  # method -> list of (compiled regex, {group: (function, names)})
 
     def __call__(self, environ, start_response):
         path = environ['PATH_INFO']
-        params = cgi.FieldStorage(environ['wsgi.input'],
-                                  environ=environ)
         method = environ['REQUEST_METHOD'].lower()
-        environ['params'] = { key: params.getvalue(key) for key in params }
-        handler = self.pathmap.get((method,path), notfound_404)
+        handler = self.pathmap.get((method,path))
+        args = None
+        if handler is None:
+            handler, args = self._match(method, path)
+            environ['wsgiorg.routing_args'] = ((), args or {})
+        environ['params'] = LazyParams(environ, args)
         return handler(environ, start_response)
 
     def register(self, method, path, function):
-        self.pathmap[method.lower(), path] = function
-        return function
\ No newline at end of file
+        method = method.lower()
+        if _ROUTE_PARAM.search(path):
+            self._routes.setdefault(method, []).append((path, function))
+            self._compile(method)
+        else:
+            self.pathmap[method, path] = function
+        return function
+
+    def _match(self, method, path):
+        for regex, routes in self._matchers.get(method, ()):
+            m = regex.match(path)
+            if m is not None:
+                # the route's own group closes last, so it is the match's lastindex
+                function, groups = routes[m.lastindex]
+                return function, dict((name, m.group(i)) for name, i in groups)
+        return notfound_404, None
+
+    def _compile(self, method):
+        """
+        Compile the method's routes, in the order they were registered, starting a new regular
+        expression whenever the next route would take one past _MAX_GROUPS groups.
+        """
+        matchers = []
+        patterns = []
+        routes = {}
+        group = 0
+        for path, function in self._routes[method]:
+            if group + 1 + len(_ROUTE_PARAM.findall(path)) > _MAX_GROUPS and patterns:
+                matchers.append((re.compile('(?:{})$'.format('|'.join(patterns))), routes))
+                patterns = []
+                routes = {}
+                group = 0
+            group += 1
+            route_group = group
+            names = []
+            parts = []
+            pos = 0
+            for m in _ROUTE_PARAM.finditer(path):
+                parts.append(re.escape(path[pos:m.start()]))
+                parts.append('([^/]+)')
+                group += 1
+                names.append((m.group(1), group))
+                pos = m.end()
+            parts.append(re.escape(path[pos:]))
+            patterns.append('({})'.format(''.join(parts)))
+            routes[route_group] = (function, names)
+        matchers.append((re.compile('(?:{})$'.format('|'.join(patterns))), routes))
+        self._matchers[method] = matchers
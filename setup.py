@@ -13,7 +13,7 @@ setup(
     license = "BSD",
     keywords = "performance metrics distributed benchmark",
     url = "http://github.com/sdlowrey/ptrial",
-    packages = ['ptrial', 'ptrial.observer'],
+    packages = ['ptrial', 'ptrial.observer', 'ptrial.store'],
     scripts = ['bin/observe'],
     long_description = read('README'),
     classifiers = [